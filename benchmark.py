@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for the simulation framework"""
+import sys
+import time
+import random
+import logging
+
+from node import Node
+from framework import Framework, reset_all
+from timer import TimerManager, TimerList, TimerHeap, TimerWheel
+from hash_multiple import ConsistentHashTable
+from merkle import MerkleTree
+import hashfunc
+
+# Keep logging out of the measurements
+logging.getLogger('dynamo').setLevel(logging.WARNING)
+
+
+def _timed(func, *args):
+    """Run func(*args), returning the elapsed time in seconds"""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+# PART timers
+def bench_timer_store(store_class, count):
+    """Start count timers, cancel most of them (as for request timers that get a
+    response), then pop the remainder.  Returns (start, cancel, pop) elapsed times."""
+    store = store_class()
+    timers = [object() for _ in xrange(count)]
+    cancels = random.sample(timers, (count * 9) // 10)
+
+    def start():
+        for tmsg in timers:
+            store.add(random.choice((10, 15, 17, 20)), tmsg)
+
+    def cancel():
+        for tmsg in cancels:
+            store.remove(tmsg)
+
+    def pop():
+        while len(store) > 0:
+            store.pop()
+
+    return (_timed(start), _timed(cancel), _timed(pop))
+
+
+TIMER_STORES = [TimerList, TimerHeap, TimerWheel]
+SLOW_TIMER_STORES = {TimerList: 10000}  # store class => largest count worth running
+
+
+def bench_timers(counts):
+    print "%-12s %8s %10s %10s %10s" % ("store", "timers", "start", "cancel", "pop")
+    for count in counts:
+        for store_class in TIMER_STORES:
+            if count > SLOW_TIMER_STORES.get(store_class, count):
+                print "%-12s %8d %10s" % (store_class.__name__, count, "(skipped)")
+                continue
+            times = bench_timer_store(store_class, count)
+            print "%-12s %8d %9.3fs %9.3fs %9.3fs" % ((store_class.__name__, count) + times)
+
+
+def bench_request_timers(store_class, count):
+    """In virtual time, start count request timers with 100-200ms timeouts, cancel most
+    of them, then run the remainder to expiry.  Returns (start, cancel, expire) times."""
+    reset_all()
+    TimerManager.use_store(store_class)
+    Framework.set_latency(1)
+    node = Node()
+    timers = []
+
+    def noop(reason):
+        pass
+
+    def start():
+        for _ in xrange(count):
+            timers.append(TimerManager.start_timer(node, callback=noop, duration=random.randint(100, 200)))
+
+    def cancel():
+        for tmsg in random.sample(timers, (count * 9) // 10):
+            TimerManager.cancel_timer(tmsg)
+
+    def expire():
+        Framework.schedule(timers_to_process=count)
+
+    result = (_timed(start), _timed(cancel), _timed(expire))
+    TimerManager.use_store(TimerHeap)
+    reset_all()
+    return result
+
+
+def bench_wheel(counts):
+    print "%-18s %8s %10s %10s %10s" % ("virtual-time store", "timers", "start", "cancel", "expire")
+    stores = [("TimerHeap", TimerHeap),
+              ("TimerWheel(1ms)", TimerWheel),
+              ("TimerWheel(10ms)", lambda: TimerWheel(tick=10))]
+    for count in counts:
+        for (name, store_class) in stores:
+            times = bench_request_timers(store_class, count)
+            print "%-18s %8d %9.3fs %9.3fs %9.3fs" % ((name, count) + times)
+
+
+# PART ring
+def bench_ring(counts):
+    """Map count keys to preference lists of 3 nodes on a 20-node ring, one key at a time
+    and as a single batch"""
+    print "%-16s %8s %10s" % ("ring lookup", "keys", "time")
+    ring = ConsistentHashTable(['N%d' % ii for ii in xrange(20)], 10)
+    for count in counts:
+        keys = ['K%d' % random.randint(0, 1000000000) for _ in xrange(count)]
+        ring.find_nodes_many(keys[:1], 3)  # build the batch tables outside the measurement
+        print "%-16s %8d %9.3fs" % ("find_nodes", count, _timed(lambda: [ring.find_nodes(key, 3) for key in keys]))
+        print "%-16s %8d %9.3fs" % ("find_nodes_many", count, _timed(ring.find_nodes_many, keys, 3))
+
+
+# PART hashes
+def bench_hash_put(hashfn, count):
+    """Hash count keys to their tokens, then store them as for the put path of a DynamoNode:
+    find the preference list on a 20-node ring, then store the key in a Merkle tree.  Returns
+    (hash, ring, store) elapsed times; the hash itself is only a small part of the other two."""
+    ring = ConsistentHashTable(['N%d' % ii for ii in xrange(20)], 10, hashfn)
+    tree = MerkleTree(hashfn=hashfn)
+    keys = ['K%d' % random.randint(0, 1000000000) for _ in xrange(count)]
+
+    def tokens():
+        token = ring.hashfn.token
+        for key in keys:
+            token(key)
+
+    def lookup():
+        for key in keys:
+            ring.find_nodes(key, 3)
+
+    def store():
+        for key in keys:
+            tree[key] = key
+
+    return (_timed(tokens), _timed(lookup), _timed(store))
+
+
+def bench_hashes(counts):
+    print "%-8s %8s %10s %10s %10s" % ("hash", "keys", "hash", "ring", "store")
+    for count in counts:
+        for name in hashfunc.names():
+            times = bench_hash_put(name, count)
+            print "%-8s %8d %9.3fs %9.3fs %9.3fs" % ((name, count) + times)
+
+
+# PART merkle
+def bench_merkle_store(lazy, count):
+    """Store count keys in an empty Merkle tree, then get its root hash.  Returns (store, root)
+    elapsed times."""
+    tree = MerkleTree(lazy=lazy)
+    keys = ['K%d' % random.randint(0, 1000000000) for _ in xrange(count)]
+
+    def store():
+        for key in keys:
+            tree[key] = key
+
+    return (_timed(store), _timed(lambda: tree.root.value))
+
+
+def bench_merkle_build(count):
+    """Create count Merkle trees, as for the local stores of count DynamoNodes, then store a
+    key in each.  Returns (create, store) elapsed times."""
+    trees = []
+
+    def create():
+        for _ in xrange(count):
+            trees.append(MerkleTree())
+
+    def store():
+        for tree in trees:
+            tree['K'] = 'V'
+            tree.root.value
+
+    return (_timed(create), _timed(store))
+
+
+def bench_merkle(counts):
+    print "%-12s %8s %10s %10s" % ("merkle", "keys", "store", "root")
+    for count in counts:
+        for (name, lazy) in (("eager", False), ("lazy", True)):
+            times = bench_merkle_store(lazy, count)
+            print "%-12s %8d %9.3fs %9.3fs" % ((name, count) + times)
+    print "%-12s %8s %10s" % ("merkle", "keys", "initdata")
+    for count in counts:
+        data = dict(('K%d' % random.randint(0, 1000000000), ii) for ii in xrange(count))
+        print "%-12s %8d %9.3fs" % ("bulk build", count, _timed(lambda: MerkleTree(initdata=data).root.value))
+    print "%-12s %8s %10s %10s" % ("merkle", "trees", "create", "store")
+    for count in counts:
+        times = bench_merkle_build(count)
+        print "%-12s %8d %9.3fs %9.3fs" % (("depth 12", count) + times)
+
+
+BENCHMARKS = {'timers': bench_timers,
+              'wheel': bench_wheel,
+              'ring': bench_ring,
+              'hashes': bench_hashes,
+              'merkle': bench_merkle}
+
+
+if __name__ == "__main__":
+    counts = [1000, 10000, 100000]
+    names = []
+    ii = 1
+    while ii < len(sys.argv):
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            ii += 2
+        elif arg == "-n" or arg == "--count":
+            counts = [int(x) for x in sys.argv[ii + 1].split(',')]
+            ii += 2
+        else:
+            names.append(arg)
+            ii += 1
+    for name in (names or sorted(BENCHMARKS.keys())):
+        BENCHMARKS[name](counts)
@@ -2,19 +2,21 @@
 
 Final iteration: add use of vector clocks for metadata"""
 import copy
-import random
 import logging
 
 import logconfig
-from node import Node
+import simulation
+from node import Node, handles
 from timer import TimerManager
 from framework import Framework
 from hash_multiple import ConsistentHashTable
+from hash_partition import PartitionedHashTable
 from dynamomessages import ClientPut, ClientGet, ClientPutRsp, ClientGetRsp
 from dynamomessages import PutReq, GetReq, PutRsp, GetRsp
 from dynamomessages import DynamoRequestMessage
 from dynamomessages import PingReq, PingRsp
 from merkle import MerkleTree
+from hashfunc import KeyRef
 from vectorclock import VectorClock
 
 logconfig.init_logging()
@@ -28,12 +30,17 @@ class DynamoNode(Node):
     N = 3  # Number of nodes to replicate at
     W = 2  # Number of nodes that need to reply to a write operation
     R = 2  # Number of nodes that need to reply to a read operation
+    HASH = 'md5'  # Hash function for ring placement and Merkle bucketing (see hashfunc.py)
+    Q = None  # Number of fixed partitions of the ring (see hash_partition.py), or None for random tokens
+    EPSILON = None  # Load slack for bounded-load choice of coordinator (see hash_multiple.py), or None
+    __context__ = ('nodelist', 'chash')  # held separately for each Simulation
     nodelist = []
-    chash = ConsistentHashTable(nodelist, T)
+    chash = ConsistentHashTable(nodelist, T, HASH)
 
-    def __init__(self):
+    def __init__(self, weight=None):
+        """Create a node, which gets a share of the keys in proportion to its weight (default 1)"""
         super(DynamoNode, self).__init__()
-        self.local_store = MerkleTree()  # key => (value, metadata)
+        self.local_store = MerkleTree(hashfn=DynamoNode.HASH)  # key => (value, metadata)
         self.pending_put_rsp = {}  # seqno => set of nodes that have stored
         self.pending_put_msg = {}  # seqno => original client message
         self.pending_get_rsp = {}  # seqno => set of (node, value, metadata) tuples
@@ -41,10 +48,11 @@ class DynamoNode(Node):
         # seqno => set of requests sent to other nodes, for each message class
         self.pending_req = {PutReq: {}, GetReq: {}}
         self.failed_nodes = []
+        self.failed_epoch = 0  # Incremented whenever failed_nodes changes
         self.pending_handoffs = {}
-        # Rebuild the consistent hash table
+        # Add this node to the consistent hash table
         DynamoNode.nodelist.append(self)
-        DynamoNode.chash = ConsistentHashTable(DynamoNode.nodelist, DynamoNode.T)
+        DynamoNode.chash.add_node(self, weight)
         # Run a timer to retry failed nodes
         self.retry_failed_node("retry")
 
@@ -52,7 +60,11 @@ class DynamoNode(Node):
     @classmethod
     def reset(cls):
         cls.nodelist = []
-        cls.chash = ConsistentHashTable(cls.nodelist, cls.T)
+        if cls.Q:
+            cls.chash = PartitionedHashTable(cls.nodelist, cls.Q, cls.HASH)
+        else:
+            cls.chash = ConsistentHashTable(cls.nodelist, cls.T, cls.HASH)
+        cls.chash.load_epsilon = cls.EPSILON
 
 # PART storage
     def store(self, key, value, metadata):
@@ -68,27 +80,31 @@ class DynamoNode(Node):
     def retry_failed_node(self, _):  # Permanently repeating timer
         if self.failed_nodes:
             node = self.failed_nodes.pop(0)
+            self.failed_epoch = self.failed_epoch + 1
             # Send a test message to the oldest failed node
             pingmsg = PingReq(self, node)
             Framework.send_message(pingmsg)
         # Restart the timer
         TimerManager.start_timer(self, reason="retry", priority=15, callback=self.retry_failed_node)
 
+    @handles(PingReq)
     def rcv_pingreq(self, pingmsg):
         # Always reply to a test message
         pingrsp = PingRsp(pingmsg)
         Framework.send_message(pingrsp)
 
+    @handles(PingRsp)
     def rcv_pingrsp(self, pingmsg):
         # Remove all instances of recovered node from failed node list
         recovered_node = pingmsg.from_node
         while recovered_node in self.failed_nodes:
             self.failed_nodes.remove(recovered_node)
+            self.failed_epoch = self.failed_epoch + 1
         if recovered_node in self.pending_handoffs:
             for key in self.pending_handoffs[recovered_node]:
                 # Send our latest value for this key
                 (value, metadata) = self.retrieve(key)
-                putmsg = PutReq(self, recovered_node, key, value, metadata)
+                putmsg = PutReq(self, recovered_node, key, value, metadata)  # key may be a KeyRef
                 Framework.send_message(putmsg)
             del self.pending_handoffs[recovered_node]
 
@@ -97,7 +113,8 @@ class DynamoNode(Node):
         # no response to this request; treat the destination node as failed
         _logger.info("Node %s now treating node %s as failed", self, reqmsg.to_node)
         self.failed_nodes.append(reqmsg.to_node)
-        failed_requests = Framework.cancel_timers_to(reqmsg.to_node)
+        self.failed_epoch = self.failed_epoch + 1
+        failed_requests = Framework.cancel_timers_to(reqmsg.to_node, self)
         failed_requests.append(reqmsg)
         for failedmsg in failed_requests:
             self.retry_request(failedmsg)
@@ -106,10 +123,12 @@ class DynamoNode(Node):
         if not isinstance(reqmsg, DynamoRequestMessage):
             return
         # Send the request to an additional node by regenerating the preference list
-        preference_list = DynamoNode.chash.find_nodes(reqmsg.key, DynamoNode.N, self.failed_nodes)[0]
+        preference_list = DynamoNode.chash.find_nodes(reqmsg.keyref, DynamoNode.N, self.failed_nodes,
+                                                      (self, self.failed_epoch))[0]
         kls = reqmsg.__class__
         # Check the pending-request list for this type of request message
         if kls in self.pending_req and reqmsg.msg_id in self.pending_req[kls]:
+            retried = False
             for node in preference_list:
                 if node not in [req.to_node for req in self.pending_req[kls][reqmsg.msg_id]]:
                     # Found a node on the new preference list that hasn't been sent the request.
@@ -118,19 +137,68 @@ class DynamoNode(Node):
                     newreqmsg.to_node = node
                     self.pending_req[kls][reqmsg.msg_id].add(newreqmsg)
                     Framework.send_message(newreqmsg)
+                    retried = True
+            if not retried and not self.awaiting_responses(kls, reqmsg.msg_id):
+                # Every node that could help has replied or timed out, without enough replies
+                _logger.info("%s: no more nodes to try for %s, so abandon it", self, reqmsg)
+                self.end_request(kls, reqmsg.msg_id)
+
+    def awaiting_responses(self, kls, seqno):
+        """Indicate whether any of the requests sent out for a client request are still waiting
+        for a response"""
+        return any(req in Framework.pending_timers for req in self.pending_req[kls][seqno])
+
+    def end_request(self, kls, seqno):
+        """Stop tracking a client request that this node coordinates, whether it has completed
+        or can no longer complete, and give back its load.  Returns the original client request."""
+        del self.pending_req[kls][seqno]
+        if kls is PutReq:
+            del self.pending_put_rsp[seqno]
+            original_msg = self.pending_put_msg.pop(seqno)
+        else:
+            del self.pending_get_rsp[seqno]
+            original_msg = self.pending_get_msg.pop(seqno)
+        DynamoNode.chash.add_load(self, -1)
+        return original_msg
+
+# PART coordinator
+    def coordinator(self, msg, preference_list):
+        """Return the node that should coordinate a client request: this node if it is in the
+        preference list, otherwise the first node in the list.  In bounded-load mode, a node
+        in the list only coordinates if it is under its load bound or the request has already
+        been forwarded to it, and the request otherwise goes to the first node under the bound."""
+        if self in preference_list:
+            if DynamoNode.chash.under_bound(self) or getattr(msg, 'intermediate_node', None) is not None:
+                return self
+        return DynamoNode.chash.coordinator(preference_list)
+
+    def forward_request(self, msg, coordinator):
+        """Forward a client request to its coordinator.  The request counts towards the load
+        of the coordinator from now on, so later choices of coordinator take it into account."""
+        if getattr(msg, 'intermediate_node', None) is not None:
+            DynamoNode.chash.add_load(self, -1)  # already counted against this node
+        DynamoNode.chash.add_load(coordinator)
+        Framework.forward_message(msg, coordinator)
+
+    def start_request(self, msg):
+        """Count a client request that this node coordinates towards its load, unless it was
+        counted when it was forwarded here"""
+        if getattr(msg, 'intermediate_node', None) is None:
+            DynamoNode.chash.add_load(self)
 
 # PART rcv_clientput
+    @handles(ClientPut)
     def rcv_clientput(self, msg):
-        preference_list, avoided = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)
+        preference_list, avoided = DynamoNode.chash.find_nodes(msg.keyref, DynamoNode.N, self.failed_nodes,
+                                                               (self, self.failed_epoch))
         # Only track avoided nodes that would have been part of the original preference list
         avoided = avoided[:DynamoNode.N]
         non_extra_count = DynamoNode.N - len(avoided)
-        # Determine if we are in the list
-        if self not in preference_list:
+        coordinator = self.coordinator(msg, preference_list)
+        if coordinator is not self:
             # Forward to the coordinator for this key
             _logger.info("put(%s=%s) maps to %s", msg.key, msg.value, preference_list)
-            coordinator = preference_list[0]
-            Framework.forward_message(msg, coordinator)
+            self.forward_request(msg, coordinator)
         else:
             # Use an incrementing local sequence number to distinguish
             # multiple requests for the same key
@@ -143,6 +211,7 @@ class DynamoNode(Node):
             self.pending_req[PutReq][seqno] = set()
             self.pending_put_rsp[seqno] = set()
             self.pending_put_msg[seqno] = msg
+            self.start_request(msg)
             reqcount = 0
             for ii, node in enumerate(preference_list):
                 if ii >= non_extra_count:
@@ -151,7 +220,7 @@ class DynamoNode(Node):
                 else:
                     handoff = None
                 # Send message to get node in preference list to store
-                putmsg = PutReq(self, node, msg.key, msg.value, metadata, msg_id=seqno, handoff=handoff)
+                putmsg = PutReq(self, node, msg.keyref, msg.value, metadata, msg_id=seqno, handoff=handoff)
                 self.pending_req[PutReq][seqno].add(putmsg)
                 Framework.send_message(putmsg)
                 reqcount = reqcount + 1
@@ -160,22 +229,24 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_clientget
+    @handles(ClientGet)
     def rcv_clientget(self, msg):
-        preference_list = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)[0]
-        # Determine if we are in the list
-        if self not in preference_list:
+        preference_list = DynamoNode.chash.find_nodes(msg.keyref, DynamoNode.N, self.failed_nodes,
+                                                      (self, self.failed_epoch))[0]
+        coordinator = self.coordinator(msg, preference_list)
+        if coordinator is not self:
             # Forward to the coordinator for this key
             _logger.info("get(%s=?) maps to %s", msg.key, preference_list)
-            coordinator = preference_list[0]
-            Framework.forward_message(msg, coordinator)
+            self.forward_request(msg, coordinator)
         else:
             seqno = self.generate_sequence_number()
             self.pending_req[GetReq][seqno] = set()
             self.pending_get_rsp[seqno] = set()
             self.pending_get_msg[seqno] = msg
+            self.start_request(msg)
             reqcount = 0
             for node in preference_list:
-                getmsg = GetReq(self, node, msg.key, msg_id=seqno)
+                getmsg = GetReq(self, node, msg.keyref, msg_id=seqno)
                 self.pending_req[GetReq][seqno].add(getmsg)
                 Framework.send_message(getmsg)
                 reqcount = reqcount + 1
@@ -184,19 +255,22 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_put
+    @handles(PutReq)
     def rcv_put(self, putmsg):
         _logger.info("%s: store %s=%s", self, putmsg.key, putmsg.value)
-        self.store(putmsg.key, putmsg.value, putmsg.metadata)
+        self.store(putmsg.keyref, putmsg.value, putmsg.metadata)
         if putmsg.handoff is not None:
             for failed_node in putmsg.handoff:
                 self.failed_nodes.append(failed_node)
+                self.failed_epoch = self.failed_epoch + 1
                 if failed_node not in self.pending_handoffs:
                     self.pending_handoffs[failed_node] = set()
-                self.pending_handoffs[failed_node].add(putmsg.key)
+                self.pending_handoffs[failed_node].add(putmsg.keyref)
         putrsp = PutRsp(putmsg)
         Framework.send_message(putrsp)
 
 # PART rcv_putrsp
+    @handles(PutRsp)
     def rcv_putrsp(self, putrsp):
         seqno = putrsp.msg_id
         if seqno in self.pending_put_rsp:
@@ -205,10 +279,7 @@ class DynamoNode(Node):
                 _logger.info("%s: written %d copies of %s=%s so done", self, DynamoNode.W, putrsp.key, putrsp.value)
                 _logger.debug("  copies at %s", [node.name for node in self.pending_put_rsp[seqno]])
                 # Tidy up tracking data structures
-                original_msg = self.pending_put_msg[seqno]
-                del self.pending_req[PutReq][seqno]
-                del self.pending_put_rsp[seqno]
-                del self.pending_put_msg[seqno]
+                original_msg = self.end_request(PutReq, seqno)
                 # Reply to the original client
                 client_putrsp = ClientPutRsp(original_msg, putrsp.metadata)
                 Framework.send_message(client_putrsp)
@@ -216,13 +287,15 @@ class DynamoNode(Node):
             pass  # Superfluous reply
 
 # PART rcv_get
+    @handles(GetReq)
     def rcv_get(self, getmsg):
         _logger.info("%s: retrieve %s=?", self, getmsg.key)
-        (value, metadata) = self.retrieve(getmsg.key)
+        (value, metadata) = self.retrieve(getmsg.keyref)
         getrsp = GetRsp(getmsg, value, metadata)
         Framework.send_message(getrsp)
 
 # PART rcv_getrsp
+    @handles(GetRsp)
     def rcv_getrsp(self, getrsp):
         seqno = getrsp.msg_id
         if seqno in self.pending_get_rsp:
@@ -233,10 +306,7 @@ class DynamoNode(Node):
                 # Coalesce all compatible (value, metadata) pairs across the responses
                 results = VectorClock.coalesce2([(value, metadata) for (node, value, metadata) in self.pending_get_rsp[seqno]])
                 # Tidy up tracking data structures
-                original_msg = self.pending_get_msg[seqno]
-                del self.pending_req[GetReq][seqno]
-                del self.pending_get_rsp[seqno]
-                del self.pending_get_msg[seqno]
+                original_msg = self.end_request(GetReq, seqno)
                 # Reply to the original client, including all received values
                 client_getrsp = ClientGetRsp(original_msg,
                                              [value for (value, metadata) in results],
@@ -245,27 +315,6 @@ class DynamoNode(Node):
         else:
             pass  # Superfluous reply
 
-# PART rcvmsg
-    def rcvmsg(self, msg):
-        if isinstance(msg, ClientPut):
-            self.rcv_clientput(msg)
-        elif isinstance(msg, PutReq):
-            self.rcv_put(msg)
-        elif isinstance(msg, PutRsp):
-            self.rcv_putrsp(msg)
-        elif isinstance(msg, ClientGet):
-            self.rcv_clientget(msg)
-        elif isinstance(msg, GetReq):
-            self.rcv_get(msg)
-        elif isinstance(msg, GetRsp):
-            self.rcv_getrsp(msg)
-        elif isinstance(msg, PingReq):
-            self.rcv_pingreq(msg)
-        elif isinstance(msg, PingRsp):
-            self.rcv_pingrsp(msg)
-        else:
-            raise TypeError("Unexpected message type %s", msg.__class__)
-
 # PART get_contents
     def get_contents(self):
         results = []
@@ -284,7 +333,9 @@ class DynamoClientNode(Node):
 
     def put(self, key, metadata, value, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
+        if not isinstance(key, KeyRef):  # Hash the key once, for every node the request visits
+            key = KeyRef(key, DynamoNode.HASH)
         # Input metadata is always a sequence, but we always need to insert a
         # single VectorClock object into the ClientPut message
         if len(metadata) == 1 and metadata[0] is None:
@@ -298,7 +349,9 @@ class DynamoClientNode(Node):
 
     def get(self, key, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
+        if not isinstance(key, KeyRef):
+            key = KeyRef(key, DynamoNode.HASH)
         getmsg = ClientGet(self, destnode, key)
         Framework.send_message(getmsg)
         return getmsg
@@ -306,10 +359,10 @@ class DynamoClientNode(Node):
     def rsp_timer_pop(self, reqmsg):
         if isinstance(reqmsg, ClientPut):  # retry
             _logger.info("Put request timed out; retrying")
-            self.put(reqmsg.key, [reqmsg.metadata], reqmsg.value)
+            self.put(reqmsg.keyref, [reqmsg.metadata], reqmsg.value)
         elif isinstance(reqmsg, ClientGet):  # retry
             _logger.info("Get request timed out; retrying")
-            self.get(reqmsg.key)
+            self.get(reqmsg.keyref)
 
 # PART clientrcvmsg
     def rcvmsg(self, msg):
@@ -2,11 +2,11 @@
 
 Second iteration, adding detection of missing responses and expansion of the preference list."""
 import copy
-import random
 import logging
 
 import logconfig
-from node import Node
+import simulation
+from node import Node, handles
 from framework import Framework
 from hash_multiple import ConsistentHashTable
 from dynamomessages import ClientPut, ClientGet, ClientPutRsp, ClientGetRsp
@@ -24,6 +24,7 @@ class DynamoNode(Node):
     N = 3  # Number of nodes to replicate at
     W = 2  # Number of nodes that need to reply to a write operation
     R = 2  # Number of nodes that need to reply to a read operation
+    __context__ = ('nodelist', 'chash')  # held separately for each Simulation
     nodelist = []
     chash = ConsistentHashTable(nodelist, T)
 
@@ -37,9 +38,9 @@ class DynamoNode(Node):
         # seqno => set of requests sent to other nodes, for each message class
         self.pending_req = {PutReq: {}, GetReq: {}}
         self.failed_nodes = []
-        # Rebuild the consistent hash table
+        # Add this node to the consistent hash table
         DynamoNode.nodelist.append(self)
-        DynamoNode.chash = ConsistentHashTable(DynamoNode.nodelist, DynamoNode.T)
+        DynamoNode.chash.add_node(self)
 
 # PART reset
     @classmethod
@@ -85,6 +86,7 @@ class DynamoNode(Node):
                     Framework.send_message(newreqmsg)
 
 # PART rcv_clientput
+    @handles(ClientPut)
     def rcv_clientput(self, msg):
         preference_list = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)[0]
         # Determine if we are in the list
@@ -115,6 +117,7 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_clientget
+    @handles(ClientGet)
     def rcv_clientget(self, msg):
         preference_list = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)[0]
         # Determine if we are in the list
@@ -139,6 +142,7 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_put
+    @handles(PutReq)
     def rcv_put(self, putmsg):
         _logger.info("%s: store %s=%s", self, putmsg.key, putmsg.value)
         self.store(putmsg.key, putmsg.value, putmsg.metadata)
@@ -146,6 +150,7 @@ class DynamoNode(Node):
         Framework.send_message(putrsp)
 
 # PART rcv_putrsp
+    @handles(PutRsp)
     def rcv_putrsp(self, putrsp):
         seqno = putrsp.msg_id
         if seqno in self.pending_put_rsp:
@@ -165,6 +170,7 @@ class DynamoNode(Node):
             pass  # Superfluous reply
 
 # PART rcv_get
+    @handles(GetReq)
     def rcv_get(self, getmsg):
         _logger.info("%s: retrieve %s=?", self, getmsg.key)
         (value, metadata) = self.retrieve(getmsg.key)
@@ -172,6 +178,7 @@ class DynamoNode(Node):
         Framework.send_message(getrsp)
 
 # PART rcv_getrsp
+    @handles(GetRsp)
     def rcv_getrsp(self, getrsp):
         seqno = getrsp.msg_id
         if seqno in self.pending_get_rsp:
@@ -194,23 +201,6 @@ class DynamoNode(Node):
         else:
             pass  # Superfluous reply
 
-# PART rcvmsg
-    def rcvmsg(self, msg):
-        if isinstance(msg, ClientPut):
-            self.rcv_clientput(msg)
-        elif isinstance(msg, PutReq):
-            self.rcv_put(msg)
-        elif isinstance(msg, PutRsp):
-            self.rcv_putrsp(msg)
-        elif isinstance(msg, ClientGet):
-            self.rcv_clientget(msg)
-        elif isinstance(msg, GetReq):
-            self.rcv_get(msg)
-        elif isinstance(msg, GetRsp):
-            self.rcv_getrsp(msg)
-        else:
-            raise TypeError("Unexpected message type %s", msg.__class__)
-
 # PART get_contents
     def get_contents(self):
         results = []
@@ -225,13 +215,13 @@ class DynamoClientNode(Node):
 
     def put(self, key, metadata, value, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
         putmsg = ClientPut(self, destnode, key, value, metadata)
         Framework.send_message(putmsg)
 
     def get(self, key, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
         getmsg = ClientGet(self, destnode, key)
         Framework.send_message(getmsg)
 
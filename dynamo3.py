@@ -2,11 +2,11 @@
 
 Third iteration: add pings to detect recovered nodes, use Merkle tree to store data"""
 import copy
-import random
 import logging
 
 import logconfig
-from node import Node
+import simulation
+from node import Node, handles
 from timer import TimerManager
 from framework import Framework
 from hash_multiple import ConsistentHashTable
@@ -27,6 +27,7 @@ class DynamoNode(Node):
     N = 3  # Number of nodes to replicate at
     W = 2  # Number of nodes that need to reply to a write operation
     R = 2  # Number of nodes that need to reply to a read operation
+    __context__ = ('nodelist', 'chash')  # held separately for each Simulation
     nodelist = []
     chash = ConsistentHashTable(nodelist, T)
 
@@ -41,9 +42,9 @@ class DynamoNode(Node):
         self.pending_req = {PutReq: {}, GetReq: {}}
         self.failed_nodes = []
         self.pending_handoffs = {}
-        # Rebuild the consistent hash table
+        # Add this node to the consistent hash table
         DynamoNode.nodelist.append(self)
-        DynamoNode.chash = ConsistentHashTable(DynamoNode.nodelist, DynamoNode.T)
+        DynamoNode.chash.add_node(self)
         # Run a timer to retry failed nodes
         self.retry_failed_node("retry")
 
@@ -73,11 +74,13 @@ class DynamoNode(Node):
         # Restart the timer
         TimerManager.start_timer(self, reason="retry", priority=15, callback=self.retry_failed_node)
 
+    @handles(PingReq)
     def rcv_pingreq(self, pingmsg):
         # Always reply to a test message
         pingrsp = PingRsp(pingmsg)
         Framework.send_message(pingrsp)
 
+    @handles(PingRsp)
     def rcv_pingrsp(self, pingmsg):
         # Remove all instances of recovered node from failed node list
         recovered_node = pingmsg.from_node
@@ -112,6 +115,7 @@ class DynamoNode(Node):
                     Framework.send_message(newreqmsg)
 
 # PART rcv_clientput
+    @handles(ClientPut)
     def rcv_clientput(self, msg):
         preference_list = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)[0]
         # Determine if we are in the list
@@ -142,6 +146,7 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_clientget
+    @handles(ClientGet)
     def rcv_clientget(self, msg):
         preference_list = DynamoNode.chash.find_nodes(msg.key, DynamoNode.N, self.failed_nodes)[0]
         # Determine if we are in the list
@@ -166,6 +171,7 @@ class DynamoNode(Node):
                     break
 
 # PART rcv_put
+    @handles(PutReq)
     def rcv_put(self, putmsg):
         _logger.info("%s: store %s=%s", self, putmsg.key, putmsg.value)
         self.store(putmsg.key, putmsg.value, putmsg.metadata)
@@ -173,6 +179,7 @@ class DynamoNode(Node):
         Framework.send_message(putrsp)
 
 # PART rcv_putrsp
+    @handles(PutRsp)
     def rcv_putrsp(self, putrsp):
         seqno = putrsp.msg_id
         if seqno in self.pending_put_rsp:
@@ -192,6 +199,7 @@ class DynamoNode(Node):
             pass  # Superfluous reply
 
 # PART rcv_get
+    @handles(GetReq)
     def rcv_get(self, getmsg):
         _logger.info("%s: retrieve %s=?", self, getmsg.key)
         (value, metadata) = self.retrieve(getmsg.key)
@@ -199,6 +207,7 @@ class DynamoNode(Node):
         Framework.send_message(getrsp)
 
 # PART rcv_getrsp
+    @handles(GetRsp)
     def rcv_getrsp(self, getrsp):
         seqno = getrsp.msg_id
         if seqno in self.pending_get_rsp:
@@ -221,27 +230,6 @@ class DynamoNode(Node):
         else:
             pass  # Superfluous reply
 
-# PART rcvmsg
-    def rcvmsg(self, msg):
-        if isinstance(msg, ClientPut):
-            self.rcv_clientput(msg)
-        elif isinstance(msg, PutReq):
-            self.rcv_put(msg)
-        elif isinstance(msg, PutRsp):
-            self.rcv_putrsp(msg)
-        elif isinstance(msg, ClientGet):
-            self.rcv_clientget(msg)
-        elif isinstance(msg, GetReq):
-            self.rcv_get(msg)
-        elif isinstance(msg, GetRsp):
-            self.rcv_getrsp(msg)
-        elif isinstance(msg, PingReq):
-            self.rcv_pingreq(msg)
-        elif isinstance(msg, PingRsp):
-            self.rcv_pingrsp(msg)
-        else:
-            raise TypeError("Unexpected message type %s", msg.__class__)
-
 # PART get_contents
     def get_contents(self):
         results = []
@@ -256,13 +244,13 @@ class DynamoClientNode(Node):
 
     def put(self, key, metadata, value, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
         putmsg = ClientPut(self, destnode, key, value, metadata)
         Framework.send_message(putmsg)
 
     def get(self, key, destnode=None):
         if destnode is None:  # Pick a random node to send the request to
-            destnode = random.choice(DynamoNode.nodelist)
+            destnode = simulation.rng().choice(DynamoNode.nodelist)
         getmsg = ClientGet(self, destnode, key)
         Framework.send_message(getmsg)
 
@@ -1,5 +1,6 @@
 """Messages between Dynamo nodes"""
 from message import Message, ResponseMessage
+from hashfunc import unwrap
 
 _show_metadata = False
 
@@ -15,10 +16,12 @@ def _show_value(value, metadata):
 
 
 class DynamoRequestMessage(Message):
-    """Base class for Dynamo request messages; all include the key for the data object in question"""
+    """Base class for Dynamo request messages; all include the key for the data object in question.
+    The key can be given as a KeyRef, to carry its hash along with the request."""
     def __init__(self, from_node, to_node, key, msg_id=None):
         super(DynamoRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
-        self.key = key
+        self.key = unwrap(key)
+        self.keyref = key  # the key, or a KeyRef for it
 
     def __str__(self):
         return "%s(%s=?)" % (self.__class__.__name__, self.key)
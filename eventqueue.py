@@ -0,0 +1,83 @@
+"""Discrete-event queue, ordered by virtual time"""
+import heapq
+
+from simulation import ContextMeta
+
+
+class EventQueue(object):
+    """Heap of pending events (message deliveries and timer expiries), keyed by virtual timestamp.
+
+    Virtual time is measured in simulated milliseconds.  When the queue is not enabled, the
+    framework runs in zero-latency mode, with messages delivered in FIFO order and timers
+    only popping when there are no messages in flight."""
+    __metaclass__ = ContextMeta
+    __context__ = ('enabled', 'now', 'events', 'origins', 'local_nodes', 'outbox')
+    enabled = False  # Whether virtual time is in use
+    now = 0  # Current virtual time
+    events = []  # heap of (time, rank, origin name, origin seqno, event) tuples
+    # Count of the events originated by each node (or '' for events with no originating node).
+    # Simultaneous events of the same rank are ordered by originating node then by this count,
+    # which (unlike a global insertion counter) does not depend on what other nodes are doing;
+    # this keeps the order the same when the nodes are spread across several processes.
+    origins = {}  # node name => number of events originated
+    # When this process only simulates some of the nodes (see parallel.py), events for the
+    # other nodes are collected in outbox rather than queued.
+    local_nodes = None  # node => whether it is simulated in this process
+    outbox = []  # list of (key, event) for nodes in other processes
+
+    @classmethod
+    def reset(cls):
+        cls.enabled = False
+        cls.now = 0
+        cls.events = []
+        cls.origins = {}
+        cls.local_nodes = None
+        cls.outbox = []
+
+    @classmethod
+    def pending_count(cls):
+        return len(cls.events)
+
+    @classmethod
+    def push(cls, delay, event, rank=(0,), source=None, dest=None):
+        """Schedule an event to happen delay ms from now, originated by the source node and
+        destined for the dest node.  Simultaneous events happen in order of rank, then of
+        originating node.  Returns the event's (time, rank, origin name, origin seqno) key."""
+        name = '' if source is None else source.name
+        seqno = cls.origins.get(name, 0) + 1
+        cls.origins[name] = seqno
+        key = (cls.now + delay, rank, name, seqno)
+        if dest is not None and cls.local_nodes is not None and not cls.local_nodes[dest]:
+            cls.outbox.append((key, event))
+        else:
+            heapq.heappush(cls.events, key + (event,))
+        return key
+
+    @classmethod
+    def insert(cls, key, event):
+        """Queue an event that was originated in another process, under its original key"""
+        heapq.heappush(cls.events, key + (event,))
+
+    @classmethod
+    def is_local(cls, node):
+        """Indicate whether the given node is simulated in this process"""
+        return cls.local_nodes is None or cls.local_nodes[node]
+
+    @classmethod
+    def peek(cls):
+        """Return (time, event) for the next event, without removing it"""
+        entry = cls.events[0]
+        return (entry[0], entry[-1])
+
+    @classmethod
+    def pop(cls):
+        """Remove and return the next event, advancing virtual time to match"""
+        entry = heapq.heappop(cls.events)
+        cls.now = entry[0]
+        return entry[-1]
+
+    @classmethod
+    def advance(cls, when):
+        """Move virtual time forward to the given point, if it is in the future"""
+        if when > cls.now:
+            cls.now = when
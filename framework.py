@@ -1,46 +1,148 @@
 """Framework code for simulating networks"""
+import os
+import sys
 import copy
 import logging
+import cPickle
+import traceback
+import multiprocessing
 from collections import deque
 
 from node import Node
 from history import History
-from timer import TimerManager
-from message import ResponseMessage
+from timer import TimerManager, WheelTick
+from eventqueue import EventQueue
+from message import ResponseMessage, Timer
+from simulation import ContextMeta
 import logconfig
 
 logconfig.init_logging()
 _logger = logging.getLogger('dynamo')
 
+# Whether each message class is a ResponseMessage, filled in on first use
+_is_response = {}  # message class => bool
+
 
 class Framework(object):
+    __metaclass__ = ContextMeta
+    __context__ = ('cuts', 'blocked', 'indexed_cuts', 'queue', 'pending_timers', 'timers_to', 'timers_from',
+                   'timer_seqno', 'latency', 'link_latency', 'response_times')
     cuts = []  # List of incommunicado sets of nodes
+    # Index of the cuts, so reachability checks are a constant-time lookup
+    blocked = {}  # from_node => {to_node => number of cuts blocking this route}
+    indexed_cuts = cuts  # cuts list that blocked corresponds to
     queue = deque([])  # queue of pending messages
     pending_timers = {}  # request_message => timer
+    # Pending request timers indexed by node; the sequence numbers give the order of sending.
+    # The per-node dicts are kept once created, even when empty.
+    timers_to = {}  # to_node => {request_message => seqno}
+    timers_from = {}  # from_node => {request_message => seqno}
+    timer_seqno = 0
+    # Message delays when running in virtual time (see set_latency())
+    latency = 0  # default one-way delay, in simulated milliseconds
+    link_latency = {}  # (from_node, to_node) => one-way delay
+    response_times = {}  # request message class => list of request->response times
 
     @classmethod
     def reset(cls):
         cls.cuts = []
+        cls.blocked = {}
+        cls.indexed_cuts = cls.cuts
         cls.queue = deque([])
         cls.pending_timers = {}
+        cls.timers_to = {}
+        cls.timers_from = {}
+        cls.timer_seqno = 0
+        cls.latency = 0
+        cls.link_latency = {}
+        cls.response_times = {}
+
+    @classmethod
+    def set_latency(cls, latency, from_node=None, to_node=None):
+        """Run the framework in virtual time, with messages taking the given time (in simulated
+        milliseconds) to arrive.  The delay applies to all links, unless from_node and to_node are
+        both given, in which case it just applies to that (one-way) link."""
+        if (from_node is None) != (to_node is None):
+            raise ValueError("Link latency needs both from_node and to_node")
+        if not EventQueue.enabled:
+            EventQueue.enabled = True
+            # Anything already queued up is delivered straight away
+            while cls.queue:
+                msg = cls.queue.popleft()
+                EventQueue.push(0, msg, source=msg.from_node, dest=msg.to_node)
+            # and timers that are already running start counting down
+            TimerManager.start_virtual_time()
+        if from_node is None:
+            cls.latency = latency
+        else:
+            cls.link_latency[(from_node, to_node)] = latency
+
+    @classmethod
+    def _enqueue(cls, msg, from_node):
+        if EventQueue.enabled:
+            key = EventQueue.push(cls.link_latency.get((from_node, msg.to_node), cls.latency), msg,
+                                  source=from_node, dest=msg.to_node)
+            # Identifies the message across processes in a parallel simulation
+            msg.origin = key[2:]
+        else:
+            cls.queue.append(msg)
 
     @classmethod
     def cut_wires(cls, from_nodes, to_nodes):
         History.add("announce", "Cut %s -> %s" % ([str(x) for x in from_nodes], [str(x) for x in to_nodes]))
+        cls._check_index()
         cls.cuts.append((from_nodes, to_nodes))
+        cls._index_cut(from_nodes, to_nodes, 1)
+
+    @classmethod
+    def heal_wires(cls, from_nodes, to_nodes):
+        """Repair a cut previously made with cut_wires(); any other cuts remain in place"""
+        History.add("announce", "Heal %s -> %s" % ([str(x) for x in from_nodes], [str(x) for x in to_nodes]))
+        cls._check_index()
+        cls.cuts.remove((from_nodes, to_nodes))
+        cls._index_cut(from_nodes, to_nodes, -1)
+
+    @classmethod
+    def heal(cls):
+        """Repair all cuts"""
+        cls.cuts = []
+        cls.blocked = {}
+        cls.indexed_cuts = cls.cuts
+
+    @classmethod
+    def _index_cut(cls, from_nodes, to_nodes, delta):
+        for from_node in from_nodes:
+            blocked = cls.blocked.setdefault(from_node, {})
+            for to_node in to_nodes:
+                count = blocked.get(to_node, 0) + delta
+                if count > 0:
+                    blocked[to_node] = count
+                else:
+                    del blocked[to_node]
+            if not blocked:
+                del cls.blocked[from_node]
+
+    @classmethod
+    def _check_index(cls):
+        """Rebuild the index if the list of cuts has been replaced wholesale"""
+        if cls.cuts is not cls.indexed_cuts:
+            cls.blocked = {}
+            cls.indexed_cuts = cls.cuts
+            for (from_nodes, to_nodes) in cls.cuts:
+                cls._index_cut(from_nodes, to_nodes, 1)
 
     @classmethod
     def reachable(cls, from_node, to_node):
-        for (from_nodes, to_nodes) in cls.cuts:
-            if from_node in from_nodes and to_node in to_nodes:
-                return False
-        return True
+        cls._check_index()
+        blocked = cls.blocked.get(from_node)
+        return blocked is None or to_node not in blocked
 
     @classmethod
     def send_message(cls, msg, expect_reply=True):
         """Send a message"""
         _logger.info("Enqueue %s->%s: %s", msg.from_node, msg.to_node, msg)
-        cls.queue.append(msg)
+        msg.sent_at = EventQueue.now
+        cls._enqueue(msg, msg.from_node)
         History.add("send", msg)
         # Automatically run timers for request messages if the sender can cope
         # with retry timer pops
@@ -48,31 +150,58 @@ class Framework(object):
             not isinstance(msg, ResponseMessage) and
             'rsp_timer_pop' in msg.from_node.__class__.__dict__ and
             callable(msg.from_node.__class__.__dict__['rsp_timer_pop'])):
-            cls.pending_timers[msg] = TimerManager.start_timer(msg.from_node, reason=msg, callback=Framework.rsp_timer_pop)
+            tmsg = TimerManager.start_timer(msg.from_node, reason=msg, callback=Framework.rsp_timer_pop)
+            cls.pending_timers[msg] = tmsg
+            seqno = cls.timer_seqno = cls.timer_seqno + 1
+            for (index, node) in ((cls.timers_to, msg.to_node), (cls.timers_from, msg.from_node)):
+                node_timers = index.get(node)
+                if node_timers is None:
+                    node_timers = index[node] = {}
+                node_timers[msg] = seqno
+
+    @classmethod
+    def _forget_req_timer(cls, reqmsg):
+        """Remove the record of a pending request timer, returning the timer"""
+        del cls.timers_to[reqmsg.to_node][reqmsg]
+        del cls.timers_from[reqmsg.from_node][reqmsg]
+        return cls.pending_timers.pop(reqmsg)
 
     @classmethod
     def remove_req_timer(cls, reqmsg):
         if reqmsg in cls.pending_timers:
             # Cancel request timer as we've seen a response
-            TimerManager.cancel_timer(cls.pending_timers[reqmsg])
-            del cls.pending_timers[reqmsg]
+            TimerManager.cancel_timer(cls._forget_req_timer(reqmsg))
 
     @classmethod
-    def cancel_timers_to(cls, destnode):
-        """Cancel all pending-request timers destined for the given node.
+    def cancel_timers_to(cls, destnode, srcnode=None):
+        """Cancel all pending-request timers destined for the given node (and, if srcnode is
+        given, sent by that node).
         Returns a list of the request messages whose timers have been cancelled."""
-        failed_requests = []
-        for reqmsg in cls.pending_timers.keys():
-            if reqmsg.to_node == destnode:
-                TimerManager.cancel_timer(cls.pending_timers[reqmsg])
-                del cls.pending_timers[reqmsg]
-                failed_requests.append(reqmsg)
-        return failed_requests
+        if srcnode is not None:
+            return cls._cancel_timers(dict((reqmsg, seqno)
+                                           for (reqmsg, seqno) in cls.timers_from.get(srcnode, {}).iteritems()
+                                           if reqmsg.to_node is destnode))
+        return cls._cancel_timers(cls.timers_to.get(destnode, {}))
+
+    @classmethod
+    def cancel_timers_from(cls, srcnode):
+        """Cancel all pending-request timers for requests sent by the given node.
+        Returns a list of the request messages whose timers have been cancelled."""
+        return cls._cancel_timers(cls.timers_from.get(srcnode, {}))
+
+    @classmethod
+    def _cancel_timers(cls, node_timers):
+        """Cancel the timers for the requests in the given {request_message => seqno} dict, in
+        order of sending"""
+        reqmsgs = sorted(node_timers, key=node_timers.get)
+        for reqmsg in reqmsgs:
+            TimerManager.cancel_timer(cls._forget_req_timer(reqmsg))
+        return reqmsgs
 
     @classmethod
     def rsp_timer_pop(cls, reqmsg):
         # Remove the record of the pending timer
-        del cls.pending_timers[reqmsg]
+        cls._forget_req_timer(reqmsg)
         # Call through to the node's rsp_timer_pop() method
         _logger.debug("Call on to rsp_timer_pop() for node %s" % reqmsg.from_node)
         reqmsg.from_node.rsp_timer_pop(reqmsg)
@@ -85,16 +214,21 @@ class Framework(object):
         fwd_msg.intermediate_node = fwd_msg.to_node
         fwd_msg.original_msg = msg
         fwd_msg.to_node = new_to_node
-        cls.queue.append(fwd_msg)
+        cls._enqueue(fwd_msg, fwd_msg.intermediate_node)
         History.add("forward", fwd_msg)
 
     @classmethod
-    def schedule(cls, msgs_to_process=None, timers_to_process=None):
-        """Schedule given number of pending messages"""
+    def schedule(cls, msgs_to_process=None, timers_to_process=None, until=None, before=None):
+        """Schedule given number of pending messages.  When running in virtual time,
+        processing also stops at the first event after the (optional) until time, or at
+        the first event at or after the (optional) before time."""
         if msgs_to_process is None:
             msgs_to_process = 32768
         if timers_to_process is None:
             timers_to_process = 32768
+        if EventQueue.enabled:
+            cls._schedule_events(msgs_to_process, timers_to_process, until, before)
+            return
 
         while cls._work_to_do():
             _logger.info("Start of schedule: %d (limit %d) pending messages, %d (limit %d) pending timers",
@@ -102,24 +236,7 @@ class Framework(object):
             # Process all the queued up messages (which may enqueue more along the way)
             while cls.queue:
                 msg = cls.queue.popleft()
-                if msg.to_node.failed:
-                    _logger.info("Drop %s->%s: %s as destination down", msg.from_node, msg.to_node, msg)
-                    History.add("drop", msg)
-                elif not Framework.reachable(msg.from_node, msg.to_node):
-                    _logger.info("Drop %s->%s: %s as route down", msg.from_node, msg.to_node, msg)
-                    History.add("cut", msg)
-                else:
-                    _logger.info("Dequeue %s->%s: %s", msg.from_node, msg.to_node, msg)
-                    if isinstance(msg, ResponseMessage):
-                        # figure out the original request this is a response to
-                        try:
-                            reqmsg = msg.response_to.original_msg
-                        except Exception:
-                            reqmsg = msg.response_to
-                        # cancel any timer associated with the original request
-                        cls.remove_req_timer(reqmsg)
-                    History.add("deliver", msg)
-                    msg.to_node.rcvmsg(msg)
+                cls._deliver(msg)
                 msgs_to_process = msgs_to_process - 1
                 if msgs_to_process == 0:
                     return
@@ -132,6 +249,123 @@ class Framework(object):
             if timers_to_process == 0:
                 return
 
+    @classmethod
+    def _schedule_events(cls, msgs_to_process, timers_to_process, until, before=None):
+        """Process events in virtual time order, jumping straight from one to the next"""
+        _logger.info("Start of schedule at %s: %d (limit %d) pending events, %d (limit %d) pending timers",
+                     EventQueue.now, EventQueue.pending_count(), msgs_to_process,
+                     TimerManager.pending_count(), timers_to_process)
+        while EventQueue.events:
+            (when, event) = EventQueue.peek()
+            if (until is not None and when > until) or (before is not None and when >= before):
+                break
+            if isinstance(event, (Timer, WheelTick)):
+                if not TimerManager.is_running(event):
+                    EventQueue.pop()  # cancelled
+                    continue
+                if timers_to_process <= 0:
+                    return
+                EventQueue.pop()
+                timers_to_process = timers_to_process - TimerManager.expire(event)
+            else:
+                if msgs_to_process == 0:
+                    return
+                EventQueue.pop()
+                cls._deliver(event)
+                msgs_to_process = msgs_to_process - 1
+        if until is not None:
+            EventQueue.advance(until)
+
+    @classmethod
+    def _deliver(cls, msg):
+        """Deliver a message to its destination, unless the node or the route is down"""
+        if msg.to_node.failed:
+            _logger.info("Drop %s->%s: %s as destination down", msg.from_node, msg.to_node, msg)
+            History.add("drop", msg)
+        elif not Framework.reachable(msg.from_node, msg.to_node):
+            _logger.info("Drop %s->%s: %s as route down", msg.from_node, msg.to_node, msg)
+            History.add("cut", msg)
+        else:
+            _logger.info("Dequeue %s->%s: %s", msg.from_node, msg.to_node, msg)
+            is_response = _is_response.get(msg.__class__)
+            if is_response is None:
+                is_response = _is_response[msg.__class__] = issubclass(msg.__class__, ResponseMessage)
+            if is_response:
+                # figure out the original request this is a response to
+                try:
+                    reqmsg = msg.response_to.original_msg
+                except Exception:
+                    reqmsg = msg.response_to
+                # cancel any timer associated with the original request
+                cls.remove_req_timer(reqmsg)
+                if EventQueue.enabled:
+                    cls.response_times.setdefault(reqmsg.__class__, []).append(EventQueue.now - reqmsg.sent_at)
+            History.add("deliver", msg)
+            msg.to_node.rcvmsg(msg)
+
+    @classmethod
+    def branch(cls, continuations, processes=None):
+        """Explore alternative continuations of the current simulation.  Each continuation is a
+        callable that is run (with no arguments) in its own forked child process, starting from a
+        copy-on-write copy of the current state; at most processes children (default: one per CPU)
+        run at once.  Returns the list of the continuations' return values, which must be picklable
+        (summary() gives a standard one).  The state of this process is unaffected."""
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        results = [None] * len(continuations)
+        running = []  # list of (index, pid, read fd)
+        next_index = 0
+        while next_index < len(continuations) or running:
+            while next_index < len(continuations) and len(running) < processes:
+                running.append(cls._fork(next_index, continuations[next_index]))
+                next_index = next_index + 1
+            (index, pid, rfd) = running.pop(0)
+            with os.fdopen(rfd, 'rb') as pipe:
+                data = pipe.read()
+            os.waitpid(pid, 0)
+            if not data:
+                raise RuntimeError("Branch %d exited without a result" % index)
+            (ok, result) = cPickle.loads(data)
+            if not ok:
+                raise RuntimeError("Branch %d failed:\n%s" % (index, result))
+            results[index] = result
+        return results
+
+    @classmethod
+    def _fork(cls, index, continuation):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(wfd)
+            return (index, pid, rfd)
+        # Child process
+        os.close(rfd)
+        try:
+            try:
+                data = cPickle.dumps((True, continuation()), 2)
+            except Exception:
+                data = cPickle.dumps((False, traceback.format_exc()), 2)
+            with os.fdopen(wfd, 'wb') as pipe:
+                pipe.write(data)
+            sys.stdout.flush()
+        finally:
+            os._exit(0)
+
+    @classmethod
+    def summary(cls):
+        """Return a picklable summary of the current simulation"""
+        actions = {}
+        for (action, _) in History.history:
+            actions[action] = actions.get(action, 0) + 1
+        return {'time': EventQueue.now,
+                'history': actions,
+                'pending_messages': len(cls.queue) + EventQueue.pending_count(),
+                'pending_timers': TimerManager.pending_count(),
+                'failed': sorted(node.name for node in Node.node.values() if node.failed),
+                'contents': dict((node.name, sorted(node.get_contents())) for node in Node.node.values())}
+
     @classmethod
     def _work_to_do(cls):
         """Indicate whether there is work to do"""
@@ -143,13 +377,14 @@ class Framework(object):
 
 
 def reset():
-    """Reset all message and other history"""
+    """Reset all message and other history in the current Simulation"""
     Framework.reset()
     TimerManager.reset()
+    EventQueue.reset()
     History.reset()
 
 
 def reset_all():
-    """Reset all message and other history, and remove all nodes"""
+    """Reset all message and other history, and remove all nodes, in the current Simulation"""
     reset()
     Node.reset()
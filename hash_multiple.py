@@ -1,54 +1,324 @@
 #!/usr/bin/env python
 """Consistent hash code"""
-import hashlib
+import math
 import binascii
 import bisect
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # find_nodes_many() falls back to pure Python
+
+import hashfunc
+
+
+# PART boundedloads
+class BoundedLoads(object):
+    """Load tracking for consistent hashing with bounded loads: when load_epsilon is set, work
+    only goes to a node whose load is below (1 + load_epsilon) times the average load.
+    Subclasses provide node_count, the number of distinct nodes.
+
+    Loads are reported by the users of the hash table, so only cover the nodes that share
+    this copy of the table; in a ParallelSimulation (see parallel.py) each process has its
+    own copy, so bounded-load choices there depend on how the nodes are partitioned."""
+    load_epsilon = None  # Slack for bounded-load mode, or None if disabled
+
+    def add_load(self, node, amount=1):
+        """Record a change in the current load of a node (e.g. its number of requests in progress)"""
+        self.loads[node] = self.loads.get(node, 0) + amount
+        self.total_load = self.total_load + amount
 
+    def load_bound(self):
+        """Return the load below which a node can take on more work: (1 + load_epsilon) times
+        the average load including the new work, rounded up"""
+        return math.ceil((1 + self.load_epsilon) * (self.total_load + 1) / float(max(1, self.node_count)))
 
-class ConsistentHashTable(object):
-    def __init__(self, nodelist, repeat):
-        """Initialize a consistent hash table for the given list of nodes"""
+    def under_bound(self, node):
+        """Indicate whether the given node can take on more work"""
+        return self.load_epsilon is None or self.loads.get(node, 0) < self.load_bound()
+
+    def coordinator(self, nodes):
+        """Return the node from the given preference list that should coordinate a request:
+        the first node, or in bounded-load mode the first node that is under the load bound
+        (or the least loaded node, if none are)"""
+        if self.load_epsilon is None:
+            return nodes[0]
+        bound = self.load_bound()
+        for node in nodes:
+            if self.loads.get(node, 0) < bound:
+                return node
+        return min(nodes, key=lambda node: self.loads.get(node, 0))
+
+
+# PART coreclass
+class ConsistentHashTable(BoundedLoads):
+    cache_size = 65536  # Maximum number of cached preference lists
+    balance_sample = 100000  # Number of keys used by balance() by default
+
+    def __init__(self, nodelist, repeat, hashfn=None, weights=None):
+        """Initialize a consistent hash table for the given list of nodes, using the
+        given hash function (see hashfunc.py).  Each node appears repeat times round the
+        ring, scaled by its weight from the (optional) weights dict (default 1)."""
+        self.repeat = repeat
+        self.node_count = len(set(nodelist))
+        self.loads = {}  # node => current load, for bounded-load mode
+        self.total_load = 0
+        self.hashfn = hashfunc.get(hashfn)
+        self.weights = dict(weights or {})  # node => weight, for nodes without weight 1
+        # Membership epoch, incremented whenever nodes are added or removed
+        self.epoch = 0
+        # Cache of find_nodes() results, cleared when the epoch changes
+        self.cache = {}  # (ring index, count, failure view) => (results, avoided)
+        self.hits = 0
+        self.misses = 0
+        # For each index into nodelist, the next successor_depth distinct nodes round the
+        # ring from there; built on first use, and discarded when the epoch changes
+        self.successors = None
+        self.successor_depth = 0
+        # Tables for find_nodes_many(), also discarded when the epoch changes
+        self.bulk_tables = {}  # count => (nodes, ring tokens, successor index matrix)
         # Insert each node into the hash circle multiple times
         baselist = []
         for node in nodelist:
-            for ii in xrange(repeat):
-                nodestring = "%s:%d" % (node, ii)
-                baselist.append((hashlib.md5(nodestring).digest(), node))
+            baselist.extend([(hashvalue, node) for hashvalue in self._node_hashes(node)])
         # Build two lists: one of (hashvalue, node) pairs, sorted by
         # hashvalue, one of just the hashvalues, to allow use of bisect.
         self.nodelist = sorted(baselist, key=lambda x: x[0])
         self.hashlist = [hashnode[0] for hashnode in self.nodelist]
 
-    def find_nodes(self, key, count=1, avoid=None):
+    def _node_hashes(self, node, start=0, stop=None):
+        """Return the hash values for the virtual nodes of the given node; virtual node
+        ii has the same hash value whatever the node's weight"""
+        if stop is None:
+            stop = self._vnode_count(node)
+        return [self.hashfn.digest("%s:%d" % (node, ii)) for ii in xrange(start, stop)]
+
+    def _vnode_count(self, node):
+        """Return the number of virtual nodes for the given node"""
+        return max(1, int(round(self.repeat * self.weights.get(node, 1))))
+
+# PART membership
+    def add_node(self, node, weight=None):
+        """Add a node (with the given weight, default 1) to the hash table, without rebuilding
+        it.  Returns a list of (start, end, old_node, new_node) tuples describing the ranges
+        of hash values [start, end) whose first node has changed; a range with start >= end
+        wraps round the ring, and old_node is None if the table was empty."""
+        if weight is not None:
+            self.weights[node] = weight
+        self.node_count = self.node_count + 1
+        for hashvalue in self._node_hashes(node):
+            index = bisect.bisect(self.hashlist, hashvalue)
+            self.hashlist.insert(index, hashvalue)
+            self.nodelist.insert(index, (hashvalue, node))
+        self._new_epoch()
+        changes = []
+        for (first, last) in self._runs(node):
+            old_node = self.nodelist[(last + 1) % len(self.nodelist)][1]
+            changes.append((self.hashlist[first - 1], self.hashlist[last],
+                            None if old_node == node else old_node, node))
+        return changes
+
+    def remove_node(self, node):
+        """Remove a node from the hash table, without rebuilding it.  Returns a list of changed
+        ranges as for add_node(), where new_node is None if the table is now empty."""
+        changes = []
+        for (first, last) in self._runs(node):
+            new_node = self.nodelist[(last + 1) % len(self.nodelist)][1]
+            changes.append((self.hashlist[first - 1], self.hashlist[last],
+                            node, None if new_node == node else new_node))
+        owned = [ii for (ii, hashnode) in enumerate(self.nodelist) if hashnode[1] == node]
+        for index in reversed(owned):
+            del self.hashlist[index]
+            del self.nodelist[index]
+        self.weights.pop(node, None)
+        self.node_count = self.node_count - 1
+        self._new_epoch()
+        return changes
+
+    def set_weight(self, node, weight):
+        """Change the weight of a node in the hash table, without rebuilding it; the node's
+        existing virtual nodes stay where they are, and virtual nodes are only added or
+        removed at the end of its sequence.  Returns a list of changed ranges as for add_node()."""
+        old_count = self._vnode_count(node)
+        self.weights[node] = weight
+        new_count = self._vnode_count(node)
+        hashvalues = self._node_hashes(node, min(old_count, new_count), max(old_count, new_count))
+        if new_count > old_count:
+            for hashvalue in hashvalues:
+                index = bisect.bisect(self.hashlist, hashvalue)
+                self.hashlist.insert(index, hashvalue)
+                self.nodelist.insert(index, (hashvalue, node))
+        # The changed ranges are those that end at the added or removed virtual nodes
+        changed = set(hashvalues)
+        changes = []
+        for (first, last) in self._runs_of([hashvalue in changed for hashvalue in self.hashlist]):
+            other_node = self.nodelist[(last + 1) % len(self.nodelist)][1]
+            if other_node == node:
+                continue  # range already belonged to this node
+            if new_count > old_count:
+                changes.append((self.hashlist[first - 1], self.hashlist[last], other_node, node))
+            else:
+                changes.append((self.hashlist[first - 1], self.hashlist[last], node, other_node))
+        if new_count < old_count:
+            removed = [ii for (ii, hashvalue) in enumerate(self.hashlist) if hashvalue in changed]
+            for index in reversed(removed):
+                del self.hashlist[index]
+                del self.nodelist[index]
+        self._new_epoch()
+        return changes
+
+    def _new_epoch(self):
+        self.epoch = self.epoch + 1
+        self.cache = {}
+        self.successors = None
+        self.bulk_tables = {}
+
+    def _runs(self, node):
+        """Return (first, last) index pairs for the runs of consecutive entries in the table that
+        belong to the given node; the last run may wrap round to the start of the table"""
+        return self._runs_of([hashnode[1] == node for hashnode in self.nodelist])
+
+    def _runs_of(self, owned):
+        """Return (first, last) index pairs for the runs of consecutive True entries in the
+        given list, which has an entry for each entry in the table"""
+        if False not in owned:
+            return [(0, len(owned) - 1)] if owned else []
+        # Start just after an entry belonging to another node, so no run straddles the start
+        start = owned.index(False)
+        runs = []
+        first = None
+        for offset in xrange(1, len(owned) + 1):
+            index = (start + offset) % len(owned)
+            if owned[index]:
+                if first is None:
+                    first = index
+                last = index
+            elif first is not None:
+                runs.append((first, last))
+                first = None
+        return runs
+
+# PART findnodes
+    def find_nodes(self, key, count=1, avoid=None, view=None):
         """Return a list of count nodes from the hash table that are
-        consecutively after the hash of the given key, together with
+        consecutively after the hash of the given key (or KeyRef), together with
         those nodes from the avoid collection that have been avoided.
 
         Returned list size is <= count, and any nodes in the avoid collection
-        are not included."""
-        if avoid is None:  # Use an empty set
-            avoid = set()
+        are not included.
+
+        Results are cached when avoid is empty, or when view is given: this is
+        a hashable (owner, epoch) value identifying the contents of avoid, so
+        the owner of the avoid collection needs to change the epoch whenever
+        the contents change."""
+        if not avoid:
+            view = None
         # Hash the key to find where it belongs on the ring
-        hv = hashlib.md5(str(key)).digest()
+        hv = self.hashfn.key_digest(key)
         # Find the node after this hash value around the ring, as an index
         # into self.hashlist/self.nodelist
         initial_index = bisect.bisect(self.hashlist, hv)
-        next_index = initial_index
+        if view is None and avoid:
+            return self._lookup(initial_index, count, avoid)
+        cache_key = (initial_index, count, view)
+        try:
+            (results, avoided) = self.cache[cache_key]
+            self.hits = self.hits + 1
+        except KeyError:
+            self.misses = self.misses + 1
+            if len(self.cache) >= self.cache_size:
+                self.cache = {}
+            (results, avoided) = self.cache[cache_key] = self._lookup(initial_index, count, avoid)
+        # Copy the lists, so callers can't alter the cached values
+        return list(results), list(avoided)
+
+    def _lookup(self, initial_index, count, avoid):
+        """Return (results, avoided) as for find_nodes(), starting from initial_index"""
+        if not self.nodelist:
+            return [], []
+        if self.successors is None or count > self.successor_depth:
+            self._build_successors(max(count, self.successor_depth))
+        results = self.successors[initial_index % len(self.nodelist)][:count]
+        if avoid:
+            for node in results:
+                if node in avoid:
+                    # Only walk the ring if an avoided node is in the way
+                    return self._walk(initial_index, count, avoid)
+        return results, []
+
+    def _build_successors(self, depth):
+        self.successor_depth = depth
+        self.successors = [self._walk(index, depth, ())[0] for index in xrange(len(self.nodelist))]
+
+# PART findnodesmany
+    def find_nodes_many(self, keys, count=1):
+        """Find the first count nodes for each of a batch of keys, as for find_nodes() with
+        nothing avoided.  Returns (nodes, matrix), where nodes is a list of the distinct nodes
+        in the table, and row ii of matrix holds the indices into nodes of the nodes for
+        keys[ii], padded with -1 if there are fewer than count nodes.
+
+        If numpy is available, matrix is a numpy array, and keys are placed on the ring by the
+        top 64 bits of their digest; otherwise matrix is a list of lists."""
+        if not self.nodelist:
+            raise ValueError("No nodes in hash table")
+        (nodes, tokens, table) = self._bulk_table(count)
+        digests = [self.hashfn.key_digest(key) for key in keys]
+        if numpy is None:
+            return nodes, [table[bisect.bisect(self.hashlist, digest) % len(table)] for digest in digests]
+        key_tokens = numpy.frombuffer("".join(digests), dtype='>u8')[::self.hashfn.bits // 64]
+        positions = numpy.searchsorted(tokens, key_tokens, side='right') % len(table)
+        return nodes, table[positions]
+
+    def _bulk_table(self, count):
+        if count not in self.bulk_tables:
+            if self.successors is None or count > self.successor_depth:
+                self._build_successors(max(count, self.successor_depth))
+            nodes = []
+            index_of = {}  # node => index into nodes
+            for (_, node) in self.nodelist:
+                if node not in index_of:
+                    index_of[node] = len(nodes)
+                    nodes.append(node)
+            table = [[index_of[node] for node in successors[:count]] + [-1] * (count - len(successors[:count]))
+                     for successors in self.successors]
+            tokens = None
+            if numpy is not None:
+                tokens = numpy.frombuffer("".join(self.hashlist), dtype='>u8')[::self.hashfn.bits // 64]
+                tokens = tokens.astype(numpy.uint64)
+                table = numpy.array(table, dtype=numpy.int32)
+            self.bulk_tables[count] = (nodes, tokens, table)
+        return self.bulk_tables[count]
+
+    def balance(self, keys=None):
+        """Return a list of (node, share, target) tuples giving, for each node, the fraction
+        of the keys (by default, balance_sample generated keys) that it is the first node for,
+        and the fraction that its weight entitles it to"""
+        if keys is None:
+            keys = ['key%d' % ii for ii in xrange(self.balance_sample)]
+        (nodes, matrix) = self.find_nodes_many(keys, 1)
+        if numpy is None:
+            counts = [0] * len(nodes)
+            for row in matrix:
+                counts[row[0]] = counts[row[0]] + 1
+        else:
+            counts = numpy.bincount(matrix[:, 0], minlength=len(nodes))
+        total_weight = float(sum(self.weights.get(node, 1) for node in nodes))
+        return [(node, float(counts[ii]) / len(keys), self.weights.get(node, 1) / total_weight)
+                for ii, node in enumerate(nodes)]
+
+# PART walk
+    def _walk(self, initial_index, count, avoid):
+        """Walk round the ring from initial_index, returning (results, avoided) as for find_nodes()"""
         results = []
         avoided = []
-        while len(results) < count:
-            if next_index == len(self.nodelist):  # Wrap round to the start
-                next_index = 0
-            node = self.nodelist[next_index][1]
+        for step in xrange(len(self.nodelist)):  # Go all the way around at most
+            node = self.nodelist[(initial_index + step) % len(self.nodelist)][1]
             if node in avoid:
                 if node not in avoided:
                     avoided.append(node)
             elif node not in results:
                 results.append(node)
-            next_index = next_index + 1
-            if next_index == initial_index:
-                # Gone all the way around -- terminate loop regardless
-                break
+                if len(results) >= count:
+                    break
         return results, avoided
 
     def __str__(self):
@@ -59,6 +329,7 @@ class ConsistentHashTable(object):
 # -----------IGNOREBEYOND: test code ---------------
 import sys
 import random
+import hashlib
 import unittest
 from testutils import random_3letters, Stats
 
@@ -101,16 +372,198 @@ class HashMultipleTestCase(unittest.TestCase):
         self.assertEqual(result, [])
         self.assertEqual(set(avoided), set(['A', 'B', 'C']))
 
+    def testIncremental(self):
+        nodes = sorted(self.nodeset)
+        c3 = ConsistentHashTable(nodes[:-1], NODE_REPEAT)
+        changes = c3.add_node(nodes[-1])
+        self.assertEqual(c3.nodelist, self.c2.nodelist)
+        self.assertEqual(c3.hashlist, self.c2.hashlist)
+        self.assertTrue(len(changes) <= NODE_REPEAT)
+        for (start, end, old_node, new_node) in changes:
+            self.assertEqual(new_node, nodes[-1])
+            self.assertNotEqual(old_node, nodes[-1])
+            # Keys just before the end of a changed range now go to the new node (the range
+            # may wrap round the end of the ring)
+            index = bisect.bisect(c3.hashlist, start) % len(c3.hashlist)
+            self.assertEqual(c3.nodelist[index][1], new_node)
+        self.assertEqual(c3.remove_node(nodes[-1]),
+                         [(start, end, new_node, old_node) for (start, end, old_node, new_node) in changes])
+        self.assertEqual(str(c3), str(ConsistentHashTable(nodes[:-1], NODE_REPEAT)))
+
+        c4 = ConsistentHashTable((), 2)
+        changes = c4.add_node('A')
+        self.assertEqual(len(changes), 1)  # the whole ring
+        self.assertEqual(changes[0][2:], (None, 'A'))
+        c4.add_node('B')
+        c4.add_node('C')
+        c4.remove_node('A')
+        c4.add_node('A')
+        self.assertEqual(str(c4), str(self.c1))
+        c4.remove_node('A')
+        c4.remove_node('B')
+        self.assertEqual(c4.remove_node('C')[0][2:], ('C', None))
+        self.assertEqual(c4.nodelist, [])
+
+    def testCache(self):
+        c = ConsistentHashTable(sorted(self.nodeset), NODE_REPEAT)
+        expected = c.find_nodes('splurg', 3)
+        self.assertEqual((c.hits, c.misses), (0, 1))
+        result = c.find_nodes('splurg', 3)
+        self.assertEqual(result, expected)
+        self.assertEqual((c.hits, c.misses), (1, 1))
+        result[0].append('X')  # doesn't affect the cache
+        self.assertEqual(c.find_nodes('splurg', 3), expected)
+        # Uncached unless there is a view for the avoid collection
+        avoid = [expected[0][0]]
+        c.find_nodes('splurg', 3, avoid)
+        self.assertEqual((c.hits, c.misses), (2, 1))
+        avoided = c.find_nodes('splurg', 3, avoid, view=('me', 1))
+        self.assertEqual(avoided[1], avoid)
+        self.assertEqual(c.find_nodes('splurg', 3, avoid, view=('me', 1)), avoided)
+        self.assertEqual((c.hits, c.misses), (3, 2))
+        # A change of membership invalidates the cache
+        epoch = c.epoch
+        c.remove_node(expected[0][1])
+        self.assertEqual(c.epoch, epoch + 1)
+        self.assertEqual(c.cache, {})
+        result = c.find_nodes('splurg', 3)
+        self.assertEqual(result[0][:2], [expected[0][0], expected[0][2]])
+
+    def testSuccessors(self):
+        nodes = sorted(self.nodeset)
+        c = ConsistentHashTable(nodes, NODE_REPEAT)
+        for ii in xrange(200):
+            key = random_3letters()
+            initial_index = bisect.bisect(c.hashlist, hashlib.md5(key).digest())
+            avoid = random.sample(nodes, ii % 3)
+            for count in (1, 3, 5):
+                self.assertEqual(c.find_nodes(key, count, avoid), c._walk(initial_index, count, avoid))
+        self.assertEqual(c.successor_depth, 5)
+        self.assertEqual(len(c.successors), len(nodes) * NODE_REPEAT)
+        # Asking for more nodes than there are stops after going all the way round
+        self.assertEqual(set(self.c1.find_nodes('splurg', 5)[0]), set(['A', 'B', 'C']))
+        self.assertEqual(set(self.c1.find_nodes('zz', 5, avoid=['B'])[0]), set(['A', 'C']))
+
     def testLarge(self):
         x = self.c2.find_nodes('splurg', 15)[0]
         self.assertEqual(len(x), 15)
 
+    def testMany(self):
+        global numpy
+        keys = [random_3letters() for _ in xrange(2000)] + ['splurg']
+        expected = [self.c2.find_nodes(key, 3)[0] for key in keys]
+        for use_numpy in (True, False):
+            saved = numpy
+            try:
+                if not use_numpy:
+                    numpy = None
+                self.c2.bulk_tables = {}
+                (nodes, matrix) = self.c2.find_nodes_many(keys, 3)
+            finally:
+                numpy = saved
+            self.assertEqual([[nodes[index] for index in row] for row in matrix], expected)
+        (nodes, matrix) = self.c1.find_nodes_many(['splurg'], 5)
+        self.assertEqual(list(matrix[0][3:]), [-1, -1])
+
+    def testKeyRef(self):
+        ref = hashfunc.KeyRef('splurg')
+        self.assertEqual(self.c2.find_nodes(ref, 3), self.c2.find_nodes('splurg', 3))
+        self.assertEqual(self.c1.find_nodes(ref, 2, avoid=('A',)), (['C', 'B'], ['A']))
+        c = ConsistentHashTable(self.nodeset, NODE_REPEAT, hashfn='crc')
+        self.assertEqual(c.find_nodes(ref, 3), c.find_nodes('splurg', 3))
+        (nodes, matrix) = self.c2.find_nodes_many([ref], 3)
+        self.assertEqual([nodes[index] for index in matrix[0]], self.c2.find_nodes('splurg', 3)[0])
+
+    def testWeights(self):
+        nodes = sorted(self.nodeset)
+        weights = dict((node, random.choice((0.5, 1, 2))) for node in nodes)
+        c = ConsistentHashTable(nodes, NODE_REPEAT, weights=weights)
+        for node in nodes:
+            self.assertEqual(len([hashnode for hashnode in c.nodelist if hashnode[1] == node]),
+                             NODE_REPEAT * weights[node])
+        # Reweighting gives the same table as building from scratch, and only changes the
+        # first node for hash values in the returned ranges
+        keys = [random_3letters() for _ in xrange(1000)]
+
+        def covers(change, hv):
+            if change[0] < change[1]:
+                return change[0] <= hv < change[1]
+            return hv >= change[0] or hv < change[1]  # range wraps round the top of the ring
+        for (node, weight) in ((nodes[0], 3), (nodes[1], 0.2), (nodes[0], 1)):
+            before = [c.find_nodes(key)[0][0] for key in keys]
+            changes = c.set_weight(node, weight)
+            weights[node] = weight
+            self.assertEqual(c.nodelist, ConsistentHashTable(nodes, NODE_REPEAT, weights=weights).nodelist)
+            for (key, old_node) in zip(keys, before):
+                new_node = c.find_nodes(key)[0][0]
+                hv = c.hashfn.digest(key)
+                in_range = [change for change in changes if covers(change, hv)]
+                if new_node != old_node:
+                    self.assertEqual(len(in_range), 1)
+                    self.assertEqual(in_range[0][2:], (old_node, new_node))
+                else:
+                    self.assertEqual(in_range, [])
+        c.remove_node(nodes[0])
+        self.assertFalse(nodes[0] in c.weights)
+        c.add_node(nodes[0], 2)
+        self.assertEqual(c._vnode_count(nodes[0]), 2 * NODE_REPEAT)
+
+    def testBalance(self):
+        nodes = sorted(self.nodeset)[:10]
+        weights = dict((node, 1 + (ii % 3)) for ii, node in enumerate(nodes))
+        c = ConsistentHashTable(nodes, 100, weights=weights)
+        report = c.balance()
+        self.assertEqual(set(node for (node, _, _) in report), set(nodes))
+        self.assertAlmostEqual(sum(share for (_, share, _) in report), 1.0)
+        self.assertAlmostEqual(sum(target for (_, _, target) in report), 1.0)
+        print
+        for (node, share, target) in sorted(report):
+            print "%s weight %d: %5.1f%% of keys, target %5.1f%%" % (node, weights[node], 100 * share, 100 * target)
+            self.assertTrue(abs(share - target) < target / 2)
+
+    def testBoundedLoads(self):
+        c = ConsistentHashTable(('A', 'B', 'C'), 2)
+        self.assertEqual(c.coordinator(['A', 'C']), 'A')
+        c.load_epsilon = 0.5
+        c.add_load('A', 3)
+        # Bound is ceil(1.5 * 4 / 3) = 2
+        self.assertEqual(c.load_bound(), 2)
+        self.assertFalse(c.under_bound('A'))
+        self.assertTrue(c.under_bound('B'))
+        self.assertEqual(c.coordinator(['A', 'C']), 'C')
+        c.add_load('C', 2)
+        self.assertEqual(c.coordinator(['A', 'C']), 'C')  # least loaded
+        c.add_load('A', -3)
+        self.assertEqual(c.coordinator(['A', 'C']), 'A')
+        self.assertEqual(c.total_load, 2)
+
+        # With skewed key popularity, the bound caps the busiest node's load
+        keys = ['hot%d' % (ii % 5) for ii in xrange(500)] + [random_3letters() for _ in xrange(500)]
+        max_loads = []
+        for epsilon in (None, 0.25):
+            c = ConsistentHashTable(self.nodeset, NODE_REPEAT)
+            c.load_epsilon = epsilon
+            for key in keys:
+                c.add_load(c.coordinator(c.find_nodes(key, 3)[0]))
+            max_loads.append(max(c.loads.values()))
+        self.assertTrue(max_loads[1] < max_loads[0])
+
+    def testHashFunctions(self):
+        keys = [random_3letters() for _ in xrange(500)]
+        for name in hashfunc.names():
+            c = ConsistentHashTable(self.nodeset, NODE_REPEAT, hashfn=name)
+            self.assertEqual(len(c.hashlist[0]) * 8, c.hashfn.bits)
+            (nodes, matrix) = c.find_nodes_many(keys, 2)
+            self.assertEqual([[nodes[index] for index in row] for row in matrix],
+                             [c.find_nodes(key, 2)[0] for key in keys])
+
     def testDistribution(self):
         """Generate a lot of hash values and see how even the distribution is"""
         nodecount = dict([(node, 0) for node in self.nodeset])
         numkeys = 10000
-        for _ in range(numkeys):
-            node = self.c2.find_nodes(random_3letters(), 1)[0][0]
+        (nodes, matrix) = self.c2.find_nodes_many([random_3letters() for _ in range(numkeys)], 1)
+        for row in matrix:
+            node = nodes[row[0]]
             nodecount[node] = nodecount[node] + 1
         stats = Stats()
         for node, count in nodecount.items():
@@ -129,9 +582,9 @@ class HashMultipleTestCase(unittest.TestCase):
             for to_node in self.nodeset:
                 transfer[from_node][to_node] = 0
         numkeys = 10000
-        for _ in range(numkeys):
-            key = random_3letters()
-            node_pair = self.c2.find_nodes(key, 2)[0]
+        (nodes, matrix) = self.c2.find_nodes_many([random_3letters() for _ in range(numkeys)], 2)
+        for row in matrix:
+            node_pair = (nodes[row[0]], nodes[row[1]])
             transfer[node_pair[0]][node_pair[1]] = transfer[node_pair[0]][node_pair[1]] + 1
         stats = Stats()
         for from_node in self.nodeset:
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""Consistent hashing with fixed, equal-sized partitions (strategy 3 of the Dynamo paper)"""
+import hashfunc
+from hash_multiple import BoundedLoads
+
+
+class PartitionedHashTable(BoundedLoads):
+    def __init__(self, nodelist, partitions, hashfn=None, weights=None):
+        """Initialize a hash table that divides the hash space of the given hash function into
+        the given number of equal-sized partitions, shared out among the given nodes in
+        proportion to their weights from the (optional) weights dict (default 1)."""
+        self.partitions = partitions
+        self.hashfn = hashfunc.get(hashfn)
+        self.partition_size = (2 ** self.hashfn.bits + partitions - 1) // partitions
+        self.weights = dict(weights or {})  # node => weight, for nodes without weight 1
+        self.members = []  # nodes, in order of joining
+        self.owner = [None] * partitions  # partition => node
+        # Membership epoch, incremented whenever partitions change hands
+        self.epoch = 0
+        # For each partition, the next successor_depth distinct nodes from that partition on;
+        # built on first use, and discarded when the epoch changes
+        self.successors = None
+        self.successor_depth = 0
+        self.loads = {}  # node => current load, for bounded-load mode
+        self.total_load = 0
+        for node in nodelist:
+            self.members.append(node)
+        self._rebalance()
+
+    @property
+    def node_count(self):
+        return len(self.members)
+
+    def partition_of(self, key):
+        """Return the partition for the given key (or KeyRef)"""
+        return self.hashfn.key_token(key) // self.partition_size
+
+    def partition_range(self, partition):
+        """Return the range of tokens [start, end) covered by the given partition"""
+        return (partition * self.partition_size,
+                min((partition + 1) * self.partition_size, 2 ** self.hashfn.bits))
+
+    def partitions_of(self, node):
+        """Return the list of partitions owned by the given node"""
+        return [partition for partition, owner in enumerate(self.owner) if owner == node]
+
+    def add_node(self, node, weight=None):
+        """Add a node (with the given weight, default 1), moving just enough partitions to it
+        to keep the shares even.  Returns a list of (partition, old_node, new_node) tuples
+        describing the partitions that have moved; old_node is None if the table was empty."""
+        if weight is not None:
+            self.weights[node] = weight
+        self.members.append(node)
+        return self._rebalance()
+
+    def remove_node(self, node):
+        """Remove a node, sharing its partitions among the remaining nodes.  Returns a list of
+        moved partitions as for add_node(), where new_node is None if the table is now empty."""
+        self.members.remove(node)
+        self.weights.pop(node, None)
+        return self._rebalance()
+
+    def set_weight(self, node, weight):
+        """Change the weight of a node, moving partitions to or from it to match.  Returns a
+        list of moved partitions as for add_node()."""
+        self.weights[node] = weight
+        return self._rebalance()
+
+    def _quotas(self):
+        """Return a dict giving the number of partitions each node should own"""
+        total_weight = float(sum(self.weights.get(node, 1) for node in self.members))
+        exact = [(self.partitions * self.weights.get(node, 1) / total_weight, node) for node in self.members]
+        quotas = dict((node, int(share)) for (share, node) in exact)
+        # Hand out the remaining partitions by largest remainder, ties going to earlier members
+        spare = self.partitions - sum(quotas.values())
+        order = sorted(xrange(len(exact)), key=lambda ii: (int(exact[ii][0]) - exact[ii][0], ii))
+        for ii in order[:spare]:
+            quotas[exact[ii][1]] = quotas[exact[ii][1]] + 1
+        return quotas
+
+    def _rebalance(self):
+        """Move the fewest partitions needed for each node to own its quota of partitions,
+        returning a list of (partition, old_node, new_node) tuples"""
+        if not self.members:
+            moves = [(partition, owner, None) for partition, owner in enumerate(self.owner)]
+            self.owner = [None] * self.partitions
+            self._new_epoch()
+            return moves
+        quotas = self._quotas()
+        owned = dict((node, []) for node in self.members)
+        spare = []  # partitions to hand out
+        for partition, owner in enumerate(self.owner):
+            if owner in owned:
+                owned[owner].append(partition)
+            else:
+                spare.append(partition)
+        for node in self.members:
+            # Give up the highest-numbered partitions beyond the quota
+            while len(owned[node]) > quotas[node]:
+                spare.append(owned[node].pop())
+        spare.sort()
+        # Deal the spare partitions out in turn to the nodes that are short of their quota, so
+        # that neighbouring partitions tend to go to different nodes
+        moves = []
+        needy = [node for node in self.members if len(owned[node]) < quotas[node]]
+        while spare:
+            for node in list(needy):
+                if not spare:
+                    break
+                partition = spare.pop(0)
+                moves.append((partition, self.owner[partition], node))
+                self.owner[partition] = node
+                owned[node].append(partition)
+                if len(owned[node]) >= quotas[node]:
+                    needy.remove(node)
+        if moves:
+            self._new_epoch()
+        return moves
+
+    def _new_epoch(self):
+        self.epoch = self.epoch + 1
+        self.successors = None
+
+    def find_nodes(self, key, count=1, avoid=None, view=None):
+        """Return a list of count nodes from the hash table for the given key (or KeyRef): the
+        owner of its partition, then the owners of the following partitions, skipping repeats
+        and any nodes in the avoid collection.  Also returns the nodes from the avoid
+        collection that have been avoided, as for ConsistentHashTable.find_nodes()
+        (view is accepted for compatibility, and ignored)."""
+        if not self.members:
+            return [], []
+        partition = self.partition_of(key)
+        if self.successors is None or count > self.successor_depth:
+            self._build_successors(max(count, self.successor_depth))
+        results = self.successors[partition][:count]
+        if avoid:
+            for node in results:
+                if node in avoid:
+                    # Only walk the partitions if an avoided node is in the way
+                    return self._walk(partition, count, avoid)
+        return list(results), []
+
+    def preference_list(self, partition, count):
+        """Return the first count distinct nodes for the given partition"""
+        if self.successors is None or count > self.successor_depth:
+            self._build_successors(max(count, self.successor_depth))
+        return list(self.successors[partition][:count])
+
+    def _build_successors(self, depth):
+        self.successor_depth = depth
+        self.successors = [self._walk(partition, depth, ())[0] for partition in xrange(self.partitions)]
+
+    def _walk(self, partition, count, avoid):
+        """Walk the partitions from the given one, returning (results, avoided)"""
+        results = []
+        avoided = []
+        for step in xrange(self.partitions):  # Go all the way around at most
+            node = self.owner[(partition + step) % self.partitions]
+            if node in avoid:
+                if node not in avoided:
+                    avoided.append(node)
+            elif node not in results:
+                results.append(node)
+                if len(results) >= count:
+                    break
+        return results, avoided
+
+    def __str__(self):
+        return ",".join(["%d:%s" % (partition, owner) for partition, owner in enumerate(self.owner)])
+
+
+# -----------IGNOREBEYOND: test code ---------------
+import sys
+import random
+import unittest
+from testutils import random_3letters, Stats
+
+
+class PartitionedHashTestCase(unittest.TestCase):
+    """Test consistent hashing with fixed partitions"""
+
+    def setUp(self):
+        self.p1 = PartitionedHashTable(('A', 'B', 'C'), 8)
+        self.nodes = sorted(set(random_3letters() for _ in xrange(20)))
+        self.p2 = PartitionedHashTable(self.nodes, 1024)
+
+    def testSmallExact(self):
+        self.assertEqual(str(self.p1), "0:A,1:B,2:C,3:A,4:B,5:C,6:A,7:B")
+        # 'splurg' hashes to 0x46cc..., in partition 2 of 8
+        self.assertEqual(self.p1.partition_of('splurg'), 2)
+        self.assertEqual(self.p1.find_nodes('splurg', 2), (['C', 'A'], []))
+        self.assertEqual(self.p1.find_nodes('splurg', 2, avoid=('C',)), (['A', 'B'], ['C']))
+        self.assertEqual(self.p1.find_nodes('splurg', 5, avoid=('A', 'C')), (['B'], ['C', 'A']))
+        self.assertEqual(self.p1.find_nodes(hashfunc.KeyRef('splurg'), 2), (['C', 'A'], []))
+        self.assertEqual(self.p1.partition_range(7)[1], 2 ** 128)
+
+    def testPartitionOf(self):
+        for _ in xrange(100):
+            key = random_3letters()
+            partition = self.p2.partition_of(key)
+            (start, end) = self.p2.partition_range(partition)
+            self.assertTrue(start <= hashfunc.get().token(key) < end)
+
+    def testBalance(self):
+        counts = [len(self.p2.partitions_of(node)) for node in self.nodes]
+        self.assertEqual(sum(counts), 1024)
+        self.assertTrue(max(counts) - min(counts) <= 1)
+        for partition in xrange(0, 1024, 37):
+            nodes = self.p2.preference_list(partition, 3)
+            self.assertEqual(len(set(nodes)), 3)
+            self.assertEqual(nodes[0], self.p2.owner[partition])
+
+    def testJoinLeave(self):
+        before = list(self.p2.owner)
+        moves = self.p2.add_node('new')
+        # Only the new node's share of partitions moves, and all of it goes to the new node
+        self.assertEqual(len(moves), 1024 // (len(self.nodes) + 1))
+        self.assertEqual(set(new for (_, _, new) in moves), set(['new']))
+        for (partition, old, new) in moves:
+            self.assertEqual(before[partition], old)
+        self.assertEqual(len([ii for ii in xrange(1024) if before[ii] != self.p2.owner[ii]]), len(moves))
+        # On leaving, just the leaving node's partitions move
+        owned = set(self.p2.partitions_of(self.nodes[0]))
+        moves = self.p2.remove_node(self.nodes[0])
+        self.assertEqual(set(partition for (partition, _, _) in moves), owned)
+        counts = [len(self.p2.partitions_of(node)) for node in self.p2.members]
+        self.assertTrue(max(counts) - min(counts) <= 1)
+        self.assertFalse(self.nodes[0] in self.p2.owner)
+
+        p3 = PartitionedHashTable((), 4)
+        self.assertEqual(p3.find_nodes('splurg'), ([], []))
+        self.assertEqual(p3.add_node('A'), [(ii, None, 'A') for ii in xrange(4)])
+        self.assertEqual(p3.remove_node('A'), [(ii, 'A', None) for ii in xrange(4)])
+
+    def testWeights(self):
+        moves = self.p2.set_weight(self.nodes[0], 3)
+        self.assertEqual(set(new for (_, _, new) in moves), set([self.nodes[0]]))
+        total = len(self.nodes) + 2
+        self.assertTrue(abs(len(self.p2.partitions_of(self.nodes[0])) - 3 * 1024.0 / total) < 1)
+        self.assertTrue(abs(len(self.p2.partitions_of(self.nodes[1])) - 1024.0 / total) < 1)
+
+    def testDistribution(self):
+        """Generate a lot of hash values and see how even the distribution is"""
+        nodecount = dict([(node, 0) for node in self.nodes])
+        numkeys = 10000
+        for _ in range(numkeys):
+            node = self.p2.find_nodes(random_3letters(), 1)[0][0]
+            nodecount[node] = nodecount[node] + 1
+        stats = Stats()
+        for node, count in nodecount.items():
+            stats.add(count)
+        print ("%d random hash keys assigned to %d nodes owning %d partitions "
+               "are distributed across the nodes "
+               "with a standard deviation of %0.2f (compared to a mean of %d)." %
+               (numkeys, len(self.nodes), self.p2.partitions, stats.stddev(), numkeys / len(self.nodes)))
+
+
+if __name__ == "__main__":
+    ii = 1
+    while ii < len(sys.argv):  # pragma: no cover
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
+        else:
+            ii += 1
+    unittest.main()
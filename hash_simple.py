@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 """Consistent hash code"""
-import hashlib
 import binascii
 import bisect
 
+import hashfunc
+
 
 class SimpleConsistentHashTable(object):
-    def __init__(self, nodelist):
-        """Initialize a consistent hash table for the given list of nodes"""
-        baselist = [(hashlib.md5(str(node)).digest(), node) for node in nodelist]
+    def __init__(self, nodelist, hashfn=None):
+        """Initialize a consistent hash table for the given list of nodes, using the
+        given hash function (see hashfunc.py)"""
+        self.hashfn = hashfunc.get(hashfn)
+        baselist = [(self.hashfn.digest(str(node)), node) for node in nodelist]
         # Build two lists: one of (hashvalue, node) pairs, sorted by
         # hashvalue, one of just the hashvalues, to allow use of bisect.
         self.nodelist = sorted(baselist, key=lambda x: x[0])
@@ -16,7 +19,7 @@ class SimpleConsistentHashTable(object):
 
     def find_nodes(self, key, count=1, avoid=None):
         """Return a list of count nodes from the hash table that are
-        consecutively after the hash of the given key, together with
+        consecutively after the hash of the given key (or KeyRef), together with
         those nodes from the avoid collection that have been avoided.
 
         Returned list size is <= count, and any nodes in the avoid collection
@@ -24,7 +27,7 @@ class SimpleConsistentHashTable(object):
         if avoid is None:  # Use an empty set
             avoid = set()
         # Hash the key to find where it belongs on the ring
-        hv = hashlib.md5(str(key)).digest()
+        hv = self.hashfn.key_digest(key)
         # Find the node after this hash value around the ring, as an index
         # into self.hashlist/self.nodelist
         initial_index = bisect.bisect(self.hashlist, hv)
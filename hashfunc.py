@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Hash functions for placing keys on the consistent hash ring and in Merkle trees"""
+import zlib
+import struct
+import hashlib
+
+
+class HashFunction(object):
+    """Named hash function, giving both a digest (a byte string, as used to order positions
+    round the consistent hash ring) and an integer token in the range [0, 2**bits) that
+    sorts in the same order as the digest."""
+    def __init__(self, name, digest, bits, token=None):
+        self.name = name
+        self.digest = digest  # function from string to byte string of bits/8 bytes
+        self.bits = bits
+        self._unpack = struct.Struct('>%dQ' % (bits // 64)).unpack
+        if token is not None:
+            # Function from string straight to the integer token, without the digest bytes
+            self.token = token
+
+    def token(self, data):
+        """Return the integer token for the given string"""
+        return self.token_of(self.digest(data))
+
+    def token_of(self, digest):
+        """Return the integer token corresponding to a digest from this function"""
+        words = self._unpack(digest)
+        if len(words) == 1:
+            return words[0]
+        if len(words) == 2:
+            return (words[0] << 64) | words[1]
+        value = 0
+        for word in words:
+            value = (value << 64) | word
+        return value
+
+    def key_digest(self, key):
+        """Return the digest for a key, which may be a KeyRef carrying the digest already"""
+        if isinstance(key, KeyRef) and key.hashfn is self:
+            return key.digest
+        return self.digest(str(key))
+
+    def key_token(self, key):
+        """Return the integer token for a key, which may be a KeyRef carrying the token already"""
+        if isinstance(key, KeyRef) and key.hashfn is self:
+            return key.token
+        return self.token(str(key))
+
+    def __reduce__(self):
+        # Pickle by name, so the digest function doesn't need to be picklable
+        return (get, (self.name,))
+
+    def __repr__(self):
+        return "HashFunction(%s)" % self.name
+
+
+# PART keyref
+class KeyRef(object):
+    """A key together with its digest and token from a hash function, worked out once so
+    the key doesn't need hashing again by each hash table and Merkle tree it is used with.
+    A KeyRef compares and hashes as equal to the key itself."""
+    __slots__ = ('key', 'hashfn', 'digest', 'token')
+
+    def __init__(self, key, hashfn=None):
+        self.key = key
+        self.hashfn = get(hashfn)
+        self.digest = self.hashfn.digest(str(key))
+        self.token = self.hashfn.token_of(self.digest)
+
+    def __eq__(self, other):
+        return unwrap(other) == self.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return str(self.key)
+
+    def __repr__(self):
+        return "KeyRef(%r)" % (self.key,)
+
+
+def unwrap(key):
+    """Return the key itself, for a key or a KeyRef"""
+    if isinstance(key, KeyRef):
+        return key.key
+    return key
+
+
+def _md5(data):
+    return hashlib.md5(data).digest()
+
+
+def _sha1(data):
+    return hashlib.sha1(data).digest()[:16]
+
+
+def _crc_token(data):
+    # Not cryptographic, but the ring and the Merkle trees only need an even spread
+    return ((zlib.crc32(data) & 0xffffffff) << 32) | (zlib.adler32(data) & 0xffffffff)
+
+
+_pack_crc = struct.Struct('>Q').pack
+
+
+def _crc(data):
+    return _pack_crc(_crc_token(data))
+
+
+_functions = {}  # name => HashFunction
+
+
+def register(hashfn):
+    """Make a HashFunction available by name"""
+    _functions[hashfn.name] = hashfn
+
+
+def get(hashfn=None):
+    """Return the HashFunction with the given name; None gives the default (md5), and a
+    HashFunction is returned unchanged"""
+    if hashfn is None:
+        hashfn = DEFAULT
+    if isinstance(hashfn, HashFunction):
+        return hashfn
+    try:
+        return _functions[hashfn]
+    except KeyError:
+        raise ValueError("Unknown hash function %s" % hashfn)
+
+
+def names():
+    """Return the names of the available hash functions"""
+    return sorted(_functions.keys())
+
+
+DEFAULT = 'md5'
+register(HashFunction('md5', _md5, 128))
+register(HashFunction('sha1', _sha1, 128))
+register(HashFunction('crc', _crc, 64, token=_crc_token))
+
+
+# -----------IGNOREBEYOND: test code ---------------
+import sys
+import pickle
+import random
+import binascii
+import unittest
+
+from testutils import random_3letters
+
+
+class HashFunctionTestCase(unittest.TestCase):
+    """Test hash functions"""
+
+    def testMD5(self):
+        hashfn = get()
+        self.assertEqual(hashfn.name, 'md5')
+        self.assertEqual(hashfn.digest('A'), hashlib.md5('A').digest())
+        self.assertEqual(hashfn.token('A'), long(hashlib.md5('A').hexdigest(), 16))
+        self.assertTrue(get(hashfn) is hashfn)
+        self.assertRaises(ValueError, get, 'nosuchhash')
+
+    def testTokens(self):
+        keys = [random_3letters() for _ in xrange(200)]
+        for name in names():
+            hashfn = get(name)
+            digests = [hashfn.digest(key) for key in keys]
+            for digest in digests:
+                self.assertEqual(len(digest) * 8, hashfn.bits)
+                self.assertEqual(hashfn.token_of(digest), long(binascii.hexlify(digest), 16))
+            # Tokens sort the same way as digests
+            self.assertEqual(sorted(digests, key=hashfn.token_of), sorted(digests))
+            self.assertEqual([hashfn.token(key) for key in keys], [hashfn.token_of(digest) for digest in digests])
+            self.assertTrue(pickle.loads(pickle.dumps(hashfn, 2)) is hashfn)
+
+    def testKeyRef(self):
+        md5 = get('md5')
+        ref = KeyRef('A')
+        self.assertEqual(ref.digest, md5.digest('A'))
+        self.assertEqual(ref.token, md5.token('A'))
+        self.assertEqual(md5.key_token(ref), ref.token)
+        self.assertEqual(get('crc').key_token(ref), get('crc').token('A'))
+        self.assertEqual(ref, 'A')
+        self.assertEqual(unwrap(ref), 'A')
+        self.assertEqual(unwrap('A'), 'A')
+        self.assertEqual(set([ref, 'A', KeyRef('A', 'crc')]), set(['A']))
+        self.assertEqual(str(ref), 'A')
+        copy = pickle.loads(pickle.dumps(ref, 2))
+        self.assertEqual((copy.key, copy.digest, copy.token), (ref.key, ref.digest, ref.token))
+        self.assertTrue(copy.hashfn is md5)
+
+
+if __name__ == "__main__":
+    ii = 1
+    while ii < len(sys.argv):  # pragma: no cover
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
+        else:
+            ii += 1
+    unittest.main()
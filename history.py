@@ -2,6 +2,8 @@
 from bisect import bisect
 import logging
 
+from simulation import ContextMeta
+
 _logger = logging.getLogger('dynamo')
 
 
@@ -56,6 +58,8 @@ class History(object):
       'remove'   - node removed from configuration
       'announce' - overall message to be included in output
     """
+    __metaclass__ = ContextMeta
+    __context__ = ('history',)
     history = []
 
     @classmethod
@@ -1,43 +1,92 @@
 #!/usr/bin/env python
 """Minimal Merkle Tree implementation"""
+import struct
 import hashlib
+import binascii
 from UserDict import DictMixin
 
+import hashfunc
+
 
 # PART keyhash
-def keyhash(key):
-    """Return a 128-bit integer associated with a key"""
-    hashval = hashlib.md5(str(key))
-    # convert 128-bit MD5 value to long
-    return long(hashval.hexdigest(), 16)
+def keyhash(key, hashfn=None):
+    """Return the integer token (128-bit for the default MD5) associated with a key or KeyRef"""
+    return hashfunc.get(hashfn).key_token(key)
+
+
+# PART itemhash
+_unpack_digest = struct.Struct('>QQ').unpack
+_pack_digest = struct.Struct('>QQ').pack
+_ITEMHASH_MODULUS = 2 ** 128
+
+
+def itemhash(key, value):
+    """Return a 128-bit integer associated with a (key, value) item.  Tuple values are
+    converted element by element with str(), so that (value, metadata) pairs holding equal
+    VectorClocks give the same result."""
+    if isinstance(value, tuple):
+        value = "(%s)" % ",".join([str(element) for element in value])
+    (high, low) = _unpack_digest(hashlib.md5("%s\0%s" % (key, value)).digest())
+    return (high << 64) | low
+
+
+# PART leafhash
+def _leaf_digest(total):
+    """Return the Merkle value for a leaf whose item hashes add up to total"""
+    return hashlib.md5(_pack_digest(total >> 64, total & 0xffffffffffffffff)).digest()
+
+
+_empty_digests = [_leaf_digest(0)]  # level => Merkle value of an empty subtree of that height
+
+
+def _empty_digest(level):
+    while len(_empty_digests) <= level:
+        _empty_digests.append(hashlib.md5(_empty_digests[-1] * 2).digest())
+    return _empty_digests[level]
 
 
 # PART coretree
+class MerkleValue(object):
+    """Merkle value of a node, with the digest()/hexdigest() methods of a hashlib object"""
+    __slots__ = ('_digest',)
+
+    def __init__(self, digest):
+        self._digest = digest
+
+    def digest(self):
+        return self._digest
+
+    def hexdigest(self):
+        return binascii.hexlify(self._digest)
+
+
 class MerkleTreeNode(object):
-    def __init__(self):
-        self.value = None
-        self.parent = None
+    """View of the node of a MerkleTree at the given index.  The nodes are numbered as in a
+    binary heap: the root is 1, and the children of node ii are 2*ii and 2*ii+1."""
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
 
-    def recalc(self):
-        raise NotImplementedError("Subclasses should implement this method")
+    @property
+    def value(self):
+        return MerkleValue(self.tree._digest(self.index))
+
+    @property
+    def parent(self):
+        if self.index == 1:
+            return None
+        return self.tree._node(self.index // 2)
 
 
 class MerkleBranchNode(MerkleTreeNode):
-    """Interior node in Merkle tree"""
-    def __init__(self, left, right):
-        super(MerkleBranchNode, self).__init__()
-        self.left = left
-        left.parent = self
-        self.right = right
-        right.parent = self
-        self.recalc()
-
-    def recalc(self):
-        """Recalculate the Merkle value for this node, and all parent nodes"""
-        # Node value is hash of two children's hash values concatenated
-        self.value = hashlib.md5(self.left.value.digest() + self.right.value.digest())
-        if self.parent is not None:
-            self.parent.recalc()
+    """Interior node in Merkle tree, whose value is the hash of its two children's values"""
+    @property
+    def left(self):
+        return self.tree._node(2 * self.index)
+
+    @property
+    def right(self):
+        return self.tree._node(2 * self.index + 1)
 
     def __str__(self):
         return self.value.hexdigest()[:6]
@@ -45,36 +94,59 @@ class MerkleBranchNode(MerkleTreeNode):
 
 # PART leafnode
 class MerkleLeaf(MerkleTreeNode):
-    """Leaf node in Merkle tree, encompassing all keys in subrange [min_key, max_key)"""
-    def __init__(self, min_key, max_key, initdata=None):
-        super(MerkleLeaf, self).__init__()
-        self.min_key = min_key
-        self.max_key = max_key
-        # Copy in any keys whose hash falls in range for this node
-        if initdata is None:
-            self._data = {}
-        else:
-            self._data = dict([(key, value) for key, value in initdata.items() if self._inrange(key)])
-        self.value = hashlib.md5(str(self._data))
+    """Leaf node in Merkle tree, encompassing all keys in subrange [min_key, max_key).
+
+    The Merkle value of a leaf is derived from the sum (modulo 2^128) of the itemhash() values
+    of its items, which doesn't depend on the order of the items, and can be kept up to date
+    as items change without going through all of them."""
+    @property
+    def leafidx(self):
+        return self.index - self.tree.num_leaves
+
+    @property
+    def min_key(self):
+        return self.tree.leaf_range(self.leafidx)[0]
+
+    @property
+    def max_key(self):
+        return self.tree.leaf_range(self.leafidx)[1]
+
+    @property
+    def _data(self):
+        return self.tree._buckets.get(self.leafidx, {})
 
     def __str__(self):
         return "[%s,%s)=>%s" % (self.min_key, self.max_key, self.value.hexdigest()[:6])
 
     def _inrange(self, key):
         """Determine whether the given key falls within the subrange of this leaf node"""
-        hashval = keyhash(key)
+        hashval = self.tree.hashfn.key_token(key)
         return hashval >= self.min_key and hashval < self.max_key
 
-    def recalc(self):
-        """Recalculate the Merkle value for this node, and all parent nodes"""
-        self.value = hashlib.md5(str(self._data))
-        self.parent.recalc()
+
+def children(indices):
+    """Return the indices of the children of the nodes with the given indices"""
+    results = []
+    for index in indices:
+        results.append(2 * index)
+        results.append(2 * index + 1)
+    return results
 
 
 # PART tree
 class MerkleTree(DictMixin):
-    def __init__(self, depth=12, min_key=0, max_key=(2 ** 128 - 1), initdata=None):
-        """Build a Merkle tree of given depth covering keys in range [min_key, max_key)"""
+    def __init__(self, depth=12, min_key=0, max_key=None, initdata=None, hashfn=None, lazy=True):
+        """Build a Merkle tree of given depth covering keys in range [min_key, max_key), where
+        keys are placed by their token from the given hash function (see hashfunc.py).  By
+        default the range covers all tokens of the hash function.
+
+        If lazy is set, changes just mark the Merkle values above them as out of date, and
+        these are recalculated (once each) when next used; otherwise every change updates
+        the Merkle values all the way up to the root."""
+        self.hashfn = hashfunc.get(hashfn)
+        self.lazy = lazy
+        if max_key is None:
+            max_key = 2 ** self.hashfn.bits - 1
         self.min_key = min_key
         self.max_key = max_key
         self.depth = depth
@@ -82,66 +154,241 @@ class MerkleTree(DictMixin):
         self.num_leaves = 2 ** self.depth
         self.leaf_size = ((self.max_key - self.min_key) + self.num_leaves - 1) / self.num_leaves
 
-        # nodes is an array of (depth+1) lists; each list is a layer of the tree
-        self.nodes = []
-        # layer 0 (bottom) of the tree is (2^depth) leaf nodes
-        self.nodes.append([MerkleLeaf(self.min_key + ii * self.leaf_size,
-                                      min(self.min_key + (ii + 1) * self.leaf_size,
-                                          max_key),
-                                      initdata)
-                           for ii in xrange(self.num_leaves)])
-        # Each layer >= 1 consists of interior nodes, and is half the size
-        # of the layer below.  Each interior node is built from two nodes below it
-        level = 1
-        while level <= self.depth:
-            self.nodes.append([MerkleBranchNode(self.nodes[level - 1][2 * ii],
-                                                self.nodes[level - 1][2 * ii + 1])
-                               for ii in xrange(len(self.nodes[level - 1]) / 2)])
+        # Only the non-empty leaves have a dict of their contents, and the sum of their
+        # item hashes.
+        self._buckets = {}  # leaf index => {key: value}
+        self._sums = {}  # leaf index => sum of itemhash() values
+        # The Merkle values of the nodes with something stored beneath them; the value for an
+        # empty subtree depends only on its height, so these are not stored.
+        self._digests = {}  # node index => Merkle value
+        self._dirty = set()  # indices of leaves whose Merkle values are out of date
+        self._views = None
+        if initdata is not None:
+            # Keys outside the range of this tree are left out
+            self._load(initdata.iteritems(), skip_outside=True)
+
+    @property
+    def root(self):
+        return self._node(1)
+
+    @property
+    def nodes(self):
+        """Views of the nodes of the tree, as a list of (depth+1) lists, from the leaves up"""
+        if self._views is None:
+            self._views = [[self._node(index) for index in xrange(2 ** (self.depth - level), 2 ** (self.depth - level + 1))]
+                           for level in xrange(self.depth + 1)]
+        return self._views
+
+    def _node(self, index):
+        if index >= self.num_leaves:
+            return MerkleLeaf(self, index)
+        return MerkleBranchNode(self, index)
+
+# PART digests
+    def _digest(self, index):
+        """Return the Merkle value for the node at the given index"""
+        if self._dirty:
+            self._flush()
+        digest = self._digests.get(index)
+        if digest is None:
+            return _empty_digest(self.depth + 1 - index.bit_length())
+        return digest
+
+    def _flush(self):
+        """Recalculate the Merkle values above the changed leaves, each once, from the leaves up"""
+        digests = self._digests
+        indices = set()
+        for leafidx in self._dirty:
+            index = self.num_leaves + leafidx
+            if leafidx in self._sums:
+                digests[index] = _leaf_digest(self._sums[leafidx])
+            else:
+                digests.pop(index, None)
+            indices.add(index // 2)
+        self._dirty = set()
+        indices.discard(0)
+        level = 1  # height above the leaves of the nodes being recalculated
+        while indices:
+            empty = _empty_digest(level - 1)
+            parents = set()
+            for index in indices:
+                # The children of node ii are at 2*ii and 2*ii+1
+                left = digests.get(2 * index)
+                right = digests.get(2 * index + 1)
+                if left is None and right is None:
+                    digests.pop(index, None)
+                else:
+                    digests[index] = hashlib.md5((left or empty) + (right or empty)).digest()
+                parents.add(index // 2)
+            parents.discard(0)
+            indices = parents
             level = level + 1
-        self.root = self.nodes[-1][0]
 
 # PART container
     def _findleaf(self, key):
-        """Return the index of the leaf node corresponding to the given key"""
-        hashval = keyhash(key)
+        """Return the index of the leaf node corresponding to the given key.  Here and in the
+        other container methods, a KeyRef can be used in place of the key."""
+        hashval = self.hashfn.key_token(key)
         if hashval < self.min_key or hashval >= self.max_key:
             raise KeyError("Key %s hashes to value outside range for this tree" % key)
-        return hashval / self.leaf_size
+        return (hashval - self.min_key) / self.leaf_size
 
     def __setitem__(self, key, value):
         leafidx = self._findleaf(key)
-        self.nodes[0][leafidx]._data[key] = value
-        self.nodes[0][leafidx].recalc()
+        key = hashfunc.unwrap(key)
+        bucket = self._buckets.setdefault(leafidx, {})
+        total = self._sums.get(leafidx, 0)
+        if key in bucket:
+            total = total - itemhash(key, bucket[key])
+        bucket[key] = value
+        self._sums[leafidx] = (total + itemhash(key, value)) % _ITEMHASH_MODULUS
+        self._changed(leafidx)
 
     def __delitem__(self, key):
         leafidx = self._findleaf(key)
-        del self.nodes[0][leafidx]._data[key]
-        self.nodes[0][leafidx].recalc()
+        key = hashfunc.unwrap(key)
+        bucket = self._buckets.get(leafidx, {})
+        value = bucket.pop(key)
+        if bucket:
+            self._sums[leafidx] = (self._sums[leafidx] - itemhash(key, value)) % _ITEMHASH_MODULUS
+        else:
+            del self._buckets[leafidx]
+            del self._sums[leafidx]
+        self._changed(leafidx)
+
+    def update(self, other=None, **kwargs):
+        """Store all the items from a dict (or a sequence of (key, value) pairs) and any keyword
+        arguments, as for dict.update(), but with a single recalculation of Merkle values"""
+        if other is not None:
+            if hasattr(other, 'iteritems'):
+                self._load(other.iteritems())
+            elif hasattr(other, 'keys'):
+                self._load((key, other[key]) for key in other.keys())
+            else:
+                self._load(other)
+        if kwargs:
+            self._load(kwargs.iteritems())
+
+    def _load(self, items, skip_outside=False):
+        """Store (key, value) items in bulk: each key is hashed once and dropped straight into its
+        leaf, and the Merkle values are only recalculated once all the items are in"""
+        placed = []  # (leaf index, key, value)
+        for key, value in items:
+            hashval = self.hashfn.key_token(key)
+            if hashval < self.min_key or hashval >= self.max_key:
+                if skip_outside:
+                    continue
+                raise KeyError("Key %s hashes to value outside range for this tree" % key)
+            placed.append(((hashval - self.min_key) / self.leaf_size, hashfunc.unwrap(key), value))
+        # All the keys are in range, so the tree is only changed once nothing can go wrong
+        touched = set()
+        for leafidx, key, value in placed:
+            bucket = self._buckets.get(leafidx)
+            if bucket is None:
+                bucket = self._buckets[leafidx] = {}
+                self._sums[leafidx] = 0
+            total = self._sums[leafidx]
+            if key in bucket:
+                total = total - itemhash(key, bucket[key])
+            bucket[key] = value
+            self._sums[leafidx] = total + itemhash(key, value)
+            touched.add(leafidx)
+        for leafidx in touched:
+            self._sums[leafidx] = self._sums[leafidx] % _ITEMHASH_MODULUS
+        self._dirty.update(touched)
+        if touched and not self.lazy:
+            self._flush()
+
+    def _changed(self, leafidx):
+        self._dirty.add(leafidx)
+        if not self.lazy:
+            self._flush()
 
     def __getitem__(self, key):
         leafidx = self._findleaf(key)
-        return self.nodes[0][leafidx]._data[key]
+        return self._buckets.get(leafidx, {})[hashfunc.unwrap(key)]
 
     def __contains__(self, key):
         leafidx = self._findleaf(key)
-        return (key in self.nodes[0][leafidx]._data)
+        return (hashfunc.unwrap(key) in self._buckets.get(leafidx, {}))
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.itervalues())
 
     def keys(self):
         results = []
-        for leafidx in xrange(self.num_leaves):
-            results.extend(self.nodes[0][leafidx]._data.keys())
+        for leafidx in sorted(self._buckets):
+            results.extend(self._buckets[leafidx].keys())
         return results
 
     def __iter__(self):
-        for leafidx in xrange(self.num_leaves):
-            for key in self.nodes[0][leafidx]._data:
+        for leafidx in sorted(self._buckets):
+            for key in self._buckets[leafidx]:
                 yield key
 
     def iteritems(self):
-        for leafidx in xrange(self.num_leaves):
-            for key, value in self.nodes[0][leafidx]._data.items():
+        for leafidx in sorted(self._buckets):
+            for key, value in self._buckets[leafidx].items():
                 yield (key, value)
 
+# PART diff
+    def same_shape(self, other):
+        """Indicate whether another tree has the same depth, key range and hash function, so that
+        its nodes correspond one-to-one with the nodes of this tree"""
+        shape = (self.depth, self.min_key, self.max_key)
+        return shape == (other.depth, other.min_key, other.max_key) and self.hashfn is other.hashfn
+
+    def leaf_range(self, leafidx):
+        """Return the range of tokens [min_key, max_key) covered by the given leaf"""
+        min_key = self.min_key + leafidx * self.leaf_size
+        return (min_key, min(min_key + self.leaf_size, self.max_key))
+
+    def leaf_items(self, leafidx):
+        """Return a dict holding the items stored in the given leaf"""
+        return dict(self._buckets.get(leafidx, {}))
+
+    def digests(self, indices):
+        """Return a list of (index, Merkle value) for the nodes with the given indices"""
+        return [(index, self._digest(index)) for index in indices]
+
+    def mismatched(self, digests):
+        """Given a list of (index, Merkle value) for nodes of a tree of the same shape, return the
+        indices of the nodes whose values are different in this tree"""
+        return [index for (index, digest) in digests if self._digest(index) != digest]
+
+    def diff(self, other):
+        """Return the list of leaf indices whose contents differ between this tree and another of
+        the same shape.  The trees are compared level by level from the root, going down only
+        into the subtrees whose Merkle values differ, so the work done is proportional to the
+        number of differing leaves rather than to the size of the trees."""
+        if not self.same_shape(other):
+            raise ValueError("Merkle trees of different shapes cannot be compared")
+        indices = [1]
+        while True:
+            indices = self.mismatched(other.digests(indices))
+            if not indices or indices[0] >= self.num_leaves:
+                return [index - self.num_leaves for index in indices]
+            indices = children(indices)
+
+    def diff_ranges(self, other):
+        """Return the list of ranges of tokens [min_key, max_key) of the leaves whose contents
+        differ between this tree and another of the same shape"""
+        return [self.leaf_range(leafidx) for leafidx in self.diff(other)]
+
+# PART pickling
+    def __getstate__(self):
+        # Just keep the data; the Merkle values are recalculated when unpickling
+        return {'depth': self.depth,
+                'min_key': self.min_key,
+                'max_key': self.max_key,
+                'hashfn': self.hashfn.name,
+                'lazy': self.lazy,
+                'data': dict(self.iteritems())}
+
+    def __setstate__(self, state):
+        self.__init__(state['depth'], state['min_key'], state['max_key'], state['data'],
+                      hashfn=state['hashfn'], lazy=state['lazy'])
+
 # PART debugoutput
     def __str__(self):
         result = ""
@@ -157,6 +404,7 @@ class MerkleTree(DictMixin):
 import sys
 import copy
 import random
+import pickle
 import unittest
 
 from testutils import random_3letters
@@ -245,6 +493,170 @@ class MerkleTestCase(unittest.TestCase):
         self.assertFalse('b' in d2)
         self.assertFalse('c' in d2)
 
+    def testPickle(self):
+        x = MerkleTree(4, initdata=self.keystore)
+        data = pickle.dumps(x, 2)
+        self.assertTrue(len(data) < 4096)
+        y = pickle.loads(data)
+        self.assertEqual(dict(y.items()), self.keystore)
+        self.assertEqual(str(y), str(x))
+        # The Merkle values of a restored tree don't depend on the order its items went in
+        z = MerkleTree(4)
+        for (key, value) in sorted(self.keystore.items(), reverse=True):
+            z[key] = value
+        self.assertEqual(str(pickle.loads(pickle.dumps(z, 2))), str(x))
+        y['A'] = 'xyzzy'
+        self.assertNotEqual(y.root.value.hexdigest(), x.root.value.hexdigest())
+
+    def testHashFunction(self):
+        self.assertEqual(keyhash('A'), self.keya)
+        x = MerkleTree(4, initdata=self.keystore, hashfn='crc')
+        self.assertEqual(x.max_key, 2 ** 64 - 1)
+        self.assertEqual(dict(x.items()), self.keystore)
+        for key in self.keystore:
+            self.assertTrue(x.nodes[0][x._findleaf(key)]._inrange(key))
+        self.assertEqual(pickle.loads(pickle.dumps(x, 2)).hashfn, x.hashfn)
+        self.assertNotEqual(str(x), str(MerkleTree(4, initdata=self.keystore)))
+
+    def testKeyRef(self):
+        x = MerkleTree(4, initdata=self.keystore)
+        ref = hashfunc.KeyRef('A')
+        x[ref] = 'xyzzy'
+        self.assertEqual(x._findleaf(ref), x._findleaf('A'))
+        self.assertEqual(x['A'], 'xyzzy')
+        self.assertEqual(x[ref], 'xyzzy')
+        self.assertTrue(ref in x)
+        # The key itself is stored, not the KeyRef
+        self.assertEqual([key for key in x.keys() if isinstance(key, hashfunc.KeyRef)], [])
+        del x[ref]
+        self.assertFalse('A' in x)
+        self.assertEqual(dict(x.items()), self.keystore)
+
+    def testItemHash(self):
+        # Leaf values don't depend on the order the items went in
+        items = self.keystore.items()
+        x = MerkleTree(2)
+        y = MerkleTree(2)
+        for (key, value) in items:
+            x[key] = value
+        for (key, value) in reversed(items):
+            y[key] = value
+        self.assertEqual(str(x), str(y))
+        self.assertEqual(str(x), str(MerkleTree(2, initdata=self.keystore)))
+        # Changing and then restoring a value gives the original leaf values
+        (key, value) = items[0]
+        x[key] = 'xyzzy'
+        self.assertNotEqual(str(x), str(y))
+        x[key] = value
+        self.assertEqual(str(x), str(y))
+        x['extra'] = 1
+        del x['extra']
+        self.assertEqual(str(x), str(y))
+        self.assertEqual(str(MerkleTree(2)), str(MerkleTree(2, initdata={})))
+        for leafidx, bucket in x._buckets.items():
+            self.assertEqual(x._sums[leafidx],
+                             sum(itemhash(key, value) for key, value in bucket.items()) % 2 ** 128)
+
+    def testLazy(self):
+        eager = MerkleTree(6, initdata=self.keystore, lazy=False)
+        lazy = MerkleTree(6, initdata=self.keystore)
+        self.assertEqual(str(lazy), str(eager))
+        for tree in (eager, lazy):
+            tree['A'] = 'xyzzy'
+            tree['B'] = 'plugh'
+        # Only the nodes above the changed leaves are out of date, until the root is used
+        self.assertEqual(lazy._dirty, set([lazy._findleaf('A'), lazy._findleaf('B')]))
+        self.assertEqual(eager._dirty, set())
+        self.assertEqual(lazy.root.value.hexdigest(), eager.root.value.hexdigest())
+        self.assertEqual(lazy._dirty, set())
+        del lazy['A']
+        del eager['A']
+        self.assertEqual(str(lazy), str(eager))
+        self.assertEqual(pickle.loads(pickle.dumps(eager, 2)).lazy, False)
+
+    def testSparse(self):
+        x = MerkleTree()
+        self.assertEqual(x._digests, {})
+        empty_root = x.root.value.hexdigest()
+        self.assertEqual(x.nodes[0][17].value.digest(), x.nodes[0][0].value.digest())
+        x['A'] = 1
+        self.assertEqual(x._buckets.keys(), [x._findleaf('A')])
+        self.assertNotEqual(x.root.value.hexdigest(), empty_root)
+        # Only the nodes on the path from the leaf to the root have their values stored
+        self.assertEqual(len(x._digests), 13)
+        x['B'] = 2
+        self.assertEqual(x.root.value.hexdigest(),
+                         MerkleTree(initdata={'A': 1, 'B': 2}, lazy=False).root.value.hexdigest())
+        del x['B']
+        x.root.value
+        self.assertEqual(len(x._digests), 13)
+        del x['A']
+        self.assertEqual(x._buckets, {})
+        self.assertEqual(x.root.value.hexdigest(), empty_root)
+        self.assertEqual(x._digests, {})
+        # Views of the nodes follow the tree structure
+        leaf = x.nodes[0][5]
+        self.assertEqual(leaf.parent.parent.left.right.index, leaf.index)
+        self.assertEqual(x.root.parent, None)
+        self.assertEqual(leaf.min_key, 5 * x.leaf_size)
+        # Keys outside the range of a tree are left out of it
+        x = MerkleTree(3, self.min_key, self.max_key, self.keystore)
+        for key in self.keystore:
+            self.assertEqual(key in x.keys(), self.min_key <= keyhash(key) < self.max_key)
+            if key in x.keys():
+                self.assertTrue(x.nodes[0][x._findleaf(key)]._inrange(key))
+
+    def testBulk(self):
+        items = [('K%d' % ii, ii) for ii in xrange(300)]
+        single = MerkleTree(4)
+        for (key, value) in items:
+            single[key] = value
+        for lazy in (True, False):
+            self.assertEqual(str(MerkleTree(4, initdata=dict(items), lazy=lazy)), str(single))
+            # Few enough leaves change to go through just the nodes above them
+            few = MerkleTree(8, initdata=dict(items[:5]), lazy=lazy)
+            few.update(items[5:10])
+            few.update(dict(items[10:20]), K20=20)
+            many = MerkleTree(8, lazy=lazy)
+            for (key, value) in items[:21]:
+                many[key] = value
+            self.assertEqual(str(few), str(many))
+        # Updating replaces existing values
+        bulk = MerkleTree(4, initdata=dict(items))
+        bulk.update([('K1', 'xyzzy')])
+        single['K1'] = 'xyzzy'
+        self.assertEqual(str(bulk), str(single))
+        # A key outside the range of the tree leaves it unchanged
+        partial = MerkleTree(2, self.min_key, self.max_key, self.keystore)
+        before = (dict(partial.items()), str(partial))
+        inside = partial.keys()[0]
+        outside = [key for key in self.keystore if key not in partial.keys()][0]
+        self.assertRaises(KeyError, partial.update, [(inside, 'xyzzy'), (outside, 1)])
+        self.assertEqual((dict(partial.items()), str(partial)), before)
+        partial[inside] = 'xyzzy'
+        self.assertEqual(str(partial), str(MerkleTree(2, self.min_key, self.max_key, dict(partial.items()))))
+
+    def testDiff(self):
+        x = MerkleTree(8, initdata=self.keystore)
+        y = MerkleTree(8, initdata=self.keystore)
+        self.assertEqual(x.diff(y), [])
+        y['A'] = 'xyzzy'
+        y['B'] = 'plugh'
+        del y[self.keystore.keys()[0]]
+        changed = sorted(set([x._findleaf('A'), x._findleaf('B'), x._findleaf(self.keystore.keys()[0])]))
+        self.assertEqual(x.diff(y), changed)
+        self.assertEqual(y.diff(x), changed)
+        for (min_key, max_key) in x.diff_ranges(y):
+            self.assertTrue(any(min_key <= keyhash(key) < max_key for key in ('A', 'B', self.keystore.keys()[0])))
+        # Only the nodes above the differing leaves are looked at
+        looked = []
+        digests = y.digests
+        y.digests = lambda indices: looked.extend(indices) or digests(indices)
+        x.diff(y)
+        self.assertTrue(len(looked) <= 1 + 2 * len(changed) * 8)
+        self.assertRaises(ValueError, x.diff, MerkleTree(4))
+        self.assertRaises(ValueError, x.diff, MerkleTree(8, hashfn='crc'))
+
     def test002(self):
         d1 = MerkleTree(initdata={'a': 1, 'b': 2, 'c': 3})
         d2 = MerkleTree(initdata={'a': 1, 'b': 2, 'c': 3})
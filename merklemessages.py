@@ -1,14 +1,16 @@
 """Messages between Merkle nodes"""
+import hashfunc
 from message import Message, ResponseMessage
 
 
 class MerkleRequestMessage(Message):
     """Base class for Merkle request messages; all include the tree config info"""
-    def __init__(self, from_node, to_node, depth, min_key, max_key, msg_id=None):
+    def __init__(self, from_node, to_node, depth, min_key, max_key, hashfn=None, msg_id=None):
         super(MerkleRequestMessage, self).__init__(from_node, to_node, msg_id=msg_id)
         self.depth = depth
         self.min_key = min_key
         self.max_key = max_key
+        self.hashfn = hashfunc.get(hashfn).name  # name of the hash function placing keys in the tree
 
     def __str__(self):
         return "%s |%s| [%s,%s)" % (Message.__str__(self), self.depth, self.min_key, self.max_key)
@@ -21,6 +23,50 @@ class MerkleResponseMessage(ResponseMessage):
         self.depth = req.depth
         self.min_key = req.min_key
         self.max_key = req.max_key
+        self.hashfn = req.hashfn
 
     def __str__(self):
         return "%s |%s| [%s,%s)" % (Message.__str__(self), self.depth, self.min_key, self.max_key)
+
+
+class MerkleCompareReq(MerkleRequestMessage):
+    """Merkle values for some of the nodes at one level of the sender's tree"""
+    def __init__(self, from_node, to_node, depth, min_key, max_key, hashfn, digests, msg_id=None):
+        super(MerkleCompareReq, self).__init__(from_node, to_node, depth, min_key, max_key, hashfn, msg_id=msg_id)
+        self.digests = digests  # list of (node index, Merkle value)
+
+    def __str__(self):
+        return "MerkleCompareReq(%d nodes)" % len(self.digests)
+
+
+class MerkleCompareRsp(MerkleResponseMessage):
+    """Indices of the nodes in a MerkleCompareReq whose values differ in the responder's tree.
+    At the leaf level, also carries the responder's items for the differing leaves."""
+    def __init__(self, req, mismatched, items=None):
+        super(MerkleCompareRsp, self).__init__(req)
+        self.mismatched = mismatched  # list of node indices
+        self.items = items  # None, or leaf index => {key: value}
+
+    def __str__(self):
+        if self.items is None:
+            return "MerkleCompareRsp(%d differ)" % len(self.mismatched)
+        return "MerkleCompareRsp(%d leaves, %d items)" % (len(self.items), _item_count(self.items))
+
+
+class MerkleSyncReq(MerkleRequestMessage):
+    """The sender's items for the leaves found to differ, for the receiver to merge in"""
+    def __init__(self, from_node, to_node, depth, min_key, max_key, hashfn, items, msg_id=None):
+        super(MerkleSyncReq, self).__init__(from_node, to_node, depth, min_key, max_key, hashfn, msg_id=msg_id)
+        self.items = items  # leaf index => {key: value}
+
+    def __str__(self):
+        return "MerkleSyncReq(%d leaves, %d items)" % (len(self.items), _item_count(self.items))
+
+
+class MerkleSyncRsp(MerkleResponseMessage):
+    def __str__(self):
+        return "MerkleSyncRsp"
+
+
+def _item_count(items):
+    return sum(len(leaf_items) for leaf_items in items.itervalues())
@@ -2,16 +2,100 @@
 import logging
 
 import logconfig
-from node import Node
+from node import Node, handles
+from framework import Framework
+from merkle import MerkleTree, children
+from merklemessages import MerkleCompareReq, MerkleCompareRsp, MerkleSyncReq, MerkleSyncRsp
 
 logconfig.init_logging()
-_logger = logging.getLogger('merkle')
+_logger = logging.getLogger('dynamo')
 
 
 # PART merklenode
 class MerkleNode(Node):
-    def __init__(self):
-        super(MerkleNode, self).__init__()
+    """Node holding a key-value store in a MerkleTree, which can bring its store into line with
+    that of another MerkleNode (whose tree has the same shape).
 
-    def rcvmsg(self, msg):
-        pass
+    The two nodes compare their trees a level at a time, starting from the root: each
+    MerkleCompareReq carries the Merkle values for the children of just those nodes that were
+    found to differ at the level above.  Once the leaves that differ are known, the two nodes
+    swap the items in those leaves and merge them in, so the cost of a sync depends on how far
+    the stores have diverged rather than on how much they hold.  Deletions are not tracked, so
+    a key that is held by only one node ends up on both."""
+    def __init__(self, name=None, depth=12, initdata=None, hashfn=None):
+        super(MerkleNode, self).__init__(name)
+        self.store = MerkleTree(depth, initdata=initdata, hashfn=hashfn)
+        self.last_sync = None  # (peer, indices of the leaves that differed) for the last sync started here
+
+    def sync_with(self, peer):
+        """Start bringing the stores of this node and the given peer into line"""
+        self._send_compare(peer, [1])
+
+    def resolve(self, key, mine, theirs):
+        """Return the value to keep for a key that has different values on the two nodes; the
+        result must not depend on which node is which, so both nodes keep the same value"""
+        return max(mine, theirs)
+
+    def _config(self):
+        return (self.store.depth, self.store.min_key, self.store.max_key, self.store.hashfn.name)
+
+    def _matches(self, msg):
+        if (msg.depth, msg.min_key, msg.max_key, msg.hashfn) != self._config():
+            _logger.warning("%s: ignore %s from %s for a differently-shaped tree", self, msg, msg.from_node)
+            return False
+        return True
+
+    def _send_compare(self, peer, indices):
+        (depth, min_key, max_key, hashfn) = self._config()
+        Framework.send_message(MerkleCompareReq(self, peer, depth, min_key, max_key, hashfn, self.store.digests(indices)))
+
+    def _merge(self, items):
+        """Merge in another node's items for some leaves"""
+        updates = []
+        for leaf_items in items.itervalues():
+            for key, value in leaf_items.iteritems():
+                if key not in self.store:
+                    updates.append((key, value))
+                else:
+                    mine = self.store[key]
+                    if mine != value:
+                        updates.append((key, self.resolve(key, mine, value)))
+        self.store.update(updates)
+
+    @handles(MerkleCompareReq)
+    def rcv_compare(self, msg):
+        if not self._matches(msg):
+            return
+        mismatched = self.store.mismatched(msg.digests)
+        items = None
+        if mismatched and mismatched[0] >= self.store.num_leaves:
+            # Down at the leaves, so send our contents of the leaves that differ
+            items = dict((index - self.store.num_leaves, self.store.leaf_items(index - self.store.num_leaves))
+                         for index in mismatched)
+        Framework.send_message(MerkleCompareRsp(msg, mismatched, items))
+
+    @handles(MerkleCompareRsp)
+    def rcv_compare_rsp(self, msg):
+        if not msg.mismatched:
+            _logger.info("%s: store matches %s", self, msg.from_node)
+            self.last_sync = (msg.from_node, [])
+        elif msg.items is None:
+            self._send_compare(msg.from_node, children(msg.mismatched))
+        else:
+            # Send our own items for the differing leaves before merging in the peer's items
+            mine = dict((leafidx, self.store.leaf_items(leafidx)) for leafidx in msg.items)
+            self._merge(msg.items)
+            (depth, min_key, max_key, hashfn) = self._config()
+            Framework.send_message(MerkleSyncReq(self, msg.from_node, depth, min_key, max_key, hashfn, mine))
+            self.last_sync = (msg.from_node, sorted(msg.items))
+
+    @handles(MerkleSyncReq)
+    def rcv_sync(self, msg):
+        if not self._matches(msg):
+            return
+        self._merge(msg.items)
+        Framework.send_message(MerkleSyncRsp(msg))
+
+    @handles(MerkleSyncRsp)
+    def rcv_sync_rsp(self, msg):
+        _logger.info("%s: store synchronized with %s", self, msg.from_node)
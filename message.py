@@ -28,7 +28,9 @@ class NodeAction(Message):
 
 class Timer(Message):
     """Internal message indicating a timer event at a node"""
-    def __init__(self, node, reason, callback=None):
+    def __init__(self, node, reason, callback=None, duration=None):
         super(Timer, self).__init__(node, node)
         self.reason = reason
         self.callback = callback
+        self.duration = duration  # in simulated milliseconds; None for the node's default
+        self.expiry = None  # virtual time at which the timer is due, once it is running in virtual time
@@ -2,12 +2,42 @@
 import logging
 from history import History
 from message import NodeAction
+from simulation import ContextMeta
 _logger = logging.getLogger('dynamo')
 
+# Message handler for each (node class, message class) pair, filled in on first use
+_dispatch = {}
+
+
+def handles(*msg_classes):
+    """Decorator for a Node method that processes messages of the given classes (and their
+    subclasses); Node.rcvmsg() passes such messages on to the method"""
+    def register(method):
+        method.handled_messages = msg_classes
+        return method
+    return register
+
+
+def _resolve_handler(node_class, msg_class):
+    """Find the method of node_class that handles msg_class, and add it to the dispatch table"""
+    handlers = {}  # message class => method name
+    for kls in reversed(node_class.__mro__):  # so subclasses take precedence
+        for name, value in kls.__dict__.items():
+            for handled in getattr(value, 'handled_messages', ()):
+                handlers[handled] = name
+    for kls in msg_class.__mro__:  # most specific message class first
+        if kls in handlers:
+            handler = getattr(node_class, handlers[kls]).im_func
+            _dispatch[(node_class, msg_class)] = handler
+            return handler
+    raise TypeError("Unexpected message type %s" % msg_class)
+
 
 class Node(object):
     """Node that can send and receive messages."""
-    # Class-wide tracking of all Nodes
+    __metaclass__ = ContextMeta
+    __context__ = ('count', 'node', 'name')
+    # Class-wide tracking of all Nodes (within the current Simulation)
     count = 0
     node = {}  # name  -> Node
     name = {}  # Node -> name
@@ -20,14 +50,12 @@ class Node(object):
 
     @classmethod
     def next_name(cls):
-        if cls.count < 26:
-            name = chr(ord('A') + cls.count)
-        elif cls.count < (26 * 26):
-            hi = cls.count / 26
-            lo = cls.count % 26
-            name = chr(ord('A') + hi - 1) + chr(ord('A') + lo)
-        else:
-            raise NotImplemented
+        # A..Z, then AA..ZZ, then AAA..ZZZ, ...
+        count = cls.count
+        name = ''
+        while count >= 0:
+            name = chr(ord('A') + count % 26) + name
+            count = count // 26 - 1
         cls.count = cls.count + 1
         return name
 
@@ -81,8 +109,13 @@ class Node(object):
         return self.next_sequence_number
 
     def rcvmsg(self, msg):
-        """Subclasses need to implement rcvmsg to allow processing of messages"""
-        raise NotImplemented
+        """Process a message, by passing it to the method registered for its class with
+        @handles; subclasses can also override this method altogether"""
+        try:
+            handler = _dispatch[(self.__class__, msg.__class__)]
+        except KeyError:
+            handler = _resolve_handler(self.__class__, msg.__class__)
+        handler(self, msg)
 
     def timer_pop(self, reason=None):
         """Subclasses need to implement rcvmsg to allow processing of timer pops"""
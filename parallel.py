@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+"""Conservative parallel simulation: the nodes of one simulated network shared out among worker processes"""
+import sys
+import zlib
+import heapq
+import random
+import logging
+import weakref
+import traceback
+import cPickle
+import cStringIO
+import multiprocessing
+
+from node import Node
+from message import Message
+from framework import Framework
+from eventqueue import EventQueue
+import simulation
+
+_logger = logging.getLogger('dynamo')
+
+# No limit on the number of messages or timers to process in one go
+_UNLIMITED = sys.maxint
+
+
+# PART ownership
+def default_owner(name, partitions):
+    """Assign a node to one of the partitions, by hashing its name"""
+    return (zlib.crc32(name) & 0xffffffff) % partitions
+
+
+class _LocalNodes(dict):
+    """Dict of node => whether this partition owns it, filled in on first lookup"""
+    def __init__(self, owner, index, partitions):
+        super(_LocalNodes, self).__init__()
+        self.owner = owner
+        self.index = index
+        self.partitions = partitions
+
+    def __missing__(self, node):
+        local = (self.owner(node.name, self.partitions) == self.index)
+        self[node] = local
+        return local
+
+
+class NodeRef(object):
+    """Reference to a node by name, for use outside the processes that hold the nodes"""
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+# PART pickling
+# Messages are copied from one process to another, but a message that comes back to the process
+# it started from (say as the response_to of a response) needs to be the same object as before,
+# so it can be found in Framework.pending_timers.  So keep track of the messages that have been
+# copied, by their origin (the originating node and its event count, which is unique).
+_messages = weakref.WeakValueDictionary()  # origin => message
+
+
+def _persistent_id(obj):
+    if isinstance(obj, (Node, NodeRef)):
+        return ('node', obj.name)
+    if isinstance(obj, Message) and 'origin' in obj.__dict__:
+        _messages[obj.origin] = obj
+        return ('msg', obj.origin, obj.__class__, obj.__dict__)
+    return None
+
+
+def _persistent_load(pid):
+    if pid[0] == 'node':
+        node = Node.node.get(pid[1])
+        if node is None:
+            return NodeRef(pid[1])
+        return node
+    (_, origin, cls, state) = pid
+    msg = _messages.get(origin)
+    if msg is None:
+        msg = cls.__new__(cls)
+        msg.__dict__.update(state)
+        _messages[origin] = msg
+    return msg
+
+
+def dumps(obj):
+    """Pickle obj, with nodes replaced by their names"""
+    out = cStringIO.StringIO()
+    pickler = cPickle.Pickler(out, 2)
+    pickler.persistent_id = _persistent_id
+    pickler.dump(obj)
+    return out.getvalue()
+
+
+def loads(data):
+    """Unpickle data produced by dumps(), with node names resolved in the current Simulation"""
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = _persistent_load
+    return unpickler.load()
+
+
+def _invoke(node, method, *args):
+    return getattr(node, method)(*args)
+
+
+# PART driver
+class _Driver(object):
+    """Commands to run at given points in virtual time"""
+    def __init__(self):
+        self.commands = []  # heap of (time, seqno, node name or None, func, args)
+        self.seqno = 0
+
+    def node(self, name):
+        """Return a reference to the named node, for use in command arguments"""
+        return NodeRef(name)
+
+    def at(self, when, node, method, *args):
+        """At virtual time when, call node.method(*args); node is a name or NodeRef"""
+        self._add(when, str(node), _invoke, (NodeRef(str(node)), method) + args)
+
+    def at_all(self, when, func, *args):
+        """At virtual time when, call func(*args) in every process; func must be picklable,
+        and NodeRefs in args are converted to the corresponding nodes"""
+        self._add(when, None, func, args)
+
+    def _add(self, when, name, func, args):
+        self.seqno = self.seqno + 1
+        heapq.heappush(self.commands, (when, self.seqno, name, func, dumps(args)))
+
+    def _due(self, until):
+        """Return the time of the next command, if there is one due by until"""
+        if self.commands and self.commands[0][0] <= until:
+            return self.commands[0][0]
+        return None
+
+    def _pop_due(self, when):
+        """Remove and return the commands for the given time"""
+        due = []
+        while self.commands and self.commands[0][0] == when:
+            due.append(heapq.heappop(self.commands))
+        return due
+
+
+class SequentialSimulation(_Driver):
+    """Simulation built and driven in the same way as a ParallelSimulation, but run as a single
+    Simulation in this process; this gives the reference results for a ParallelSimulation."""
+    def __init__(self, build, args=(), lookahead=1, seed=None):
+        super(SequentialSimulation, self).__init__()
+        self.sim = simulation.Simulation(seed)
+        with self.sim:
+            Framework.set_latency(lookahead)
+            build(*args)
+
+    def run(self, until):
+        """Run the simulation up to virtual time until, including any commands due by then"""
+        with self.sim:
+            when = self._due(until)
+            while when is not None:
+                Framework.schedule(_UNLIMITED, _UNLIMITED, until=when)
+                for (_, _, _, func, args) in self._pop_due(when):
+                    func(*loads(args))
+                when = self._due(until)
+            Framework.schedule(_UNLIMITED, _UNLIMITED, until=until)
+
+    def collect(self, func, *args):
+        """Return a list holding func(*args), as run in the Simulation"""
+        with self.sim:
+            return [func(*loads(dumps(args)))]
+
+
+class ParallelSimulation(_Driver):
+    """Simulation whose nodes are shared out among worker processes, each with its own EventQueue.
+
+    Every worker runs build(*args) to create the complete set of nodes, but only simulates the
+    nodes that owner(name, partitions) assigns to it; messages for nodes in other workers are
+    passed on in batches.  Synchronization is conservative: no message between workers can take
+    less than lookahead simulated milliseconds, so once the earliest pending event anywhere is at
+    time T, every worker can safely process all of its events before T + lookahead.
+
+    Simultaneous events are ordered by the nodes that originated them (see EventQueue), so the
+    results are the same as for a SequentialSimulation, provided that the nodes only interact
+    through messages (so in particular they must not use the shared random number generator)."""
+    def __init__(self, build, args=(), partitions=2, lookahead=1, seed=None, owner=default_owner, quiet=True):
+        super(ParallelSimulation, self).__init__()
+        if lookahead <= 0:
+            raise ValueError("Parallel simulation needs a positive lookahead")
+        self.partitions = partitions
+        self.lookahead = lookahead
+        self.owner = owner
+        self.inbox = [[] for _ in xrange(partitions)]  # batches of events for each worker
+        self.conns = []
+        self.workers = []
+        for index in xrange(partitions):
+            (conn, worker_conn) = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker,
+                                             args=(worker_conn, index, partitions, owner, lookahead, seed, quiet,
+                                                   build, args))
+            worker.daemon = True
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        self._collect_replies(range(partitions))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes"""
+        for conn in self.conns:
+            try:
+                conn.send(('stop', None))
+            except IOError:
+                pass  # worker has already gone
+        for worker in self.workers:
+            worker.join()
+        self.conns = []
+        self.workers = []
+
+    def _request(self, requests):
+        """Send each worker its (op, payload) request from the dict, and return a dict of the
+        results; events that the workers generate for one another are added to the inboxes"""
+        for index, request in requests.items():
+            self.conns[index].send(request)
+        return self._collect_replies(requests.keys())
+
+    def _collect_replies(self, indices):
+        results = {}
+        for index in indices:
+            (ok, result, outbox) = self.conns[index].recv()
+            if not ok:
+                raise RuntimeError("Worker %d failed:\n%s" % (index, result))
+            for dest, batch in outbox.items():
+                self.inbox[dest].append(batch)
+            results[index] = result
+        return results
+
+    def _deliver(self):
+        """Pass on all batched events, returning the time of the earliest event in any worker"""
+        requests = {}
+        for index in xrange(self.partitions):
+            requests[index] = ('deliver', self.inbox[index])
+            self.inbox[index] = []
+        times = [when for when in self._request(requests).values() if when is not None]
+        if times:
+            return min(times)
+        return None
+
+    def _window(self, start, until=None, before=None):
+        self._request(dict((index, ('run', (start + self.lookahead, until, before)))
+                           for index in xrange(self.partitions)))
+
+    def run(self, until):
+        """Run the simulation up to virtual time until, including any commands due by then"""
+        while True:
+            bound = self._due(until)
+            if bound is None:
+                bound = until
+            start = self._deliver()
+            if start is not None and start <= bound:
+                if start + self.lookahead <= bound:
+                    self._window(start, before=start + self.lookahead)
+                else:
+                    self._window(start, until=bound)
+                continue
+            # Nothing more to do before bound, so bring all the workers up to that time
+            self._window(bound, until=bound)
+            due = self._pop_due(bound)
+            if not due:
+                return
+            for (when, _, name, func, args) in due:
+                if name is None:
+                    indices = range(self.partitions)
+                else:
+                    indices = [self.owner(name, self.partitions)]
+                self._request(dict((index, ('call', (func, args))) for index in indices))
+
+    def collect(self, func, *args):
+        """Run func(*args) in every worker, returning a list of the results"""
+        results = self._request(dict((index, ('call', (func, dumps(args))))
+                                     for index in xrange(self.partitions)))
+        return [loads(results[index]) for index in xrange(self.partitions)]
+
+
+# PART worker
+def _worker(conn, index, partitions, owner, lookahead, seed, quiet, build, args):
+    if quiet:
+        logging.getLogger('dynamo').setLevel(logging.WARNING)
+    outbox = {}
+    try:
+        with simulation.Simulation(seed):
+            EventQueue.local_nodes = _LocalNodes(owner, index, partitions)
+            Framework.set_latency(lookahead)
+            build(*args)
+            outbox = _take_outbox(owner, partitions, lookahead)
+            conn.send((True, None, outbox))
+            while True:
+                (op, payload) = conn.recv()
+                if op == 'stop':
+                    break
+                if op == 'run':
+                    horizon = payload[0]
+                else:
+                    horizon = EventQueue.now + lookahead
+                result = _OPS[op](payload)
+                conn.send((True, result, _take_outbox(owner, partitions, horizon)))
+    except Exception:
+        conn.send((False, traceback.format_exc(), {}))
+    conn.close()
+
+
+def _take_outbox(owner, partitions, horizon):
+    """Remove the events for other workers from the EventQueue outbox, checking that none of
+    them is due before the horizon, and return them as a dict of worker index => batch"""
+    batches = {}
+    for (key, event) in EventQueue.outbox:
+        if key[0] < horizon:
+            raise ValueError("Message %s->%s at %s is within the lookahead" % (event.from_node, event.to_node, key[0]))
+        batches.setdefault(owner(event.to_node.name, partitions), []).append((key, event))
+    EventQueue.outbox = []
+    return dict((dest, dumps(batch)) for dest, batch in batches.items())
+
+
+def _op_deliver(batches):
+    for batch in batches:
+        for (key, event) in loads(batch):
+            EventQueue.insert(key, event)
+    if EventQueue.events:
+        return EventQueue.peek()[0]
+    return None
+
+
+def _op_run(window):
+    (_, until, before) = window
+    Framework.schedule(_UNLIMITED, _UNLIMITED, until=until, before=before)
+
+
+def _op_call(command):
+    (func, args) = command
+    return dumps(func(*loads(args)))
+
+
+_OPS = {'deliver': _op_deliver,
+        'run': _op_run,
+        'call': _op_call}
+
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+from history import History
+import dynamo
+
+
+def build_cluster(node_count, client_count):
+    for _ in xrange(node_count):
+        dynamo.DynamoNode()
+    for ii in xrange(client_count):
+        dynamo.DynamoClientNode('c%d' % ii)
+    # One slow link
+    Framework.set_latency(3, Node.node['A'], Node.node['B'])
+
+
+def cut(from_nodes, to_nodes):
+    Framework.cut_wires(from_nodes, to_nodes)
+
+
+def set_latency(latency):
+    Framework.set_latency(latency)
+
+
+def results():
+    """Summary of the nodes simulated in this process"""
+    local = [node for node in Node.node.values() if EventQueue.is_local(node)]
+    return {'contents': dict((node.name, sorted(node.get_contents())) for node in local),
+            'sent': len([action for (action, _) in History.history if action in ('send', 'forward')]),
+            'response_times': sorted([(kls.__name__, elapsed)
+                                      for kls, elapsed_list in Framework.response_times.items()
+                                      for elapsed in elapsed_list]),
+            'now': EventQueue.now}
+
+
+def merge(parts):
+    merged = {'contents': {}, 'sent': 0, 'response_times': [], 'now': set()}
+    for part in parts:
+        merged['contents'].update(part['contents'])
+        merged['sent'] += part['sent']
+        merged['response_times'].extend(part['response_times'])
+        merged['now'].add(part['now'])
+    merged['response_times'].sort()
+    return merged
+
+
+def script(sim):
+    """Drive a simulation: client operations on fixed coordinators, with a failure and a cut"""
+    for ii in xrange(30):
+        client = 'c%d' % (ii % 2)
+        dest = sim.node('ABDEFGH'[ii % 7])
+        if ii % 3 == 2:
+            sim.at(ii * 4, client, 'get', 'K%d' % (ii % 5), dest)
+        else:
+            sim.at(ii * 4, client, 'put', 'K%d' % (ii % 5), [None], ii, dest)
+    sim.at(20, 'C', 'fail')
+    sim.at(300, 'C', 'recover')
+    sim.at_all(50, cut, [sim.node('D')], [sim.node('E')])
+
+
+class ParallelTestCase(unittest.TestCase):
+    """Test parallel simulation"""
+
+    def testOwnership(self):
+        with simulation.Simulation():
+            names = [Node.next_name() for _ in xrange(1000)]
+        self.assertEqual(names[676], 'ZA')
+        self.assertEqual(names[702], 'AAA')
+        counts = [0, 0, 0]
+        for name in names:
+            counts[default_owner(name, 3)] += 1
+        self.assertEqual(sum(counts), 1000)
+        self.assertTrue(min(counts) > 200)
+
+    def testPickling(self):
+        with simulation.Simulation():
+            Framework.set_latency(1)
+            (a, b) = (Node(), Node())
+            msg = Message(a, b)
+            Framework.send_message(msg, expect_reply=False)
+            copied = loads(dumps([msg, msg]))
+            self.assertTrue(copied[0] is msg)  # copied back to where it came from
+            self.assertTrue(copied[1] is msg)
+            self.assertTrue(loads(dumps(a)) is a)
+        self.assertEqual(str(loads(dumps(a))), 'A')
+
+    def testIdenticalResults(self):
+        expected = SequentialSimulation(build_cluster, (8, 2))
+        script(expected)
+        expected.run(1000)
+        expected = merge(expected.collect(results))
+        self.assertEqual(expected['now'], set([1000]))
+        self.assertTrue(expected['response_times'])
+        for partitions in (1, 3):
+            with ParallelSimulation(build_cluster, (8, 2), partitions=partitions) as psim:
+                script(psim)
+                psim.run(1000)
+                actual = merge(psim.collect(results))
+            self.assertEqual(actual, expected)
+
+    def testLookahead(self):
+        with ParallelSimulation(build_cluster, (8, 2), partitions=2, lookahead=2) as psim:
+            psim.at_all(0, set_latency, 1)
+            psim.at(0, 'c0', 'put', 'K1', [None], 1, psim.node('A'))
+            self.assertRaises(RuntimeError, psim.run, 100)
+
+
+if __name__ == "__main__":
+    ii = 1
+    while ii < len(sys.argv):  # pragma: no cover
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
+        else:
+            ii += 1
+    unittest.main()
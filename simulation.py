@@ -0,0 +1,161 @@
+"""Simulation contexts, each holding the complete state of one simulated network"""
+import zlib
+import types
+import random
+import cPickle
+import threading
+import cStringIO
+
+
+class Simulation(object):
+    """The state of one simulated network: queued messages, timers, history, the registry of
+    nodes and the consistent hash rings of the Dynamo implementations.
+
+    That state is held in class attributes of the various classes involved (Framework.queue,
+    History.history, Node.node, DynamoNode.chash, ...), but these attributes are looked up in
+    the Simulation that is current for the calling thread.  Unless another Simulation has been
+    made current with
+
+        with sim:
+            ...
+
+    the current Simulation is a single process-wide default, so existing code carries on
+    working unchanged.  Separate Simulations are completely independent, so can be run in
+    different threads at the same time."""
+    def __init__(self, seed=None):
+        self.state = {}  # (class, attribute name) => value
+        self.rng = random.Random(seed)  # random number generator for use within the simulation
+
+    def __enter__(self):
+        _local.stack.append(self)
+        _local.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = _local.stack
+        stack.pop()
+        _local.current = stack[-1] if stack else _default
+
+    def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) with this Simulation current, returning the result"""
+        with self:
+            return func(*args, **kwargs)
+
+    def reset(self):
+        """Discard all state; each class re-initializes its state with reset() on next use"""
+        self.state = {}
+
+    def snapshot(self):
+        """Return a compressed pickle of the complete state of this Simulation (including the
+        state of its random number generator), from which restore() builds an independent copy.
+        Timer callbacks have to be picklable; bound methods are fine, lambdas are not."""
+        out = cStringIO.StringIO()
+        pickler = cPickle.Pickler(out, 2)
+        pickler.persistent_id = _persistent_id
+        pickler.dump((self.state, self.rng.getstate()))
+        return zlib.compress(out.getvalue())
+
+
+def restore(snapshot):
+    """Return a new Simulation holding the state captured by Simulation.snapshot()"""
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(zlib.decompress(snapshot)))
+    unpickler.persistent_load = _persistent_load
+    (state, rng_state) = unpickler.load()
+    sim = Simulation()
+    sim.state = state
+    sim.rng.setstate(rng_state)
+    return sim
+
+
+def _persistent_id(obj):
+    # Bound methods (such as timer callbacks) don't pickle, so record the object and method name
+    if isinstance(obj, types.MethodType):
+        return ('method', obj.im_self, obj.im_func.__name__)
+    return None
+
+
+def _persistent_load(pid):
+    (_, obj, name) = pid
+    return getattr(obj, name)
+
+
+# Default simulation, whose random number generator is the one behind the random module
+_default = Simulation()
+_default.rng = random
+
+
+class _Local(threading.local):
+    """The Simulations made current in one thread.  The innermost one is also kept on its own,
+    as it is looked up on every access to simulation state."""
+    def __init__(self):
+        self.stack = []  # Simulations entered with 'with', innermost last
+        self.current = _default
+
+
+_local = _Local()
+
+
+def current():
+    """Return the Simulation that is current for this thread"""
+    return _local.current
+
+
+def default():
+    """Return the process-wide default Simulation"""
+    return _default
+
+
+def rng():
+    """Return the random number generator for the current Simulation"""
+    return current().rng
+
+
+class _ContextAttribute(object):
+    """Descriptor that redirects a class attribute to the current Simulation"""
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.key = (owner, name)
+        self.marker = (owner, None)  # present in the state once the owner class has been reset
+
+    def _initialize(self, state):
+        if self.marker not in state:
+            # First use of this class in this Simulation
+            state[self.marker] = True
+            self.owner.reset()
+
+    def __get__(self, cls, meta):
+        state = _local.current.state
+        try:
+            return state[self.key]
+        except KeyError:
+            self._initialize(state)
+            if self.key not in state:
+                raise AttributeError("%s.reset() does not set %s" % (self.owner.__name__, self.name))
+            return state[self.key]
+
+    def __set__(self, cls, value):
+        state = _local.current.state
+        if self.marker not in state:
+            self._initialize(state)
+        state[self.key] = value
+
+
+class ContextMeta(type):
+    """Metaclass for classes that keep simulation state in class attributes.
+
+    A class using this metaclass lists the names of those attributes in __context__, and its
+    reset() class method must set all of them.  Any values given for them in the class body
+    are for documentation only; the state in each Simulation starts off as set by reset()."""
+    def __new__(mcs, name, bases, dct):
+        attrs = dct.get('__context__', ())
+        if attrs:
+            # Data descriptors for class attributes have to live in the metaclass, so each
+            # class with context attributes gets its own metaclass to hold them.
+            mcs = type('%sMeta' % name, (mcs,), {})
+            for attr in attrs:
+                dct.pop(attr, None)
+        cls = type.__new__(mcs, name, bases, dct)
+        for attr in attrs:
+            setattr(mcs, attr, _ContextAttribute(cls, attr))
+        return cls
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""Parameter sweeps: run many Dynamo simulations across a process pool and tabulate the results"""
+import sys
+import math
+import random
+import logging
+import itertools
+import multiprocessing
+
+from framework import Framework
+from history import History
+from eventqueue import EventQueue
+from timer import DEFAULT_DURATION
+import simulation
+from dynamomessages import ClientPut, ClientGet, ClientGetRsp
+import dynamo
+
+_logger = logging.getLogger('dynamo')
+
+# Configuration settings that can be swept, with their default values
+DEFAULT_CONFIG = {'nodes': 6,  # Number of DynamoNodes in the cluster
+                  'N': dynamo.DynamoNode.N,
+                  'R': dynamo.DynamoNode.R,
+                  'W': dynamo.DynamoNode.W,
+                  'T': dynamo.DynamoNode.T,
+                  'latency': 1}  # One-way message delay, in simulated milliseconds
+# Settings that are DynamoNode class constants
+NODE_SETTINGS = ('N', 'R', 'W', 'T')
+# Columns of the result table, in display order
+COLUMNS = ('run', 'nodes', 'N', 'R', 'W', 'T', 'latency', 'workload', 'failures', 'seed',
+           'ops', 'success', 'messages', 'siblings', 'mean_ms', 'p99_ms')
+
+
+class Workload(object):
+    """Client operations to run against a cluster: ops operations spread across the given
+    number of clients and keys, one every interval simulated milliseconds, of which
+    get_fraction are Gets and the rest are Puts."""
+    def __init__(self, name, ops=100, clients=1, keys=10, get_fraction=0.5, interval=5):
+        self.name = name
+        self.ops = ops
+        self.clients = clients
+        self.keys = keys
+        self.get_fraction = get_fraction
+        self.interval = interval
+
+    def __str__(self):
+        return self.name
+
+
+class FailureSchedule(object):
+    """Node failures and recoveries during a run, as a list of (time, action, node index)
+    tuples, where action is 'fail' or 'recover'"""
+    def __init__(self, name, events=()):
+        self.name = name
+        self.events = sorted(events)
+
+    def __str__(self):
+        return self.name
+
+
+NO_FAILURES = FailureSchedule("none")
+
+
+# PART sweepclient
+class SweepClient(dynamo.DynamoClientNode):
+    """Client that tracks the outcome of each operation, and keeps the most recent
+    metadata for each key to use as the context for its next Put"""
+    def __init__(self, name=None):
+        super(SweepClient, self).__init__(name)
+        self.op_of = {}  # request message => operation index
+        self.started = {}  # operation index => start time
+        self.latency = {}  # operation index => time to first response
+        self.siblings = []  # number of values in each Get response
+        self.context = {}  # key => list of metadata
+
+    def start_op(self, op, key, is_get, value):
+        self.started[op] = EventQueue.now
+        if is_get:
+            msg = self.get(key)
+        else:
+            msg = self.put(key, self.context.get(key, [None]), value)
+        self.op_of[msg] = op
+
+    def rsp_timer_pop(self, reqmsg):
+        # Retry as for DynamoClientNode, but keep track of the operation
+        if isinstance(reqmsg, ClientPut):
+            msg = self.put(reqmsg.keyref, [reqmsg.metadata], reqmsg.value)
+        elif isinstance(reqmsg, ClientGet):
+            msg = self.get(reqmsg.keyref)
+        else:
+            return
+        self.op_of[msg] = self.op_of[reqmsg]
+
+    def rcvmsg(self, msg):
+        super(SweepClient, self).rcvmsg(msg)
+        reqmsg = msg.response_to
+        op = self.op_of.get(getattr(reqmsg, 'original_msg', reqmsg))
+        if op is None or op in self.latency:
+            return  # response to a superseded request
+        self.latency[op] = EventQueue.now - self.started[op]
+        if isinstance(msg, ClientGetRsp):
+            self.siblings.append(len(msg.value))
+            self.context[msg.key] = msg.metadata
+        else:
+            self.context[msg.key] = [msg.metadata]
+
+
+# PART runone
+def run_one(spec):
+    """Run a single simulation, described by a (run index, config, workload, failures, seed)
+    tuple, and return a dict of its results"""
+    (run, config, workload, failures, seed) = spec
+    saved = dict((setting, getattr(dynamo.DynamoNode, setting)) for setting in NODE_SETTINGS)
+    try:
+        for setting in NODE_SETTINGS:
+            setattr(dynamo.DynamoNode, setting, config[setting])
+        sim = simulation.Simulation(seed)
+        return sim.run(_run_workload, run, config, workload, failures, seed)
+    finally:
+        for setting, value in saved.items():
+            setattr(dynamo.DynamoNode, setting, value)
+
+
+def _run_workload(run, config, workload, failures, seed):
+    rng = simulation.rng()
+    Framework.set_latency(config['latency'])
+    nodes = [dynamo.DynamoNode() for _ in xrange(config['nodes'])]
+    clients = [SweepClient('c%d' % ii) for ii in xrange(workload.clients)]
+    keys = ['K%d' % ii for ii in xrange(workload.keys)]
+    events = []  # (time, order, action)
+    for op in xrange(workload.ops):
+        events.append((op * workload.interval, 1, ('op', op)))
+    for (when, action, node_index) in failures.events:
+        events.append((when, 0, (action, node_index)))
+    events.sort()
+    for (when, _, (action, arg)) in events:
+        Framework.schedule(until=when)
+        if action == 'op':
+            client = clients[arg % len(clients)]
+            client.start_op(arg, rng.choice(keys), rng.random() < workload.get_fraction, arg)
+        elif action == 'fail':
+            nodes[arg].fail()
+        elif action == 'recover':
+            nodes[arg].recover()
+        else:
+            raise ValueError("Unknown failure action %s" % action)
+    # Allow time for stragglers and retries
+    Framework.schedule(until=EventQueue.now + 20 * DEFAULT_DURATION)
+
+    latencies = sorted(itertools.chain(*[c.latency.values() for c in clients]))
+    siblings = list(itertools.chain(*[c.siblings for c in clients]))
+    row = dict(config)
+    row.update({'run': run,
+                'workload': str(workload),
+                'failures': str(failures),
+                'seed': seed,
+                'ops': workload.ops,
+                'success': float(len(latencies)) / workload.ops,
+                'messages': len([action for (action, _) in History.history if action in ('send', 'forward')]),
+                'siblings': _mean(siblings),
+                'mean_ms': _mean(latencies),
+                'p99_ms': _percentile(latencies, 99)})
+    return row
+
+
+def _mean(values):
+    if not values:
+        return None
+    return float(sum(values)) / len(values)
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(len(sorted_values) * percent / 100.0)) - 1)]
+
+
+# PART sweep
+def configurations(grid):
+    """Expand a grid of {setting: [values]} into a list of complete configurations"""
+    settings = sorted(grid.keys())
+    for setting in settings:
+        if setting not in DEFAULT_CONFIG:
+            raise KeyError("Unknown setting %s" % setting)
+    results = []
+    for values in itertools.product(*[grid[setting] for setting in settings]):
+        config = dict(DEFAULT_CONFIG)
+        config.update(zip(settings, values))
+        results.append(config)
+    return results
+
+
+def _quiet():
+    """Pool initializer: keep per-message logging out of sweep runs"""
+    logging.getLogger('dynamo').setLevel(logging.WARNING)
+
+
+def sweep(grid, workloads, failure_schedules=(NO_FAILURES,), repeats=1, seed=0, processes=None):
+    """Run every combination of configuration (from grid), workload and failure schedule,
+    repeats times each, and return a list of result dicts in run order.
+
+    Each run gets its own seed, derived from the overall seed and the run's position in the
+    sweep, so results do not depend on how runs are shared out among the worker processes.
+    If processes is 0, the runs happen serially in this process."""
+    specs = []
+    for config in configurations(grid):
+        for workload in workloads:
+            for failures in failure_schedules:
+                for _ in xrange(repeats):
+                    run = len(specs)
+                    specs.append((run, config, workload, failures, seed * 1000003 + run))
+    if processes == 0:
+        return [run_one(spec) for spec in specs]
+    pool = multiprocessing.Pool(processes, initializer=_quiet)
+    try:
+        return pool.map(run_one, specs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def format_table(rows, columns=COLUMNS):
+    """Format a list of result dicts as a text table"""
+    def fmt(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return '%.2f' % value
+        return str(value)
+    cells = [list(columns)] + [[fmt(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(line[ii]) for line in cells) for ii in xrange(len(columns))]
+    return '\n'.join(' '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+TEST_GRID = {'R': [1, 2], 'W': [2], 'T': [5]}
+TEST_WORKLOAD = Workload("small", ops=30, clients=2, keys=4)
+TEST_FAILURES = FailureSchedule("fail1", [(20, 'fail', 1), (100, 'recover', 1)])
+
+
+class SweepTestCase(unittest.TestCase):
+    """Test parameter sweeps"""
+
+    def testConfigurations(self):
+        configs = configurations({'N': [2, 3], 'T': [5, 10, 20]})
+        self.assertEqual(len(configs), 6)
+        self.assertEqual(set((config['N'], config['T']) for config in configs),
+                         set(itertools.product((2, 3), (5, 10, 20))))
+        self.assertEqual(configs[0]['R'], DEFAULT_CONFIG['R'])
+        self.assertRaises(KeyError, configurations, {'X': [1]})
+
+    def testDeterministic(self):
+        serial = sweep(TEST_GRID, [TEST_WORKLOAD], [NO_FAILURES, TEST_FAILURES], seed=3, processes=0)
+        pooled = sweep(TEST_GRID, [TEST_WORKLOAD], [NO_FAILURES, TEST_FAILURES], seed=3, processes=2)
+        self.assertEqual(serial, pooled)
+        self.assertEqual([row['run'] for row in serial], range(4))
+        for row in serial:
+            self.assertEqual(row['ops'], 30)
+            self.assertTrue(row['messages'] > 0)
+            if row['failures'] == 'none':
+                self.assertEqual(row['success'], 1.0)
+        print
+        print format_table(serial)
+        # Class constants are restored after each run
+        self.assertEqual(dynamo.DynamoNode.T, DEFAULT_CONFIG['T'])
+
+
+if __name__ == "__main__":
+    ii = 1
+    while ii < len(sys.argv):  # pragma: no cover
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
+        else:
+            ii += 1
+    unittest.main()
@@ -6,17 +6,24 @@ import locale
 import random
 import unittest
 import logging
+import threading
 
 # Wrap sys.stdout into a StreamWriter to allow writing unicode.
 sys.stdout = codecs.getwriter(locale.getpreferredencoding())(sys.stdout)
 
 from framework import Framework, reset_all
-from node import Node
+from node import Node, handles
 from history import History
+from timer import TimerManager, TimerHeap, TimerWheel
+from eventqueue import EventQueue
 import history
+import hashfunc
 import logconfig
+import simulation
 
 import dynamomessages
+import merklemessages
+from merklenode import MerkleNode
 import dynamo1
 import dynamo2
 import dynamo3
@@ -329,6 +336,130 @@ class SimpleTestCase(unittest.TestCase):
         Framework.schedule(timers_to_process=3)
         return all_nodes
 
+    def test_cancel_timers(self):
+        (A, B, C) = [dynamo2.DynamoNode() for _ in range(3)]
+        reqs = [dynamomessages.GetReq(A, B, 'K1'),
+                dynamomessages.GetReq(A, C, 'K1'),
+                dynamomessages.GetReq(B, C, 'K1'),
+                dynamomessages.GetReq(A, C, 'K2'),
+                dynamomessages.GetReq(C, A, 'K2')]
+        for req in reqs:
+            Framework.send_message(req)
+        self.assertEqual(TimerManager.pending_count(), 5)
+        Framework.remove_req_timer(reqs[0])
+        self.assertEqual(Framework.cancel_timers_to(B), [])
+        self.assertEqual(Framework.cancel_timers_to(C, B), [reqs[2]])
+        self.assertEqual(Framework.cancel_timers_to(C), [reqs[1], reqs[3]])
+        self.assertEqual(Framework.cancel_timers_to(C), [])
+        self.assertEqual(Framework.cancel_timers_from(A), [])
+        self.assertEqual(Framework.cancel_timers_from(C), [reqs[4]])
+        self.assertEqual(TimerManager.pending_count(), 0)
+        self.assertEqual(Framework.pending_timers, {})
+        self.assertEqual(Framework.timers_to, {A: {}, B: {}, C: {}})
+        self.assertEqual(Framework.timers_from, {A: {}, B: {}, C: {}})
+
+    def test_key_hashed_once(self):
+        hashed = []
+        md5 = hashfunc.get('md5')
+        hashfunc.register(hashfunc.HashFunction('counted', lambda data: hashed.append(data) or md5.digest(data), 128))
+        saved = dynamo99.DynamoNode.HASH
+        dynamo99.DynamoNode.HASH = 'counted'
+        try:
+            with simulation.Simulation(seed=1):  # leave the default random number sequence alone
+                for _ in range(6):
+                    dynamo99.DynamoNode()
+                a = dynamo99.DynamoClientNode('a')
+                a.put('K1', [None], 1)
+                Framework.schedule(timers_to_process=0)
+                a.get('K1')
+                Framework.schedule(timers_to_process=0)
+        finally:
+            dynamo99.DynamoNode.HASH = saved
+        self.assertEqual(a.last_msg.value, [1])
+        # Once for the put and once for the get, however many nodes the requests visit
+        self.assertEqual(hashed.count('K1'), 2)
+
+    def test_fixed_partitions(self):
+        saved = dynamo99.DynamoNode.Q
+        dynamo99.DynamoNode.Q = 64
+        try:
+            with simulation.Simulation(seed=1):
+                for _ in range(6):
+                    dynamo99.DynamoNode()
+                self.assertEqual(len(set(dynamo99.DynamoNode.chash.owner)), 6)
+                a = dynamo99.DynamoClientNode('a')
+                a.put('K1', [None], 1)
+                Framework.schedule(timers_to_process=0)
+                a.get('K1')
+                Framework.schedule(timers_to_process=0)
+                self.assertEqual(a.last_msg.value, [1])
+                holders = [node for node in dynamo99.DynamoNode.nodelist if 'K1' in node.local_store]
+                self.assertEqual(set(holders), set(dynamo99.DynamoNode.chash.find_nodes('K1', 3)[0]))
+        finally:
+            dynamo99.DynamoNode.Q = saved
+
+    def test_bounded_loads(self):
+        def busiest_coordinator(epsilon):
+            dynamo99.DynamoNode.EPSILON = epsilon
+            with simulation.Simulation(seed=1):
+                for _ in range(6):
+                    dynamo99.DynamoNode()
+                a = dynamo99.DynamoClientNode('a')
+                for ii in range(30):  # all in progress at once
+                    a.put('K1', [None], ii)
+                Framework.schedule(timers_to_process=0)
+                coordinators = [msg.from_node for (action, msg) in History.history
+                                if action == 'send' and isinstance(msg, dynamomessages.ClientPutRsp)]
+                self.assertEqual(len(coordinators), 30)
+                self.assertEqual(dynamo99.DynamoNode.chash.total_load, 0)
+                return max(coordinators.count(node) for node in set(coordinators))
+        saved = dynamo99.DynamoNode.EPSILON
+        try:
+            # The 30 requests are spread evenly over the 3 nodes in the preference list
+            self.assertEqual(busiest_coordinator(0.5), 10)
+            self.assertTrue(busiest_coordinator(None) > 10)
+        finally:
+            dynamo99.DynamoNode.EPSILON = saved
+
+    def test_abandoned_request_load(self):
+        with simulation.Simulation(seed=1):
+            nodes = [dynamo99.DynamoNode() for _ in range(3)]
+            a = dynamo99.DynamoClientNode('a')
+            coordinator = dynamo99.DynamoNode.chash.find_nodes('K1', 3)[0][0]
+            Framework.set_latency(1)
+            for node in nodes:
+                if node is not coordinator:
+                    node.fail()
+            a.put('K1', [None], 1, destnode=coordinator)
+            Framework.schedule(until=1000)
+            # The request can't get W=2 replies, so is given up once the other nodes time out
+            self.assertEqual(coordinator.pending_req, {dynamomessages.PutReq: {}, dynamomessages.GetReq: {}})
+            self.assertEqual(coordinator.pending_put_msg, {})
+            self.assertEqual(dynamo99.DynamoNode.chash.total_load, 0)
+
+    def test_partial_heal(self):
+        nodes = [dynamo99.DynamoNode() for _ in range(4)]
+        (A, B, C, D) = nodes
+        Framework.cut_wires((A, B), (C, D))
+        Framework.cut_wires((A,), (C, D))
+        Framework.cut_wires((C, D), (A, B))
+        self.assertFalse(Framework.reachable(A, C))
+        self.assertFalse(Framework.reachable(B, D))
+        self.assertFalse(Framework.reachable(D, A))
+        self.assertTrue(Framework.reachable(A, B))
+        Framework.heal_wires((A, B), (C, D))
+        # A->C is still covered by the second cut
+        self.assertFalse(Framework.reachable(A, C))
+        self.assertTrue(Framework.reachable(B, D))
+        self.assertFalse(Framework.reachable(D, A))
+        Framework.cuts = [((D,), (A,))]
+        self.assertTrue(Framework.reachable(A, C))
+        self.assertFalse(Framework.reachable(D, A))
+        Framework.heal()
+        for from_node in nodes:
+            for to_node in nodes:
+                self.assertTrue(Framework.reachable(from_node, to_node))
+
     def test_partition(self):
         dynamomessages._show_metadata = True
         all_nodes = self.partition()
@@ -337,10 +468,13 @@ class SimpleTestCase(unittest.TestCase):
         print History.ladder(force_include=all_nodes, spacing=16, key=lambda x: ' ' if x.name == 'b' else x.name)
         dynamomessages._show_metadata = False
 
-    def partition_repair(self):
+    def partition_repair(self, heal=False):
         # Repair the partition
         History.add("announce", "Repair network partition")
-        Framework.cuts = []
+        if heal:
+            Framework.heal()
+        else:
+            Framework.cuts = []
         Framework.schedule(timers_to_process=12)
 
         # Get from node a
@@ -348,6 +482,62 @@ class SimpleTestCase(unittest.TestCase):
         a.get('K1')
         Framework.schedule(timers_to_process=0)
 
+    def partition_summary(self):
+        a = Node.node['a']
+        # Sibling order depends on set iteration order, so sort the values
+        return ([(node.name, sorted(node.get_contents())) for node in dynamo99.DynamoNode.nodelist],
+                len(History.history), sorted(zip(a.last_msg.value, [str(x) for x in a.last_msg.metadata])),
+                TimerManager.pending_count())
+
+    def test_snapshot(self):
+        self.partition()
+        snapshot = simulation.current().snapshot()
+        self.partition_repair()
+        expected = self.partition_summary()
+        for _ in range(2):  # each restore is an independent copy
+            with simulation.restore(snapshot):
+                self.assertEqual(len(Framework.cuts), 2)
+                self.partition_repair()
+                self.assertEqual(self.partition_summary(), expected)
+        self.assertEqual(self.partition_summary(), expected)
+
+    def test_partition_heal(self):
+        # Framework.heal() repairs the partition just as replacing Framework.cuts does
+        with simulation.Simulation(seed=1) as sim:
+            self.partition()
+            snapshot = sim.snapshot()
+            self.partition_repair()
+            expected = self.partition_summary()
+        with simulation.restore(snapshot):
+            self.partition_repair(heal=True)
+            self.assertEqual(Framework.cuts, [])
+            self.assertEqual(self.partition_summary(), expected)
+
+    def test_branch(self):
+        self.partition()
+        before = Framework.summary()
+        D = Node.node['D']
+
+        def fail_d():
+            D.fail()
+            self.partition_repair()
+            return Framework.summary()
+
+        def repair():
+            self.partition_repair()
+            return Framework.summary()
+
+        def bad():
+            raise ValueError("no")
+
+        results = Framework.branch([repair, fail_d, Framework.summary], processes=2)
+        self.assertEqual(Framework.summary(), before)
+        self.assertEqual(results[2], before)
+        self.assertEqual(results[0]['failed'], [])
+        self.assertEqual(results[1]['failed'], ['D'])
+        self.assertTrue(results[0]['history']['deliver'] > before['history']['deliver'])
+        self.assertRaises(RuntimeError, Framework.branch, [bad])
+
     def test_partition_detect(self):
         dynamomessages._show_metadata = True
         all_nodes = self.partition()
@@ -393,6 +583,310 @@ class SimpleTestCase(unittest.TestCase):
         print putmsg.metadata
 
 
+class DispatchTestCase(unittest.TestCase):
+    """Test dispatch of messages to handler methods"""
+    def setUp(self):
+        reset_all()
+
+    def tearDown(self):
+        reset_all()
+
+    def test_dispatch(self):
+        class PingNode(Node):
+            def __init__(self):
+                super(PingNode, self).__init__()
+                self.received = []
+
+            @handles(dynamomessages.PingReq)
+            def rcv_ping(self, msg):
+                self.received.append(('ping', msg))
+
+            @handles(dynamomessages.DynamoRequestMessage)
+            def rcv_request(self, msg):
+                self.received.append(('request', msg))
+
+        class GetNode(PingNode):
+            @handles(dynamomessages.GetReq)
+            def rcv_get(self, msg):
+                self.received.append(('get', msg))
+
+            def rcv_ping(self, msg):  # overrides the handler, without re-registering
+                self.received.append(('ping2', msg))
+
+        (A, B) = (PingNode(), GetNode())
+        for node in (A, B):
+            for msg in (dynamomessages.PingReq(A, node), dynamomessages.GetReq(A, node, 'K1'),
+                        dynamomessages.PutReq(A, node, 'K1', 1, None)):
+                node.rcvmsg(msg)
+        self.assertEqual([action for (action, _) in A.received], ['ping', 'request', 'request'])
+        self.assertEqual([action for (action, _) in B.received], ['ping2', 'get', 'request'])
+        self.assertRaises(TypeError, A.rcvmsg, dynamomessages.PingRsp(dynamomessages.PingReq(B, A)))
+
+
+class MerkleSyncTestCase(unittest.TestCase):
+    """Test synchronizing the stores of Merkle nodes"""
+    def setUp(self):
+        reset_all()
+
+    def tearDown(self):
+        reset_all()
+
+    def sent(self, msg_class):
+        return [msg for (action, msg) in History.history if action == 'send' and isinstance(msg, msg_class)]
+
+    def test_sync(self):
+        data = dict(('K%d' % ii, ii) for ii in xrange(2000))
+        (A, B) = (MerkleNode(depth=10, initdata=data), MerkleNode(depth=10, initdata=data))
+        A.sync_with(B)
+        Framework.schedule()
+        self.assertEqual(len(self.sent(merklemessages.MerkleCompareReq)), 1)
+        self.assertEqual(A.last_sync, (B, []))
+
+        A.store['K1'] = 'xyzzy'
+        B.store['K2'] = 'plugh'
+        B.store['new'] = 'new'
+        changed = sorted(set(A.store._findleaf(key) for key in ('K1', 'K2', 'new')))
+        self.assertEqual(A.store.diff(B.store), changed)
+        History.reset()
+        A.sync_with(B)
+        Framework.schedule()
+        self.assertEqual(A.last_sync, (B, changed))
+        self.assertEqual(dict(A.store.items()), dict(B.store.items()))
+        self.assertEqual(A.store.root.value.digest(), B.store.root.value.digest())
+        self.assertEqual(A.store['K1'], max('xyzzy', 1))
+        self.assertEqual(A.store['new'], 'new')
+        # One comparison per level, covering just the subtrees that differ, then just the
+        # items of the differing leaves are swapped
+        compares = self.sent(merklemessages.MerkleCompareReq)
+        self.assertEqual(len(compares), 11)
+        self.assertTrue(sum(len(msg.digests) for msg in compares) <= 1 + 2 * len(changed) * 10)
+        exchanged = self.sent(merklemessages.MerkleCompareRsp)[-1].items.values()
+        exchanged += self.sent(merklemessages.MerkleSyncReq)[0].items.values()
+        self.assertEqual(sum(len(items) for items in exchanged),
+                         2 * sum(len(A.store.leaf_items(leafidx)) for leafidx in changed) - 1)
+
+        # Nodes ignore requests for trees of a different shape, or using a different hash function
+        C = MerkleNode(depth=8, initdata=data)
+        C.sync_with(A)
+        D = MerkleNode(depth=10, initdata=data, hashfn='sha1')
+        D.sync_with(A)
+        Framework.schedule()
+        self.assertEqual(C.last_sync, None)
+        self.assertEqual(D.last_sync, None)
+
+
+class VirtualTimeTestCase(unittest.TestCase):
+    """Test running the framework in virtual time"""
+    def setUp(self):
+        _logger.info("Reset for next test")
+        reset_all()
+        dynamo1.DynamoNode.reset()
+        dynamo99.DynamoNode.reset()
+        self.store_class = TimerManager.store_class
+
+    def tearDown(self):
+        _logger.info("Reset after last test")
+        TimerManager.use_store(self.store_class)
+        reset_all()
+
+    def test_latency(self):
+        for _ in range(6):
+            dynamo1.DynamoNode()
+        a = dynamo1.DynamoClientNode('a')
+        pref_list = dynamo1.DynamoNode.chash.find_nodes('K1', 3)[0]
+        Framework.set_latency(5)
+        a.put('K1', None, 1, destnode=pref_list[0])
+        Framework.schedule()
+        # ClientPut, PutReq, PutRsp, ClientPutRsp
+        self.assertEqual(EventQueue.now, 20)
+        self.assertEqual(Framework.response_times[dynamomessages.ClientPut], [20])
+        self.assertEqual(Framework.response_times[dynamomessages.PutReq], [10, 10, 10])
+
+    def test_link_latency(self):
+        for _ in range(6):
+            dynamo1.DynamoNode()
+        a = dynamo1.DynamoClientNode('a')
+        pref_list = dynamo1.DynamoNode.chash.find_nodes('K1', 3)[0]
+        Framework.set_latency(5)
+        Framework.set_latency(50, pref_list[0], pref_list[2])
+        a.put('K1', None, 1, destnode=pref_list[0])
+        Framework.schedule(until=20)
+        # Quorum of W=2 reached without waiting for the slow link
+        self.assertEqual(EventQueue.now, 20)
+        self.assertEqual(Framework.response_times[dynamomessages.ClientPut], [20])
+        Framework.schedule()
+        self.assertEqual(EventQueue.now, 60)
+        self.assertEqual(sorted(Framework.response_times[dynamomessages.PutReq]), [10, 10, 55])
+
+    def test_timer_expiry(self):
+        self.timer_expiry()
+
+    def test_timer_wheel_expiry(self):
+        TimerManager.use_store(lambda: TimerWheel(tick=10))
+        self.timer_expiry()
+
+    def timer_expiry(self):
+        Framework.set_latency(1)
+        node = dynamo1.DynamoNode()
+        pops = []
+        TimerManager.start_timer(node, reason="slow", duration=50, callback=pops.append)
+        tmsg = TimerManager.start_timer(node, reason="cancelled", duration=20, callback=pops.append)
+        TimerManager.start_timer(node, reason="fast", duration=10, callback=pops.append)
+        TimerManager.cancel_timer(tmsg)
+        Framework.schedule(until=30)
+        self.assertEqual(pops, ["fast"])
+        self.assertEqual(EventQueue.now, 30)
+        Framework.schedule()
+        self.assertEqual(pops, ["fast", "slow"])
+        self.assertEqual(EventQueue.now, 50)
+        self.assertEqual(TimerManager.pending_count(), 0)
+
+    def test_timer_before_latency(self):
+        self.timer_before_latency()
+
+    def test_timer_wheel_before_latency(self):
+        TimerManager.use_store(lambda: TimerWheel(tick=10))
+        self.timer_before_latency()
+
+    def timer_before_latency(self):
+        # Timers started in zero-latency mode carry on running in virtual time
+        node = dynamo1.DynamoNode()
+        pops = []
+        TimerManager.start_timer(node, reason="early", duration=30, callback=pops.append)
+        nodes = [dynamo99.DynamoNode() for _ in range(3)]
+        Framework.set_latency(1)
+        Framework.schedule(until=29)
+        self.assertEqual(pops, [])
+        Framework.schedule(until=30)
+        self.assertEqual(pops, ["early"])
+        # Including the retry timers of Dynamo nodes
+        Framework.schedule(until=250)
+        retries = [tmsg for (action, tmsg) in History.history if action == "pop" and tmsg.reason == "retry"]
+        self.assertEqual(sorted(tmsg.from_node for tmsg in retries), sorted(nodes * 2))
+        self.assertEqual(TimerManager.pending_count(), 3)
+
+    def test_wheel_cancel_in_slot(self):
+        # A timer can cancel one that expires in the same TimerWheel slot
+        TimerManager.use_store(lambda: TimerWheel(tick=10))
+        Framework.set_latency(1)
+        node = dynamo1.DynamoNode()
+        pops = []
+        later = TimerManager.start_timer(node, reason="later", duration=9, callback=pops.append)
+        TimerManager.start_timer(node, reason="first", duration=5, priority=20,
+                                 callback=lambda reason: TimerManager.cancel_timer(later))
+        Framework.schedule()
+        self.assertEqual(pops, [])
+        self.assertEqual(TimerManager.pending_count(), 0)
+
+    def test_switch_store(self):
+        # Timers pending in virtual time keep their expiry times when the store changes
+        Framework.set_latency(1)
+        node = dynamo1.DynamoNode()
+        pops = []
+        for (reason, duration) in (("slow", 50), ("fast", 13), ("medium", 31)):
+            TimerManager.start_timer(node, reason=reason, duration=duration, callback=pops.append)
+        Framework.schedule(until=5)
+        TimerManager.use_store(lambda: TimerWheel(tick=10))
+        Framework.schedule(until=20)
+        self.assertEqual(pops, ["fast"])
+        TimerManager.use_store(lambda: TimerWheel(tick=1))
+        TimerManager.start_timer(node, reason="late", duration=45, callback=pops.append)
+        Framework.schedule(until=35)
+        self.assertEqual(pops, ["fast", "medium"])
+        TimerManager.use_store(TimerHeap)
+        Framework.schedule()
+        self.assertEqual(pops, ["fast", "medium", "slow", "late"])
+        self.assertEqual(EventQueue.now, 65)
+        self.assertEqual(TimerManager.pending_count(), 0)
+
+    def test_request_timeout(self):
+        self.request_timeout()
+        print History.ladder(force_include=self.pref_list, spacing=16)
+
+    def test_timer_wheel_request_timeout(self):
+        TimerManager.use_store(TimerWheel)
+        self.request_timeout()
+
+    def request_timeout(self):
+        for _ in range(6):
+            dynamo99.DynamoNode()
+        a = dynamo99.DynamoClientNode('a')
+        pref_list = dynamo99.DynamoNode.chash.find_nodes('K1', 5)[0]
+        Framework.set_latency(1)
+        pref_list[1].fail()
+        pref_list[2].fail()
+        a.put('K1', [None], 1, destnode=pref_list[0])
+        Framework.schedule(until=1000)
+        # Failed nodes were only detected once the request timers expired
+        self.assertTrue(isinstance(a.last_msg, dynamomessages.ClientPutRsp))
+        self.assertTrue(max(Framework.response_times[dynamomessages.ClientPut]) > 100)
+        self.pref_list = pref_list
+
+
+class SimulationTestCase(unittest.TestCase):
+    """Test independent simulation contexts"""
+    def setUp(self):
+        _logger.info("Reset for next test")
+        reset_all()
+        dynamo99.DynamoNode.reset()
+
+    def tearDown(self):
+        _logger.info("Reset after last test")
+        reset_all()
+
+    def put_keys(self):
+        for _ in range(6):
+            dynamo99.DynamoNode()
+        a = dynamo99.DynamoClientNode('a')
+        for ii in range(20):
+            a.put('K%d' % ii, [None], ii)
+        Framework.schedule(timers_to_process=0)
+        return ([(node.name, sorted(node.get_contents())) for node in dynamo99.DynamoNode.nodelist],
+                len(History.history))
+
+    def test_independent(self):
+        sim1 = simulation.Simulation(seed=1)
+        sim2 = simulation.Simulation(seed=1)
+        results1 = sim1.run(self.put_keys)
+        # Default simulation is untouched
+        self.assertEqual(Node.node, {})
+        self.assertEqual(History.history, [])
+        self.assertEqual(dynamo99.DynamoNode.nodelist, [])
+        results2 = sim2.run(self.put_keys)
+        self.assertEqual(results1, results2)
+        with sim1:
+            self.assertEqual(len(dynamo99.DynamoNode.nodelist), 6)
+            self.assertTrue(simulation.current() is sim1)
+            with sim2:
+                self.assertTrue(simulation.current() is sim2)
+            self.assertEqual(Node.node['a'].last_msg.__class__, dynamomessages.ClientPutRsp)
+        self.assertTrue(simulation.current() is simulation.default())
+        sim1.reset()
+        with sim1:
+            self.assertEqual(Node.node, {})
+
+    def test_set_before_use(self):
+        with simulation.Simulation():
+            EventQueue.local_nodes = {}
+            self.assertFalse(EventQueue.enabled)
+            self.assertEqual(EventQueue.local_nodes, {})
+
+    def test_threads(self):
+        sims = [simulation.Simulation(seed=(ii % 2)) for ii in range(4)]
+        results = [None] * len(sims)
+
+        def run(ii):
+            results[ii] = sims[ii].run(self.put_keys)
+        threads = [threading.Thread(target=run, args=(ii,)) for ii in range(len(sims))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1], results[3])
+        self.assertEqual(results[0], simulation.Simulation(seed=0).run(self.put_keys))
+
+
 if __name__ == "__main__":
     ii = 1
     while ii < len(sys.argv):
@@ -1,12 +1,16 @@
 """Timer functionality"""
+import heapq
 import logging
 
 from message import Timer
 from history import History
+from eventqueue import EventQueue
+from simulation import ContextMeta
 
 _logger = logging.getLogger('dynamo')
 
 DEFAULT_PRIORITY = 10
+DEFAULT_DURATION = 100  # simulated milliseconds, only relevant in virtual time
 
 
 def _priority(tmsg):
@@ -17,58 +21,393 @@ def _priority(tmsg):
     return priority
 
 
+def _duration(tmsg):
+    duration = DEFAULT_DURATION
+    node = tmsg.from_node
+    if 'timer_duration' in node.__class__.__dict__:
+        duration = node.__class__.__dict__['timer_duration']
+    return duration
+
+
+class TimerList(object):
+    """Store of pending timers, as a list maintained in order of priority then insertion"""
+    bulk_expiry = False  # Timers in virtual time are queued individually in the EventQueue
+
+    def __init__(self):
+        self.pending = []  # list of (priority, tmsg) tuples
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, priority, tmsg):
+        # Figure out where in the list to insert
+        for ii in range(len(self.pending)):
+            if priority > self.pending[ii][0]:
+                self.pending.insert(ii, (priority, tmsg))
+                return
+        self.pending.append((priority, tmsg))
+
+    def remove(self, tmsg):
+        """Remove the given timer; returns whether it was present"""
+        for (this_prio, this_tmsg) in self.pending:
+            if this_tmsg == tmsg:
+                self.pending.remove((this_prio, this_tmsg))
+                return True
+        return False
+
+    def pop(self):
+        """Remove and return the first pending timer"""
+        return self.pending.pop(0)[1]
+
+    def items(self):
+        """Return list of (priority, tmsg) tuples in pop order"""
+        return list(self.pending)
+
+
+class TimerHeap(object):
+    """Store of pending timers, as a heap ordered by priority then insertion.
+
+    Cancelled timers are left in the heap and skipped when they reach the top; the heap
+    is rebuilt if they come to outnumber the live timers."""
+    bulk_expiry = False  # Timers in virtual time are queued individually in the EventQueue
+
+    def __init__(self):
+        self.heap = []  # heap of (-priority, seqno, tmsg) tuples
+        self.live = {}  # tmsg => seqno of its heap entry
+        self.seqno = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    def add(self, priority, tmsg):
+        self.seqno = self.seqno + 1
+        self.live[tmsg] = self.seqno
+        heapq.heappush(self.heap, (-priority, self.seqno, tmsg))
+
+    def remove(self, tmsg):
+        """Remove the given timer; returns whether it was present"""
+        if tmsg not in self.live:
+            return False
+        del self.live[tmsg]
+        if len(self.heap) > 2 * len(self.live) + 64:
+            self.heap = [entry for entry in self.heap if self.live.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+        return True
+
+    def pop(self):
+        """Remove and return the first pending timer"""
+        while True:
+            (_, seqno, tmsg) = heapq.heappop(self.heap)
+            if self.live.get(tmsg) == seqno:
+                del self.live[tmsg]
+                return tmsg
+
+    def items(self):
+        """Return list of (priority, tmsg) tuples in pop order"""
+        return [(-negprio, tmsg) for (negprio, seqno, tmsg) in sorted(self.heap)
+                if self.live.get(tmsg) == seqno]
+
+
+class WheelTick(object):
+    """EventQueue entry for the expiry of all the timers in one slot of a TimerWheel"""
+    def __init__(self, slot, wheel):
+        self.slot = slot
+        self.wheel = wheel  # ticks left over from a store that has since been replaced are ignored
+
+
+class TimerWheel(object):
+    """Store of pending timers, as a hashed timing wheel.
+
+    Timers are hashed into a slot for the tick (of the given length, in simulated milliseconds)
+    in which they expire, and kept in priority then insertion order within the slot.  Starting
+    and cancelling a timer are both O(1).  In virtual time, each slot has a single EventQueue
+    entry and all of its timers expire together; in zero-latency mode, every timer is in the
+    slot for the next tick, and popping them one at a time uses a heap (built on first use, and
+    with cancelled timers skipped lazily as for TimerHeap)."""
+    bulk_expiry = True
+
+    def __init__(self, tick=1):
+        self.tick = tick
+        self.slots = {}  # slot number => {tmsg => (-priority, seqno, tmsg)}
+        self.heaps = {}  # slot number => heap of (-priority, seqno, tmsg), for slots popped from
+        self.where = {}  # tmsg => slot number
+        self.seqno = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, priority, tmsg, expiry=0):
+        """Add a timer due at the given expiry time.  If this is the first timer in its
+        slot, returns the slot number, otherwise None."""
+        slot = -(-expiry // self.tick)  # round up, so timers never expire early
+        self.seqno = self.seqno + 1
+        entry = (-priority, self.seqno, tmsg)
+        self.where[tmsg] = slot
+        timers = self.slots.get(slot)
+        if timers is None:
+            self.slots[slot] = {tmsg: entry}
+            return slot
+        timers[tmsg] = entry
+        if slot in self.heaps:
+            heapq.heappush(self.heaps[slot], entry)
+        return None
+
+    def remove(self, tmsg):
+        """Remove the given timer; returns whether it was present"""
+        slot = self.where.pop(tmsg, None)
+        if slot is None:
+            return False
+        timers = self.slots[slot]
+        del timers[tmsg]
+        if not timers:
+            del self.slots[slot]
+            self.heaps.pop(slot, None)
+        elif slot in self.heaps and len(self.heaps[slot]) > 2 * len(timers) + 64:
+            del self.heaps[slot]  # mostly cancelled timers; rebuilt on the next pop()
+        return True
+
+    def slot_time(self, slot):
+        """Return the virtual time at which the given slot expires"""
+        return slot * self.tick
+
+    def pop(self):
+        """Remove and return the first pending timer"""
+        if not self.slots:
+            raise IndexError("pop from empty TimerWheel")
+        slot = min(self.slots)
+        timers = self.slots[slot]
+        heap = self.heaps.get(slot)
+        if heap is None:
+            heap = self.heaps[slot] = timers.values()
+            heapq.heapify(heap)
+        while True:
+            entry = heapq.heappop(heap)
+            tmsg = entry[2]
+            if timers.get(tmsg) is entry:
+                self.remove(tmsg)
+                return tmsg
+
+    def expire(self, slot):
+        """Remove and return all of the timers in the given slot, in order"""
+        if slot not in self.slots:
+            return []
+        timers = self.slots.pop(slot)
+        self.heaps.pop(slot, None)
+        results = [tmsg for (_, _, tmsg) in sorted(timers.itervalues())]
+        for tmsg in results:
+            del self.where[tmsg]
+        return results
+
+    def items(self):
+        """Return list of (priority, tmsg) tuples in pop order"""
+        results = []
+        for slot in sorted(self.slots):
+            results.extend([(-negprio, tmsg) for (negprio, _, tmsg) in sorted(self.slots[slot].itervalues())])
+        return results
+
+
 class TimerManager(object):
-    # List of pending timers, maintained in order of priority then insertion
-    pending = []  # list of (priority, tmsg) tuples
+    __metaclass__ = ContextMeta
+    __context__ = ('pending', 'scheduled')
+    # Implementation of the store of pending timers; TimerList, TimerHeap or TimerWheel
+    store_class = TimerHeap
+    # Pending timers, maintained in order of priority then insertion
+    pending = store_class()
+    # Timers running in virtual time that live in the EventQueue individually
+    # (rather than in a bulk_expiry store), plus those of a TimerWheel slot that is expiring
+    scheduled = {}  # tmsg => priority (None for timers from a TimerWheel slot)
 
     @classmethod
     def pending_count(cls):
-        return len(cls.pending)
+        return len(cls.pending) + len(cls.scheduled)
 
     @classmethod
     def reset(cls):
-        cls.pending = []
+        cls.pending = cls.store_class()
+        cls.scheduled = {}
 
     @classmethod
-    def start_timer(cls, node, reason=None, callback=None, priority=None):
-        """Start a timer for the given node, with an option reason code"""
-        if node.failed:
+    def use_store(cls, store_class):
+        """Switch to a different implementation for the store of pending timers; this should
+        be a class, or a factory function such as lambda: TimerWheel(tick=10)"""
+        old_pending = cls.pending
+        cls.store_class = store_class
+        cls.pending = store_class()
+        for (priority, tmsg) in old_pending.items():
+            if EventQueue.enabled:
+                # Keep the timer's original expiry time (slots in a TimerWheel can run late)
+                cls._schedule(priority, tmsg, max(0, tmsg.expiry - EventQueue.now))
+            else:
+                cls.pending.add(priority, tmsg)
+
+    @classmethod
+    def start_timer(cls, node, reason=None, callback=None, priority=None, duration=None):
+        """Start a timer for the given node, with an option reason code.  The duration
+        (in simulated milliseconds) only has an effect when running in virtual time."""
+        if node.failed or not EventQueue.is_local(node):
             return None
-        tmsg = Timer(node, reason, callback=callback)
+        tmsg = Timer(node, reason, callback=callback, duration=duration)
         History.add("start", tmsg)
         if priority is None:  # default to priority of the node
             priority = _priority(tmsg)
         _logger.debug("Start timer %s prio %d for node %s reason %s", id(tmsg), priority, node, reason)
-        # Figure out where in the list to insert
-        for ii in range(len(cls.pending)):
-            if priority > cls.pending[ii][0]:
-                cls.pending.insert(ii, (priority, tmsg))
-                return tmsg
-        cls.pending.append((priority, tmsg))
+        if EventQueue.enabled:
+            cls._schedule(priority, tmsg, duration)
+            return tmsg
+        cls.pending.add(priority, tmsg)
         return tmsg
 
+    @classmethod
+    def _schedule(cls, priority, tmsg, duration):
+        """Set a timer to expire the given time (default: the node's timer duration) from now,
+        in virtual time"""
+        if duration is None:
+            duration = _duration(tmsg)
+        tmsg.expiry = EventQueue.now + duration
+        # Timers expire after messages that arrive at the same time, then in priority order
+        if cls.pending.bulk_expiry:
+            slot = cls.pending.add(priority, tmsg, expiry=tmsg.expiry)
+            if slot is not None:
+                delay = cls.pending.slot_time(slot) - EventQueue.now
+                EventQueue.push(delay, WheelTick(slot, cls.pending), rank=(1,))
+        else:
+            cls.scheduled[tmsg] = priority
+            EventQueue.push(duration, tmsg, rank=(1, -priority), source=tmsg.from_node)
+
+    @classmethod
+    def start_virtual_time(cls):
+        """Move the timers started in zero-latency mode into the EventQueue, once it has been
+        enabled; as no time passes in zero-latency mode, each runs for its full duration from now"""
+        for (priority, tmsg) in cls.pending.items():
+            cls.pending.remove(tmsg)
+            cls._schedule(priority, tmsg, tmsg.duration)
+
     @classmethod
     def cancel_timer(cls, tmsg):
         """Cancel the given timer"""
-        for (this_prio, this_tmsg) in cls.pending:
-            if this_tmsg == tmsg:
-                _logger.debug("Cancel timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
-                cls.pending.remove((this_prio, this_tmsg))
-                History.add("cancel", tmsg)
-                return
+        if tmsg in cls.scheduled:
+            # Leave the entry in the EventQueue; it is ignored when it comes up
+            _logger.debug("Cancel timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
+            del cls.scheduled[tmsg]
+            History.add("cancel", tmsg)
+            return
+        if cls.pending.remove(tmsg):
+            _logger.debug("Cancel timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
+            History.add("cancel", tmsg)
 
     @classmethod
     def pop_timer(cls):
         """Pop the first pending timer"""
         while True:
-            (_, tmsg) = cls.pending.pop(0)
+            tmsg = cls.pending.pop()
             if tmsg.from_node.failed:
                 continue
-            _logger.debug("Pop timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
-            History.add("pop", tmsg)
-            if tmsg.callback is None:
-                # Default to calling Node.timer_pop()
-                tmsg.from_node.timer_pop(tmsg.reason)
-            else:
-                tmsg.callback(tmsg.reason)
+            cls._fire(tmsg)
             return
+
+    @classmethod
+    def is_running(cls, event):
+        """Indicate whether a timer (or TimerWheel slot) from the EventQueue is still due to expire"""
+        if isinstance(event, WheelTick):
+            return event.wheel is cls.pending and event.slot in cls.pending.slots
+        return event in cls.scheduled
+
+    @classmethod
+    def expire(cls, event):
+        """Expire a timer (or all the timers in a TimerWheel slot) that has reached the front of
+        the EventQueue.  Returns the number of timers that popped, skipping those whose node
+        has failed."""
+        if isinstance(event, WheelTick):
+            tmsgs = cls.pending.expire(event.slot)
+            # Until they pop, the slot's timers can still be cancelled by those ahead of them
+            cls.scheduled.update(dict.fromkeys(tmsgs))
+        else:
+            tmsgs = [event]
+        count = 0
+        for tmsg in tmsgs:
+            if tmsg not in cls.scheduled:
+                continue
+            del cls.scheduled[tmsg]
+            if tmsg.from_node.failed:
+                continue
+            cls._fire(tmsg)
+            count = count + 1
+        return count
+
+    @classmethod
+    def _fire(cls, tmsg):
+        _logger.debug("Pop timer %s for node %s reason %s", id(tmsg), tmsg.from_node, tmsg.reason)
+        History.add("pop", tmsg)
+        if tmsg.callback is None:
+            # Default to calling Node.timer_pop()
+            tmsg.from_node.timer_pop(tmsg.reason)
+        else:
+            tmsg.callback(tmsg.reason)
+
+
+# -----------IGNOREBEYOND: test code ---------------
+import sys
+import random
+import unittest
+
+
+class TimerStoreTestCase(unittest.TestCase):
+    """Test implementations of the store of pending timers"""
+
+    def checkOrdering(self, store_class):
+        store = store_class()
+        timers = [object() for ii in xrange(200)]
+        priorities = [random.choice((10, 15, 17, 20)) for tmsg in timers]
+        for tmsg, priority in zip(timers, priorities):
+            store.add(priority, tmsg)
+        cancelled = set(random.sample(timers, 150))
+        for tmsg in cancelled:
+            self.assertTrue(store.remove(tmsg))
+        # Cancelling twice has no effect
+        self.assertFalse(store.remove(iter(cancelled).next()))
+        self.assertEqual(len(store), 50)
+        # Expect priority order, then insertion order
+        expected = [tmsg for (ii, tmsg) in
+                    sorted(enumerate(timers), key=lambda x: (-priorities[x[0]], x[0]))
+                    if tmsg not in cancelled]
+        self.assertEqual([tmsg for (_, tmsg) in store.items()], expected)
+        popped = [store.pop() for ii in xrange(len(store))]
+        self.assertEqual(popped, expected)
+        self.assertEqual(len(store), 0)
+        self.assertRaises(IndexError, store.pop)
+
+    def testList(self):
+        self.checkOrdering(TimerList)
+
+    def testHeap(self):
+        self.checkOrdering(TimerHeap)
+
+    def testWheel(self):
+        self.checkOrdering(TimerWheel)
+
+    def testWheelSlots(self):
+        wheel = TimerWheel(tick=10)
+        timers = [object() for ii in xrange(6)]
+        self.assertEqual(wheel.add(10, timers[0], expiry=25), 3)
+        self.assertEqual(wheel.add(20, timers[1], expiry=21), None)
+        self.assertEqual(wheel.add(10, timers[2], expiry=30), None)
+        self.assertEqual(wheel.add(10, timers[3], expiry=5), 1)
+        self.assertEqual(wheel.add(10, timers[4], expiry=31), 4)
+        self.assertEqual(wheel.slot_time(4), 40)
+        self.assertTrue(wheel.remove(timers[4]))
+        self.assertEqual(wheel.expire(4), [])
+        self.assertEqual(wheel.expire(3), [timers[1], timers[0], timers[2]])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.pop(), timers[3])
+
+
+if __name__ == "__main__":
+    ii = 1
+    while ii < len(sys.argv):  # pragma: no cover
+        arg = sys.argv[ii]
+        if arg == "-s" or arg == "--seed":
+            random.seed(sys.argv[ii + 1])
+            del sys.argv[ii:ii + 2]
+        else:
+            ii += 1
+    unittest.main()